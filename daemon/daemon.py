@@ -1,9 +1,10 @@
 import stompy, pprint, urllib, requests, json, time, traceback, textwrap, sys
 from urllib.parse import urlparse
-from data_dispatcher.db import DBProject, DBReplica, DBRSE, DBProximityMap
+from data_dispatcher.db import DBProject, DBFileHandle, DBReplica, DBRSE, DBProximityMap, DBListener
 from data_dispatcher.logs import Logged
 from daemon_web_server import DaemonWebServer
 from tape_interfaces import get_interface
+from rucio_client import RucioReplicaClient
 
 import pythreader
 if pythreader.version_info < (2,10,0):
@@ -219,15 +220,121 @@ class RSEConfig(Logged):
         return self.get(rse).get("preference", 0)
 
     def max_burst(self, rse):
+        # max locality polls per second
         return self.get(rse).get("max_poll_burst", 100)
 
+    def poll_workers(self, rse):
+        # number of concurrent locality polls
+        return self.get(rse).get("poll_workers", 10)
+
+    def max_pin_request(self, rse):
+        # max number of files in one pin request
+        return self.get(rse).get("max_pin_request", 10000)
+
+class ReplicaSyncService(PyThread, Logged):
+    # Syncs replicas of the active DIDs of all the projects with Rucio. Each DID is synced at most once per SyncInterval
+    # regardless of how many projects use it
+
+    SyncInterval = 600          # interval to re-sync replicas with Rucio
+    CheckInterval = 10
+    
+    def __init__(self, db, rse_config, rucio_client, url_schemes=None):
+        # rucio_client is a RucioReplicaClient
+        PyThread.__init__(self, name="ReplicaSyncService", daemon=True)
+        Logged.__init__(self, "ReplicaSyncService")
+        self.DB = db
+        self.RSEConfig = rse_config
+        self.RucioClient = rucio_client
+        url_schemes = [scheme.lower() for scheme in url_schemes or []]
+        self.URLSchemes = url_schemes or None
+        self.SchemesPreference = {scheme: i         # used for sorting
+            for i, scheme in enumerate(url_schemes)
+        }
+        self.Registered = {}        # {project_id -> set of (namespace, name)}
+        self.LastSynced = {}        # {(namespace, name) -> time}
+        self.Stop = False
+
+    @synchronized
+    def register(self, project_id, dids):
+        dids = set(dids)
+        new_dids = dids - self.Registered.get(project_id, set())
+        self.Registered[project_id] = dids
+        if any(did not in self.LastSynced for did in new_dids):
+            self.wakeup()
+
+    @synchronized
+    def unregister(self, project_id):
+        self.Registered.pop(project_id, None)
+
+    @synchronized
+    def due_dids(self):
+        active = set()
+        for dids in self.Registered.values():
+            active |= dids
+        self.LastSynced = {did: t for did, t in self.LastSynced.items() if did in active}        # forget unused DIDs
+        now = time.time()
+        return [did for did in active if self.LastSynced.get(did, 0) + self.SyncInterval <= now]
+
+    @synchronized
+    def synced(self, dids, t):
+        for did in dids:
+            self.LastSynced[did] = t
+
+    def replicas_by_did(self, rucio_replicas):
+        by_namespace_name_rse = {}
+        for r in rucio_replicas:
+            namespace = r["scope"]
+            name = r["name"]
+            for rse, urls in r["rses"].items():
+                if rse in self.RSEConfig:
+                    urls = sorted(urls, key=lambda url:
+                        self.SchemesPreference.get(urlparse(url).scheme.lower(), 1000)
+                    )
+                    available = not self.RSEConfig.is_tape(rse)
+                    data = {
+                        "available": available,
+                        "urls": [self.RSEConfig.fix_url(rse, url) for url in urls]
+                    }
+                    by_namespace_name_rse.setdefault((namespace, name), {})[rse] = data
+        return by_namespace_name_rse
+
+    def sync(self, dids):
+        total_replicas = 0
+        changes = dict(inserted=0, updated=0, deleted=0)
+        t = time.time()
+        chunks = self.RucioClient.list_replicas([{"scope":namespace, "name":name} for namespace, name in dids], 
+                        schemes=self.URLSchemes,
+                        all_states=False, ignore_availability=False)
+        for chunk, rucio_replicas in chunks:
+            total_replicas += len(rucio_replicas)
+            counts = DBReplica.sync_replicas(self.DB, self.replicas_by_did(rucio_replicas))
+            for k, n in counts.items():
+                changes[k] += n
+            self.synced([(did["scope"], did["name"]) for did in chunk], t)
+        self.log(f"sync(): {total_replicas} replicas found for {len(dids)} dids,",
+            "inserted: %(inserted)d, updated: %(updated)d, deleted: %(deleted)d" % changes)
+
+    def run(self):
+        while not self.Stop:
+            try:
+                dids = self.due_dids()
+                if dids:
+                    self.sync(dids)
+            except Exception as e:
+                self.error("exception in sync:", e)
+                self.error(textwrap.indent(traceback.format_exc(), "  "))
+            if not self.Stop:
+                self.sleep(self.CheckInterval)
+
 class ProjectMonitor(Primitive, Logged):
     
     UpdateInterval = 120        # replica availability update interval
     NewRequestInterval = 5      # interval to check on new pin request
-    SyncInterval = 600          # interval to re-sync replicas with Rucio
+    SyncInterval = ReplicaSyncService.SyncInterval      # interval to update the list of DIDs registered with the ReplicaSyncService.
+                                                        # The service owns the Rucio resync schedule, so the DIDs are re-listed
+                                                        # only as often as they are re-synced
     
-    def __init__(self, master, project_id, db, rse_config, rucio_client, url_schemes=None):
+    def __init__(self, master, project_id, db, rse_config, replica_sync):
         Logged.__init__(self, f"ProjectMonitor({project_id})")
         Primitive.__init__(self, name=f"ProjectMonitor({project_id})")
         self.Removed = False
@@ -236,7 +343,7 @@ class ProjectMonitor(Primitive, Logged):
         self.RSEConfig = rse_config
         self.PinRequests = {}       # {rse -> PinRequest}
         self.Master = master
-        self.RucioClient = rucio_client
+        self.ReplicaSync = replica_sync
         self.SyncReplicasJobID = f"sync_replicas_{project_id}"
         self.UpdateAvailabilityJobID = f"update_availability_{project_id}"
         self.CheckStateJobID = f"check_state_{project_id}"
@@ -245,11 +352,6 @@ class ProjectMonitor(Primitive, Logged):
         self.SyncTask = SyncTaskQueue.add(self.sync_replicas, interval=self.SyncInterval)
         self.CheckProjectTask = GeneralTaskQueue.add(self.check_project_state, interval=self.UpdateInterval)
         self.UpdateAvailabilityTask = None
-        url_schemes = [scheme.lower() for scheme in url_schemes]
-        self.URLSchemes = url_schemes or None
-        self.SchemesPreference = {scheme: i         # used for sorting
-            for i, scheme in enumerate(url_schemes or [])
-        }
 
     def tape_rse_interface(self, rse):
         interface = self.TapeRSEInterfaces.get(rse)
@@ -264,6 +366,7 @@ class ProjectMonitor(Primitive, Logged):
         self.SyncTask.cancel()
         if self.UpdateAvailabilityTask is not None:
             self.UpdateAvailabilityTask.cancel()
+        self.ReplicaSync.unregister(self.ProjectID)
 
         for rse, rse_interface in self.TapeRSEInterfaces.items():
             rse_interface.unpin_project(self.ProjectID)
@@ -274,12 +377,10 @@ class ProjectMonitor(Primitive, Logged):
         self.Master = None
         self.log("remove_me(): project monitor removed:", reason)
 
-    def active_handles(self, as_dids = True):
-        # returns {did -> handle} for all active handles, or None if the project is not found
-        project = DBProject.get(self.DB, self.ProjectID)
-        if project is None:
-            return None
-        return [h for h in project.handles(with_replicas=True) if h.is_active()]
+    def active_handles(self):
+        # generates active handles with their replicas, streaming them from the database
+        return DBFileHandle.list(self.DB, project_id=self.ProjectID, with_replicas=True,
+                    state=[DBFileHandle.ReadyState, DBFileHandle.ReservedState])
 
     def tape_replicas_by_rse(self, active_handles):
         tape_replicas_by_rse = {}               # {rse -> {did -> replica}}
@@ -307,69 +408,24 @@ class ProjectMonitor(Primitive, Logged):
 
     @synchronized
     def sync_replicas(self):
+        # registers the project active DIDs with the ReplicaSyncService
         if self.Removed:
             self.debug("sync_replicas: already removed. skipping")
             return              # alredy removed
-        active_handles = self.active_handles()
-        self.debug("sync_replicas(): active_handles:", None if active_handles is None else len(active_handles))
-
-        if active_handles is None:
+        project = DBProject.get(self.DB, self.ProjectID)
+        if project is None:
             self.remove_me("deleted")
             return "stop"
-        elif not active_handles:
+        dids = [(h.Namespace, h.Name) 
+                for h in DBFileHandle.list(self.DB, project_id=self.ProjectID, state=[DBFileHandle.ReadyState, DBFileHandle.ReservedState])]
+        self.debug("sync_replicas(): active dids:", len(dids))
+        if not dids:
             self.remove_me("done")
             return "stop"
-            
-        try:
-            dids = [{"scope":h.Namespace, "name":h.Name} for h in active_handles]
-            ndids = len(dids)
-            
-            total_replicas = 0
-            for chunk in chunked(dids, 100):
-                nchunk = len(chunk)
-                #self.debug("sync_replicas: blocking for Master...")
-                with self.Master:
-                    # locked, in case the client needs to refresh the token
-                    #self.debug("sync_replicas: calling list_replicas...")
-                    rucio_replicas = self.RucioClient.list_replicas(chunk, 
-                            schemes=self.URLSchemes,
-                            all_states=False, ignore_availability=False)
-                rucio_replicas = list(rucio_replicas)
-                n = len(rucio_replicas)
-                total_replicas += n
-                self.log(f"sync_replicas(): {n} replicas found for dids chunk {nchunk}")
-
-                by_namespace_name_rse = {}
-                for r in rucio_replicas:
-                    namespace = r["scope"]
-                    name = r["name"]
-                    for rse, urls in r["rses"].items():
-                        #self.debug(namespace, name, rse, urls)
-                        if rse in self.RSEConfig:
-                            urls = sorted(urls, key=lambda url:
-                                self.SchemesPreference.get(urlparse(url).scheme.lower(), 1000)
-                            )
-                            #self.debug(f"RSE {rse} in config")
-                            available = not self.RSEConfig.is_tape(rse)
-                            data = {
-                                "available": available,
-                                "urls": [self.RSEConfig.fix_url(rse, url) for url in urls]
-                            }
-                            by_namespace_name_rse.setdefault((namespace, name), {})[rse] = data
-                            #self.debug("added replica:", data)
-                        else:
-                            pass
-                DBReplica.sync_replicas(self.DB, by_namespace_name_rse)
-            self.log(f"sync_replicas(): {total_replicas} replicas found for {ndids} dids")
-        except Exception as e:
-            print("Exception in sync_replicas:", e, file=sys.stderr)
-            traceback.print_exc()
-            self.error("exception in sync_replicas:", e)
-            self.error(textwrap.indent(traceback.format_exc(), "  "))
+        self.ReplicaSync.register(self.ProjectID, dids)
         if self.UpdateAvailabilityTask is None:
             self.UpdateAvailabilityTask = GeneralTaskQueue.add(self.update_replicas_availability, interval=self.UpdateInterval)
-        self.debug("update_replicas_availability task schduled")
-        self.debug("sync_replicas done")
+            self.debug("update_replicas_availability task schduled")
 
     @synchronized
     def update_replicas_availability(self):
@@ -380,13 +436,15 @@ class ProjectMonitor(Primitive, Logged):
         with self:
             #self.debug("update_replicas_availability(): entered")
             
-            active_handles = self.active_handles()
-            self.debug("update_replicas_availability(): active_handles:", None if active_handles is None else len(active_handles))
-
-            if active_handles is None:
+            project = DBProject.get(self.DB, self.ProjectID)
+            if project is None:
                 self.remove_me("deleted")
                 return "stop"
-            elif not active_handles:
+
+            counts = project.file_state_counts()
+            nactive = counts.get(DBFileHandle.ReadyState, 0) + counts.get(DBFileHandle.ReservedState, 0)
+            self.debug("update_replicas_availability(): active handles:", nactive)
+            if not nactive:
                 self.remove_me("done")
                 return "stop"
 
@@ -394,7 +452,7 @@ class ProjectMonitor(Primitive, Logged):
             # Collect replica info on active replicas located in tape storages
             #
 
-            tape_replicas_by_rse = self.tape_replicas_by_rse(active_handles)               # {rse -> {did -> replica}}
+            tape_replicas_by_rse = self.tape_replicas_by_rse(self.active_handles())               # {rse -> {did -> replica}}
             self.debug("tape_replicas_by_rse:", [(rse, len(dids)) for rse, dids in tape_replicas_by_rse.items()])
         
             next_run = self.UpdateInterval
@@ -409,21 +467,17 @@ class ProjectMonitor(Primitive, Logged):
                 self.debug("pinning", len(replica_paths), "in", rse)
                 rse_interface.pin_project(self.ProjectID, replica_paths)
 
-            project = DBProject.get(self.DB, self.ProjectID)
-            if project is not None and project.WorkerTimeout is not None:
-                self.debug("releasing timed-out handles, timeout=", project.WorkerTimeout)
-                n = project.release_timed_out_handles()
-                if n:
-                    self.log(f"released {n} timed-out handles")
             self.debug("update_replicas_availability(): done")
             return next_run
 
 class ProjectMaster(PyThread, Logged):
     
-    RunInterval = 10        # seconds       - new project discovery latency
+    RunInterval = 10            # seconds       - new project discovery latency if the DB notifications are not available
+    ReconcileInterval = 300     # seconds       - interval to re-read the list of active projects if the notifications work
     PurgeInterval = 30
+    LeaseSweepInterval = 5      # seconds       - interval to release handles reserved longer than the project worker timeout
     
-    def __init__(self, db, rse_config, rucio_client, url_schemes):
+    def __init__(self, db, rse_config, rucio_client, url_schemes, dbconfig=None):
         Logged.__init__(self, "ProjectMaster")
         PyThread.__init__(self, name="ProjectMaster")
         self.DB = db
@@ -432,6 +486,8 @@ class ProjectMaster(PyThread, Logged):
         self.RSEConfig = rse_config
         self.RucioClient = rucio_client
         self.URLSchemes = url_schemes or None
+        self.Listener = DBListener(dbconfig, [DBProject.StateChannel]) if dbconfig else None
+        self.ReplicaSync = ReplicaSyncService(db, rse_config, rucio_client, url_schemes)
 
     def clean(self):
         self.debug("cleaner...")
@@ -443,22 +499,50 @@ class ProjectMaster(PyThread, Logged):
         except:
             self.error("Exception in ProjectMaster.clean():", "\n" + traceback.format_exc())
 
+    def release_expired_leases(self):
+        try:
+            released = DBFileHandle.release_expired(self.DB)
+            for project_id, n in released.items():
+                self.log(f"project {project_id}: released {n} timed-out handles")
+        except:
+            self.error("Exception in ProjectMaster.release_expired_leases():", "\n" + traceback.format_exc())
+
+    def reconcile(self):
+        active_projects = DBProject.active_ids(self.DB)
+        with self:
+            monitor_projects = set(self.Monitors.keys())
+            #for project_id in monitor_projects - active_projects:
+            #    self.remove_project(project_id, "inactive")
+            for project_id in active_projects - monitor_projects:
+                self.log("new project discovered:", project_id)
+                self.add_project(project_id)
+
+    def notified(self, notifications):
+        for channel, payload in notifications:
+            project_id, state = payload.split(":", 1)
+            if state == "active":
+                self.add_project(int(project_id))
+            else:
+                self.debug("project state changed:", project_id, state)     # the monitor will remove itself
+
     def run(self):
+        self.ReplicaSync.start()
         GeneralTaskQueue.append(self.clean, interval = self.PurgeInterval)
+        GeneralTaskQueue.append(self.release_expired_leases, interval = self.LeaseSweepInterval)
+        next_reconcile = 0
         while not self.Stop:
             try:
-                active_projects = set(p.ID for p in DBProject.list(self.DB, state="active") if p.is_active())
-                with self:
-                    monitor_projects = set(self.Monitors.keys())
-                    #for project_id in monitor_projects - active_projects:
-                    #    self.remove_project(project_id, "inactive")
-                    for project_id in active_projects - monitor_projects:
-                        self.log("new project discovered:", project_id)
-                        self.add_project(project_id)
+                if time.time() >= next_reconcile:
+                    self.reconcile()
+                    next_reconcile = time.time() + (self.ReconcileInterval if self.Listener is not None else self.RunInterval)
+                if self.Listener is not None:
+                    self.notified(self.Listener.wait(max(0.0, min(self.RunInterval, next_reconcile - time.time()))))
+                else:
+                    self.sleep(self.RunInterval)
             except Exception as e:
                 self.error("exception in run():\n", traceback.format_exc())
-            #self.debug("sleeping...")
-            self.sleep(self.RunInterval)
+                next_reconcile = 0          # notifications may have been lost
+                self.sleep(self.RunInterval)
 
     @synchronized
     def add_project(self, project_id):
@@ -466,8 +550,7 @@ class ProjectMaster(PyThread, Logged):
             # check if new project
             project = DBProject.get(self.DB, project_id)
             if project is not None:
-                monitor = ProjectMonitor(self, project_id, self.DB, 
-                        self.RSEConfig, self.RucioClient, self.URLSchemes)
+                monitor = ProjectMonitor(self, project_id, self.DB, self.RSEConfig, self.ReplicaSync)
                 self.Monitors[project_id] = monitor
             self.log("project added:", project_id)
 
@@ -562,6 +645,7 @@ class RucioListener(PyThread, Logged):
 def main():
     import sys, yaml, getopt, os
     from wsdbtools import ConnectionPool
+    import data_dispatcher.db
     from rucio.client.replicaclient import ReplicaClient
     from rucio.client.rseclient import RSEClient
     from data_dispatcher.logs import init_logger
@@ -573,6 +657,7 @@ def main():
 
     dbconfig = config["database"]
     connection_pool = ConnectionPool(postgres=dbconfig, max_connections=dbconfig.get("max_connections"))
+    data_dispatcher.db.ServerCursorItersize = dbconfig.get("itersize", data_dispatcher.db.ServerCursorItersize)
 
     rse_config = RSEConfig(config.get("rses", {}), connection_pool)
     ssl_config = config.get("ssl", {})
@@ -601,7 +686,8 @@ def main():
         connection.close()
         del connection
 
-    replica_client = ReplicaClient()        # read standard Rucio config file for now
+    # read standard Rucio config file for now
+    replica_client = RucioReplicaClient(ReplicaClient, max_workers=rucio_config.get("sync_workers", 5))
     rse_client = RSEClient()
     
     proximity_map_loader = None
@@ -625,7 +711,7 @@ def main():
 
     schemes = config.get("replica_url_schemes")
 
-    project_master = ProjectMaster(connection_pool, rse_config, replica_client, schemes)
+    project_master = ProjectMaster(connection_pool, rse_config, replica_client, schemes, dbconfig=dbconfig)
     project_master.start()
 
     server_config = config.get("daemon_server", {})
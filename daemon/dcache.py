@@ -1,13 +1,80 @@
-import traceback, requests, time, json, sys
-from data_dispatcher.db import DBReplica
+import traceback, requests, time, json, sys, threading, heapq
+from concurrent.futures import ThreadPoolExecutor
+from data_dispatcher.db import DBReplica, DBPinRequest
 from pythreader import Primitive, Scheduler, synchronized, PyThread
 from data_dispatcher.logs import Logged
 
+class RateLimiter(object):
+    # spaces the events evenly at no more than <rate> per second, thread safe
+
+    def __init__(self, rate):
+        self.Interval = 1.0/rate if rate else 0.0
+        self.Next = 0.0
+        self.Lock = threading.Lock()
+
+    def wait(self):
+        with self.Lock:
+            now = time.time()
+            t = max(now, self.Next)
+            self.Next = t + self.Interval
+        if t > now:
+            time.sleep(t - now)
+
+class PollerStats(object):
+    # per-RSE locality poll counters
+
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.T0 = time.time()
+        self.Polls = self.Errors = self.Files = 0
+        self.Latency = 0.0              # total, seconds
+        self.MaxLatency = 0.0
+
+    def record(self, latency, error=False, files=1):
+        # one poll request for <files> files
+        with self.Lock:
+            self.Polls += 1
+            self.Files += files
+            if error:
+                self.Errors += 1
+            self.Latency += latency
+            self.MaxLatency = max(self.MaxLatency, latency)
+
+    def reset(self):
+        # returns the counters since the last reset and resets them
+        with self.Lock:
+            t = time.time()
+            dt = t - self.T0
+            out = dict(
+                polls = self.Polls,
+                files = self.Files,
+                errors = self.Errors,
+                polls_per_second = self.Polls/dt if dt > 0 else 0.0,
+                files_per_second = self.Files/dt if dt > 0 else 0.0,
+                average_latency = self.Latency/self.Polls if self.Polls else 0.0,
+                max_latency = self.MaxLatency
+            )
+            self.T0 = t
+            self.Polls = self.Errors = self.Files = 0
+            self.Latency = self.MaxLatency = 0.0
+            return out
+
 class DCachePoller(PyThread, Logged):
     
-    STAGGER = 0.1
+    # Polls file locality using a bounded pool of worker threads. Each worker uses its own keep-alive HTTP session.
+    # max_burst is the maximum number of polls per second
+    #
+    # Each file has its own next poll time, kept in a heap. While the file stays offline, its poll interval grows
+    # exponentially from MinInterval up to MaxInterval. The interval is reset when the pin request makes progress (reset())
+    # and files which the pin request reports as being staged are polled right away (expedite())
+
+    BatchSize = 1000            # max number of files polled before the results are written to the database
+    StatsInterval = 300         # seconds - how often to log the poll statistics
+    MinInterval = 10            # seconds
+    MaxInterval = 600           # seconds
+    BackoffFactor = 2
     
-    def __init__(self, rse, db, base_url, max_burst, ssl_config):
+    def __init__(self, rse, db, base_url, max_burst, ssl_config, workers=10):
         PyThread.__init__(self, name=f"DCachePoller({rse})")
         Logged.__init__(self, f"DCachePoller({rse})")
         self.MaxBurst = max_burst
@@ -15,60 +82,175 @@ class DCachePoller(PyThread, Logged):
         self.RSE = rse
         self.BaseURL = base_url
         self.Files = {}                 # { did -> path }
+        self.Intervals = {}             # { did -> current poll interval }
+        self.NextPoll = {}              # { did -> next poll time }
+        self.Queue = []                 # heap of (next poll time, did), entries not matching NextPoll are stale
         self.Stop = False
         ssl_config = ssl_config or {}
         self.Cert = ssl_config.get("cert")
         self.Key = ssl_config.get("key")
         #self.CA_Bundle = ssl_config.get("ca_bundle")
+        self.Workers = workers
+        self.Executor = ThreadPoolExecutor(workers, thread_name_prefix=f"DCachePoller({rse})")
+        self.RateLimiter = RateLimiter(max_burst)
+        self.Stats = PollerStats()
+        self.LastStats = {}
+        self.Local = threading.local()
         
+    def schedule(self, did, t):
+        # must be called while locked
+        self.NextPoll[did] = t
+        heapq.heappush(self.Queue, (t, did))
+
     @synchronized
     def submit(self, dids_paths):
-        self.Files.update(dict(dids_paths))
+        # adds files to poll, new files are polled right away
+        now = time.time()
+        for did, path in dict(dids_paths).items():
+            if did not in self.Files:
+                self.Intervals[did] = self.MinInterval
+                self.schedule(did, now)
+            self.Files[did] = path
         self.wakeup()
-        
+
+    @synchronized
+    def update(self, dids_paths):
+        # replaces the set of files to poll, keeping the schedule of the files already known
+        dids_paths = dict(dids_paths)
+        for did in list(self.Files.keys()):
+            if did not in dids_paths:
+                del self.Files[did]
+                self.Intervals.pop(did, None)
+                self.NextPoll.pop(did, None)
+        if len(self.Queue) > 2*len(self.NextPoll) + 1000:
+            self.Queue = [(t, did) for did, t in self.NextPoll.items()]
+            heapq.heapify(self.Queue)
+        self.submit(dids_paths)
+
+    @synchronized
+    def reset(self, dids):
+        # the pin request made progress: restart the backoff for the files
+        t = time.time() + self.MinInterval
+        for did in dids:
+            if did in self.Files:
+                self.Intervals[did] = self.MinInterval
+                if self.NextPoll[did] > t:
+                    self.schedule(did, t)
+        self.wakeup()
+
+    @synchronized
+    def expedite(self, dids):
+        # the files are being staged: poll them now
+        now = time.time()
+        for did in dids:
+            if did in self.Files:
+                self.Intervals[did] = self.MinInterval
+                if self.NextPoll[did] > now:
+                    self.schedule(did, now)
+        self.wakeup()
+
+    @synchronized
+    def due(self):
+        # returns the list of up to BatchSize (did, path) to poll now and the time of the next poll after those
+        now = time.time()
+        batch = []
+        while self.Queue and len(batch) < self.BatchSize:
+            t, did = self.Queue[0]
+            if self.NextPoll.get(did) != t:
+                heapq.heappop(self.Queue)           # stale
+            elif t <= now:
+                heapq.heappop(self.Queue)
+                batch.append((did, self.Files[did]))
+            else:
+                break
+        return batch, (self.Queue[0][0] if self.Queue else None)
+
+    @synchronized
+    def polled(self, did, status):
+        # reschedules the polled file according to the poll result
+        if did not in self.Files:
+            return
+        if status in ("available", "not found"):
+            interval = self.MaxInterval
+        else:
+            interval = self.Intervals.get(did, self.MinInterval)
+            self.Intervals[did] = min(self.MaxInterval, interval * self.BackoffFactor)
+        if self.NextPoll.get(did, 0) <= time.time():         # not rescheduled by reset() or expedite() while polling
+            self.schedule(did, time.time() + interval)
+
+    def session(self):
+        session = getattr(self.Local, "session", None)
+        if session is None:
+            session = self.Local.session = requests.Session()
+            session.headers.update({ "accept" : "application/json", "content-type" : "application/json"})
+            session.verify = False
+            if self.Cert is not None:
+                session.cert = (self.Cert, self.Key)
+        return session
+
+    def poll(self, did, path):
+        # returns (did, "available"|"unavailable"|"not found"|None), None on error
+        self.RateLimiter.wait()
+        url = self.BaseURL + path + "?locality=true"
+        t0 = time.time()
+        status = None
+        try:
+            #self.debug("dCache poll URL:", url)
+            response = self.session().get(url)
+            #self.debug("response:", response.status_code, response.text)
+            if response.status_code == 404:
+                self.debug(f"file not found (status 404): {did} {path} - removing")
+                status = "not found"
+            elif response.status_code//100 == 2:
+                data = response.json()
+                status = "available" if "ONLINE" in data.get("fileLocality", "").upper() else "unavailable"
+        except Exception as e:
+            self.debug("error polling", url, ":", e)
+        self.Stats.record(time.time() - t0, error = status is None)
+        return did, status
+
+    def poll_batch(self, batch):
+        # batch: list of (did, path)
+        # yields (did, status) for each file in the batch
+        return self.Executor.map(lambda item: self.poll(*item), batch)
+
+    def stats(self):
+        return self.LastStats
+
+    def log_stats(self):
+        self.LastStats = stats = self.Stats.reset()
+        if stats["polls"]:
+            self.log("polls: %(polls)d, files: %(files)d, errors: %(errors)d, %(polls_per_second).1f polls/s, %(files_per_second).1f files/s, "
+                "latency: average %(average_latency).3f, max %(max_latency).3f seconds" % stats)
+
     def run(self):
+        next_stats = time.time() + self.StatsInterval
         while not self.Stop:
-            while self.Files:
-                with self:
-                    items = list(self.Files.items())
-                    n = len(items)
-                    nburst = min(self.MaxBurst, n)
-                    burst, items = items[:nburst], items[nburst:]
-                    self.Files = dict(items)
-                headers = { "accept" : "application/json",
-                        "content-type" : "application/json"}
+            batch, next_poll = self.due()
+            if batch:
                 available_dids = []
                 unavailable_dids = []
                 remove_dids = []
-                for did, path in burst:
-                    url = self.BaseURL + path + "?locality=true"
-                    cert = None if self.Cert is None else (self.Cert, self.Key)
-                    #self.debug("dCache poll URL:", url)
-                    response = requests.get(url, headers=headers, cert=cert, verify=False)
-                    #self.debug("response:", response.status_code, response.text)
-                    if response.status_code == 404:
-                        self.debug(f"file not found (status 404): {did} {path} - removing")
-                        #self.log("Replica not found:", path)
+                for did, status in self.poll_batch(batch):
+                    self.polled(did, status)
+                    if status == "available":
+                        available_dids.append(did)
+                    elif status == "unavailable":
+                        unavailable_dids.append(did)
+                    elif status == "not found":
                         remove_dids.append(did)
-                    elif response.status_code//100 != 2:
-                        continue
-                    else:
-                        data = response.json()
-                        available = "ONLINE" in data.get("fileLocality", "").upper()
-                        if available:
-                            #self.log("Replica available:", did, path)
-                            available_dids.append(did)
-                        else:
-                            unavailable_dids.append(did)
-                            #self.log("Replica unavailable:", did, path)
                 self.debug("out of %d replicas: available: %d, unavailable: %d, not found:%d" % 
-                    (len(burst), len(available_dids), len(unavailable_dids), len(remove_dids))
+                    (len(batch), len(available_dids), len(unavailable_dids), len(remove_dids))
                 )
                 DBReplica.update_availability_bulk(self.DB, True, self.RSE, available_dids)
                 DBReplica.update_availability_bulk(self.DB, False, self.RSE, unavailable_dids)
                 DBReplica.remove_bulk(self.DB, self.RSE, remove_dids)
-                time.sleep(self.STAGGER)
-            self.sleep(10)
+            if time.time() >= next_stats:
+                self.log_stats()
+                next_stats = time.time() + self.StatsInterval
+            if not batch:
+                timeout = self.MinInterval if next_poll is None else min(self.MinInterval, max(0.0, next_poll - time.time()))
+                self.sleep(timeout)
 
 class PinRequest(Logged):
     
@@ -90,7 +272,9 @@ class PinRequest(Logged):
         self.Complete = False
         self.Expiration = None
         self.Error = None
+        self.StatusCode = None              # HTTP status of the last query
         self.StagedReplicas = set()         # set of paths
+        self.InProgress = set()             # set of paths being staged
         self.debug("created for", len(paths),"replicas")
         self.Mode = mode            # dcache or WLCG
 
@@ -161,6 +345,7 @@ class PinRequest(Logged):
         assert self.URL is not None
         headers = { "accept" : "application/json" }
         r = requests.get(self.URL, headers=headers, verify=False, cert = self.CertTuple)
+        self.StatusCode = r.status_code
         #self.debug("status(): response:", r)
         if r.status_code // 100 == 4:
             self.log("query: HTTP status:", r.status_code, " -- ERROR")
@@ -180,16 +365,26 @@ class PinRequest(Logged):
                 (item.get("target") for item in data["targets"] if item.get("state") == "COMPLETED")
                 if f
             )
+            self.InProgress = set(f for f in
+                (item.get("target") for item in data["targets"] if item.get("state") == "RUNNING")
+                if f
+            )
         elif "files" in data:
             # WLCG format
             self.StagedReplicas = set(item["path"] for item in data["files"]
                     if item.get("onDisk") or item.get("state", "").upper() == "COMPLETED"
             )
+            self.InProgress = set(item["path"] for item in data["files"]
+                    if item.get("state", "").upper() == "STARTED"
+            )
         return data
         
     def staged_replicas(self):
         return self.StagedReplicas
 
+    def in_progress(self):
+        return self.InProgress - self.StagedReplicas
+
     def delete(self):
         assert self.URL is not None
         headers = { "accept" : "application/json" }
@@ -203,6 +398,28 @@ class PinRequest(Logged):
         self.StagedReplicas = set()
         #return r.json()
 
+    def cancel(self, paths):
+        # cancels some of the files in the request, the files are removed from the request only if the cancel succeeds
+        assert self.URL is not None
+        paths = set(paths)
+        headers = { "accept" : "application/json",
+                    "content-type" : "application/json"}
+        if self.Mode == "dcache":
+            # dCache bulk requests API: PATCH the request with the cancel action
+            r = requests.patch(self.URL, data = json.dumps({"action": "cancel", "paths": list(paths)}), headers=headers,
+                    verify=False, cert = self.CertTuple)
+        else:
+            # WLCG tape REST API
+            r = requests.post(self.URL + "/cancel", data = json.dumps({"paths": list(paths)}), headers=headers,
+                    verify=False, cert = self.CertTuple)
+        if r.status_code // 100 != 2:
+            self.Error = f"HTTP status: {r.status_code} {r.text}"
+            return "ERROR"
+        self.Paths -= paths
+        self.StagedReplicas -= paths
+        self.InProgress -= paths
+        self.debug("cancel: my URL:", self.URL, "   cancelled:", len(paths), "files")
+
     def status(self):
         return self.query()["status"]
 
@@ -228,23 +445,34 @@ class PinRequest(Logged):
 
 class DCachePinner(PyThread, Logged):
 
+    # Keeps a set of pin requests covering the files of all the projects pinned at the RSE, each request for at most
+    # max_request_size files. When the set of files changes, new requests are sent only for the new files and the files no
+    # longer needed are cancelled in the existing requests. Requests about to expire are replaced.
+    # The requests are stored in the database and adopted when the daemon restarts.
+
     InitialSleepInterval = 60
     UpdateInterval = 60         # replica availability update interval
+    PinRequestClass = PinRequest
+    GoneStatusCodes = (404, 410)    # query statuses meaning the tape system does not know the request
+    MergeFraction = 0.25            # requests shrunk by cancels below MergeFraction * max_request_size are merged
 
-    def __init__(self, rse, db, url, prefix, ssl_config, poller):
-        PyThread.__init__(self, name=f"DCachePinner({rse})")
-        Logged.__init__(self, name=f"DCachePinner({rse})")
+    def __init__(self, rse, db, url, prefix, ssl_config, poller, max_request_size=10000):
+        PyThread.__init__(self, name=f"{self.__class__.__name__}({rse})")
+        Logged.__init__(self, name=f"{self.__class__.__name__}({rse})")
         self.URL = url
         self.debug("url:", self.URL)
         self.RSE = rse
         self.Prefix = prefix
         self.SSLConfig = ssl_config
         self.FilesPerProject = {}        # {project_id -> {did: path, ...}}
-        self.PinRequest = None
+        self.PinRequests = []
+        self.Records = {}               # {pin request URL -> DBPinRequest}
+        self.MaxRequestSize = max_request_size
         self.DB = db
         self.Poller = poller
         self.Stop = False
-        self.StagedReplicas = []
+        self.Progress = {}              # {pin request URL -> (number of staged files, set of paths in progress)} as of the last query
+        self.Shrunk = set()             # URLs of the pin requests which lost files because of cancels
 
     @synchronized
     def pin_project(self, project_id, replicas):
@@ -256,7 +484,171 @@ class DCachePinner(PyThread, Logged):
         self.log(f"unpin_project({project_id})")
         self.FilesPerProject.pop(project_id, None)
 
+    def pinned_paths(self):
+        paths = set()
+        for pin_request in self.PinRequests:
+            paths |= pin_request.Paths
+        return paths
+
+    def save_request(self, pin_request):
+        # creates or updates the database record of the pin request
+        try:
+            record = self.Records.get(pin_request.URL)
+            if record is None:
+                self.Records[pin_request.URL] = DBPinRequest.create(self.DB, self.RSE, pin_request.URL, pin_request.Paths,
+                    expiration=pin_request.Expiration, staged=pin_request.StagedReplicas)
+            elif record.Paths != pin_request.Paths or record.Staged != pin_request.StagedReplicas:
+                record.Paths = set(pin_request.Paths)
+                record.Staged = set(pin_request.StagedReplicas)
+                record.save()
+        except Exception as e:
+            self.error("Exception saving pin request", pin_request.URL, ":", traceback.format_exc())
+
+    def forget_request(self, pin_request):
+        record = self.Records.pop(pin_request.URL, None)
+        if record is not None:
+            try:    record.delete()
+            except Exception as e:
+                self.error("Exception deleting pin request record", pin_request.URL, ":", e)
+
+    def adopt_requests(self):
+        # adopts the pin requests stored in the database, which the tape system still knows about
+        for record in DBPinRequest.list(self.DB, self.RSE):
+            pin_request = self.PinRequestClass(self.RSE, self.URL, self.Prefix, self.SSLConfig, record.Paths)
+            pin_request.URL = record.URL
+            pin_request.Expiration = record.Expiration.timestamp() if record.Expiration is not None else None
+            pin_request.StagedReplicas = set(record.Staged)
+            try:
+                status = pin_request.query()
+            except Exception as e:
+                # the tape system may be temporarily unavailable, keep the request and try it again later
+                self.error("Exception querying stored pin request", record.URL, ":", e, "  -- adopting anyway")
+                status = None
+            if status == "ERROR":
+                if pin_request.StatusCode in self.GoneStatusCodes:
+                    self.log("stored pin request is not known to the tape system, forgetting it:", record.URL)
+                    try:    record.delete()
+                    except Exception as e:
+                        self.error("Exception deleting pin request record", record.URL, ":", e)
+                    continue
+                # any other error, e.g. 5xx, may be temporary
+                self.error("Error querying stored pin request", record.URL, ": HTTP status:", pin_request.StatusCode, "  -- adopting anyway")
+                status = None
+            self.PinRequests.append(pin_request)
+            self.Records[pin_request.URL] = record
+            if status is not None:
+                self.Progress[pin_request.URL] = (len(pin_request.StagedReplicas), pin_request.in_progress())
+            self.log(f"adopted pin request for {len(pin_request)} files, staged: {len(pin_request.StagedReplicas)}. URL:", record.URL)
+
+    def delete_request(self, pin_request, reason):
+        self.log(f"deleting pin request for {len(pin_request)} files ({reason}). URL:", pin_request.URL)
+        try:    pin_request.delete()
+        except Exception as e:
+            self.error("Exception deleting pin request:", e, "   -- ignoring, the pin request will expire")
+        self.PinRequests.remove(pin_request)
+        self.Progress.pop(pin_request.URL, None)
+        self.Shrunk.discard(pin_request.URL)
+        self.forget_request(pin_request)
+
+    def update_requests(self, all_paths):
+        # brings the set of pin requests in sync with the set of paths to pin, returns True if any new requests were sent
+        created = []                # requests sent in this cycle
+        for pin_request in self.PinRequests[:]:
+            unneeded = pin_request.Paths - all_paths
+            if unneeded == pin_request.Paths:
+                self.delete_request(pin_request, "files no longer needed")
+            elif pin_request.will_expire(self.UpdateInterval*3):
+                # the old request keeps the files pinned until the replacement is sent
+                replacement = self.send_request(sorted(pin_request.Paths - unneeded))
+                if replacement is None:
+                    self.error("failed to replace pin request about to expire", pin_request.URL, "  -- will retry")
+                    continue
+                created.append(replacement)
+                self.delete_request(pin_request, "about to expire, replaced")
+            elif unneeded:
+                self.log(f"cancelling {len(unneeded)} files no longer needed in pin request", pin_request.URL)
+                try:
+                    if pin_request.cancel(unneeded) == "ERROR":
+                        self.error(f"error cancelling {len(unneeded)} files in pin request", pin_request.URL, ":", pin_request.Error,
+                            "  -- will retry")
+                except Exception as e:
+                    self.error("Exception cancelling files in pin request:", e, "  -- will retry")
+                if not (pin_request.Paths & unneeded):
+                    self.Shrunk.add(pin_request.URL)
+                self.save_request(pin_request)
+
+        created += self.merge_requests(exclude=created)
+
+        new_paths = sorted(all_paths - self.pinned_paths())
+        for i in range(0, len(new_paths), self.MaxRequestSize):
+            pin_request = self.send_request(new_paths[i:i+self.MaxRequestSize])
+            if pin_request is None:
+                break
+            created.append(pin_request)
+        return bool(created)
+
+    def send_request(self, paths):
+        # returns the new pin request or None on failure
+        self.debug("sending pin request for", len(paths), "replicas...")
+        pin_request = self.PinRequestClass(self.RSE, self.URL, self.Prefix, self.SSLConfig, paths)
+        try:
+            sent = pin_request.send()
+        except Exception as e:
+            self.error("exception sending pin request: " + traceback.format_exc())
+            self.log("Failed to create pin request because of exception:", e)
+            return None
+        if not sent:
+            self.log("error sending pin request:", pin_request.Error)
+            self.error("error sending pin request:", pin_request.Error)
+            return None
+        self.PinRequests.append(pin_request)
+        self.save_request(pin_request)
+        self.log("pin request created for %d files. URL:%s" % (len(paths), pin_request.URL))
+        return pin_request
+
+    def merge_requests(self, exclude=[]):
+        # replaces groups of requests, which were shrunk by cancels below the merge threshold, with one request each,
+        # so that the number of requests to query does not keep growing. A group is merged only if the merged request
+        # is above the threshold, so that the merged request is not merged again in the next cycle.
+        # The requests in exclude, e.g. sent in the current cycle, are not merged.
+        # The new request is sent before the old ones are deleted
+        # returns list of new requests
+        threshold = self.MaxRequestSize * self.MergeFraction
+        exclude = set(r.URL for r in exclude)
+        small = sorted((r for r in self.PinRequests 
+                            if r.URL in self.Shrunk and r.URL not in exclude and len(r) < threshold), 
+                        key=len)
+        groups = []
+        group, group_size = [], 0
+        for pin_request in small:
+            if group and group_size + len(pin_request) > self.MaxRequestSize:
+                groups.append(group)
+                group, group_size = [], 0
+            group.append(pin_request)
+            group_size += len(pin_request)
+        groups.append(group)
+        created = []
+        for group in groups:
+            paths = set()
+            for pin_request in group:
+                paths |= pin_request.Paths
+            if len(group) < 2 or len(paths) < threshold:
+                continue
+            self.log(f"merging {len(group)} pin requests with {len(paths)} files")
+            merged = self.send_request(sorted(paths))
+            if merged is None:
+                break
+            created.append(merged)
+            for pin_request in group:
+                self.delete_request(pin_request, "merged")
+        return created
+
     def run(self):
+        try:
+            with self:
+                self.adopt_requests()
+        except Exception as e:
+            self.error("exception adopting stored pin requests:\n", traceback.format_exc())
         time.sleep(self.InitialSleepInterval)          # initial sleep so pprojects have a chance to send their pin requests
         self.debug("run...")
         while not self.Stop:
@@ -267,59 +659,46 @@ class DCachePinner(PyThread, Logged):
                     for project_files in self.FilesPerProject.values():
                         all_files.update(project_files)
                     all_paths = set(all_files.values())
-                    
-                    self.debug("existing pin request:", None if self.PinRequest is None else self.PinRequest.URL)
-                    
-                    if self.PinRequest is not None:
-                        if not self.PinRequest.same_files(all_paths):
-                            self.log("file set changed -- deleting pin request")
-                            self.debug("file set changed -- deleting pin request")
-                            # debug
-                            for path in sorted(all_paths - self.PinRequest.Paths):
-                                self.debug(" +", path)
-                            for path in sorted(self.PinRequest.Paths - all_paths):
-                                self.debug(" -", path)
-                            self.PinRequest.delete()
-                            self.PinRequest = None
-                        elif self.PinRequest.will_expire(self.UpdateInterval*3):
-                            self.debug("pin request is about to expire -- deleting pin request")
-                            self.log("pin request is about to expire -- deleting pin request")
-                            try:    self.PinRequest.delete()
-                            except Exception as e:
-                                self.error("Exception deleting pin request:", e, "   -- ignoring, the pin request will expire")
-                                self.debug("Exception deleting pin request:", e, "   -- ignoring, the pin request will expire")
-                            self.PinRequest = None
-                    if all_files:       # anything to pin ??
-                        if self.PinRequest is None:
-                            self.debug("sending pin request for", len(all_paths), "replicas...")
-                            pin_request = PinRequest(self.RSE, self.URL, self.Prefix, self.SSLConfig, all_paths)
-                            try:
-                                created = pin_request.send()
-                            except Exception as e:
-                                self.error("exception sending pin request: " + traceback.format_exc())
-                                self.log("Failed to create pin request because of exception:", e)
-                            else:
-                                if created:
-                                    self.PinRequest = pin_request
-                                    self.debug("pin request created for %d files. URL:%s" % (len(all_paths), self.PinRequest.URL))
-                                    self.log("pin request created for %d files. URL:%s" % (len(all_paths), self.PinRequest.URL))
-                                    next_run = 5            # check request status kinda soon
-                                else:
-                                    self.log("error sending pin request:", pin_request.Error)
-                                    self.error("error sending pin request:", pin_request.Error)
+
+                    if self.update_requests(all_paths):
+                        next_run = 5            # check new requests status kinda soon
+
+                    staged_paths = set()
+                    reset_paths = set()             # pending paths of the requests which made progress
+                    expedite_paths = set()          # paths which started staging since the last query
+                    for pin_request in self.PinRequests:
+                        try:
+                            staged = pin_request.update_staged_set()
+                            in_progress = pin_request.in_progress()
+                        except Exception as e:
+                            self.error("exception querying pin request", pin_request.URL, ":", e)
+                            continue
+                        staged_paths |= staged
+                        previous = self.Progress.get(pin_request.URL)
+                        if previous is None:
+                            # first query of a new request: the in progress set is the baseline
+                            if staged:
+                                reset_paths |= pin_request.Paths - staged
                         else:
-                            staged_paths = self.PinRequest.update_staged_set()
-                            staged_dids = [did for did, path in all_files.items() if path in staged_paths]
-                            pending_dids_paths = [(did, path) for did, path in all_files.items() if path not in staged_paths]
-                            self.log("files staged:", len(staged_dids), "    still pending:", len(pending_dids_paths))
-                            if staged_dids:
-                                DBReplica.update_availability_bulk(self.DB, True, self.RSE, staged_dids)
-                            if pending_dids_paths:
-                                self.debug("sending", len(pending_dids_paths), "dids/paths to poller")
-                                self.Poller.submit(pending_dids_paths)
-                    else:
-                        #self.debug("no files to pin")
-                        pass
+                            staged_count, was_in_progress = previous
+                            if len(staged) > staged_count:
+                                reset_paths |= pin_request.Paths - staged
+                            expedite_paths |= in_progress - was_in_progress
+                        self.Progress[pin_request.URL] = (len(staged), in_progress)
+                        self.save_request(pin_request)
+                    staged_dids = [did for did, path in all_files.items() if path in staged_paths]
+                    pending_dids_paths = [(did, path) for did, path in all_files.items() if path not in staged_paths]
+                    if all_files:
+                        self.log(f"pin requests: {len(self.PinRequests)}, files staged:", len(staged_dids), "    still pending:", len(pending_dids_paths))
+                    if staged_dids:
+                        DBReplica.update_availability_bulk(self.DB, True, self.RSE, staged_dids)
+                    self.debug("sending", len(pending_dids_paths), "dids/paths to poller")
+                    self.Poller.update(pending_dids_paths)
+                    if reset_paths:
+                        # restart the poll backoff for the files of the requests which made progress
+                        self.Poller.reset(did for did, path in pending_dids_paths if path in reset_paths)
+                    if expedite_paths:
+                        self.Poller.expedite(did for did, path in pending_dids_paths if path in expedite_paths)
             except Exception as e:
                 self.error("exception in run:\n", traceback.format_exc())
             time.sleep(next_run)       
@@ -329,8 +708,10 @@ class DCacheInterface(Primitive, Logged):
     def __init__(self, rse, db, rse_config):
         Primitive.__init__(self, name=f"DCacheInterface({rse})")
         Logged.__init__(self, name=f"DCacheInterface({rse})")
-        self.Poller = DCachePoller(rse, db, rse_config.poll_url(rse), rse_config.max_burst(rse), rse_config.ssl_config(rse))
-        self.Pinner = DCachePinner(rse, db, rse_config.pin_url(rse), rse_config.pin_prefix(rse), rse_config.ssl_config(rse), self.Poller)
+        self.Poller = DCachePoller(rse, db, rse_config.poll_url(rse), rse_config.max_burst(rse), rse_config.ssl_config(rse),
+                        workers=rse_config.poll_workers(rse))
+        self.Pinner = DCachePinner(rse, db, rse_config.pin_url(rse), rse_config.pin_prefix(rse), rse_config.ssl_config(rse), self.Poller,
+                        max_request_size=rse_config.max_pin_request(rse))
         self.Poller.start()
         self.Pinner.start()
 
@@ -0,0 +1,85 @@
+import time, threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_dispatcher.logs import Logged
+
+class RucioReplicaClient(Logged):
+    #
+    # Thread-safe wrapper around Rucio ReplicaClient.
+    # Each thread uses its own client object. Client creation (authentication) and re-creation after an authentication
+    # error, which is how the token is refreshed, are serialized with a separate lock, so the token file is not written
+    # concurrently and the queries do not have to be serialized.
+    # list_replicas() runs the chunk queries in a bounded thread pool and adjusts the chunk size so that each query
+    # takes about ChunkTime seconds.
+    #
+
+    ChunkTime = 5.0             # target time for one list_replicas call, seconds
+    MinChunkSize = 10
+    MaxChunkSize = 1000
+
+    def __init__(self, client_factory=None, max_workers=5, chunk_size=100):
+        Logged.__init__(self, "RucioReplicaClient")
+        if client_factory is None:
+            from rucio.client.replicaclient import ReplicaClient
+            client_factory = ReplicaClient
+        self.ClientFactory = client_factory
+        self.MaxWorkers = max_workers
+        self.ChunkSize = chunk_size
+        self.Local = threading.local()
+        self.TokenLock = threading.Lock()
+        self.ChunkSizeLock = threading.Lock()
+        self.Executor = ThreadPoolExecutor(max_workers, thread_name_prefix="RucioReplicaClient")
+
+    def client(self, renew=False):
+        client = getattr(self.Local, "client", None)
+        if client is None or renew:
+            with self.TokenLock:
+                client = self.Local.client = self.ClientFactory()
+        return client
+
+    @staticmethod
+    def is_auth_error(e):
+        # do not import rucio exceptions here to avoid dependency on the rucio version
+        return type(e).__name__ in ("CannotAuthenticate", "NoAuthInformation")
+
+    def list_chunk(self, chunk, **args):
+        # returns (chunk, list of replicas, elapsed time)
+        t0 = time.time()
+        try:
+            replicas = list(self.client().list_replicas(chunk, **args))
+        except Exception as e:
+            if not self.is_auth_error(e):
+                raise
+            self.log("authentication error, renewing the client:", e)
+            replicas = list(self.client(renew=True).list_replicas(chunk, **args))
+        return chunk, replicas, time.time() - t0
+
+    def adjust_chunk_size(self, n, dt):
+        with self.ChunkSizeLock:
+            if n < self.ChunkSize:
+                return              # last partial chunk, not representative
+            if dt > self.ChunkTime:
+                self.ChunkSize = max(self.MinChunkSize, self.ChunkSize // 2)
+            elif dt < self.ChunkTime / 2:
+                self.ChunkSize = min(self.MaxChunkSize, self.ChunkSize * 2)
+
+    def list_replicas(self, dids, **args):
+        # dids: list of {"scope":..., "name":...} dictionaries
+        # yields (chunk of dids, list of replicas found for the chunk) tuples in the order the queries complete
+        dids = list(dids)
+        t0 = time.time()
+        i = 0
+        pending = set()
+        while i < len(dids) or pending:
+            while i < len(dids) and len(pending) < self.MaxWorkers:
+                chunk = dids[i:i+self.ChunkSize]
+                i += len(chunk)
+                pending.add(self.Executor.submit(self.list_chunk, chunk, **args))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk, replicas, dt = future.result()
+                self.adjust_chunk_size(len(chunk), dt)
+                yield chunk, replicas
+        dt = time.time() - t0
+        if dids:
+            self.log("list_replicas: %d dids in %.1f seconds, %.1f dids/s, chunk size: %d" % (
+                len(dids), dt, len(dids)/dt if dt > 0 else 0.0, self.ChunkSize))
@@ -2,7 +2,7 @@ import traceback, requests, time, json, sys
 from data_dispatcher.db import DBReplica
 from pythreader import Primitive, Scheduler, synchronized, PyThread
 from data_dispatcher.logs import Logged
-from dcache import DCachePoller
+from dcache import DCachePoller, DCachePinner
 
 print("wlcg module importing...")
 
@@ -27,7 +27,9 @@ class WLCGPinRequest(Logged):
         self.Complete = False
         self.Expiration = None
         self.Error = None
+        self.StatusCode = None              # HTTP status of the last query
         self.StagedReplicas = set()         # set of paths
+        self.InProgress = set()             # set of paths being staged
         self.debug("created for", len(paths),"replicas")
 
     def __len__(self):
@@ -78,6 +80,7 @@ class WLCGPinRequest(Logged):
         assert self.URL is not None
         headers = { "accept" : "application/json" }
         r = requests.get(self.URL, headers=headers, verify=False, cert = self.CertTuple)
+        self.StatusCode = r.status_code
         #self.debug("status(): response:", r)
         if r.status_code // 100 != 2:
             self.log("query: HTTP status:", r.status_code, " -- ERROR")
@@ -91,12 +94,19 @@ class WLCGPinRequest(Logged):
             item["path"] for item in data["files"]
             if item.get("onDisk") or item.get("state", "").upper() == "COMPLETED"
         )
+        self.InProgress = set(
+            item["path"] for item in data["files"]
+            if item.get("state", "").upper() == "STARTED"
+        )
         self.Complete = data.get("completedAt", time.time() + 1000000) < time.time()
         return data
         
     def staged_replicas(self):
         return self.StagedReplicas
 
+    def in_progress(self):
+        return self.InProgress - self.StagedReplicas
+
     def delete(self):
         assert self.URL is not None
         headers = { "accept" : "application/json" }
@@ -110,6 +120,22 @@ class WLCGPinRequest(Logged):
         self.StagedReplicas = set()
         #return r.json()
 
+    def cancel(self, paths):
+        # cancels some of the files in the request, the files are removed from the request only if the cancel succeeds
+        assert self.URL is not None
+        paths = set(paths)
+        headers = { "accept" : "application/json",
+                    "content-type" : "application/json"}
+        r = requests.post(self.URL + "/cancel", data = json.dumps({"paths": list(paths)}), headers=headers, 
+                    verify=False, cert = self.CertTuple)
+        if r.status_code // 100 != 2:
+            self.Error = f"HTTP status: {r.status_code} {r.text}"
+            return "ERROR"
+        self.Paths -= paths
+        self.StagedReplicas -= paths
+        self.InProgress -= paths
+        self.debug("cancel: my URL:", self.URL, "   cancelled:", len(paths), "files")
+
     def status(self):
         return self.query()["status"]
 
@@ -132,104 +158,64 @@ class WLCGPinRequest(Logged):
         same = paths == self.Paths
         return same
 
-class WLCGPinner(PyThread, Logged):
+class WLCGPoller(DCachePoller):
 
-    InitialSleepInterval = 60
-    UpdateInterval = 60         # replica availability update interval
+    # Polls file locality in bulk using the WLCG Tape REST API archiveinfo call, up to ArchiveInfoBatch paths per request.
+    # Requests are sent concurrently by the DCachePoller worker pool. max_burst limits the number of requests per second
 
-    def __init__(self, rse, db, url, prefix, ssl_config, poller):
-        PyThread.__init__(self, name=f"WLCGPinner({rse})")
-        Logged.__init__(self, name=f"WLCGPinner({rse})")
-        self.URL = url
-        self.debug("url:", self.URL)
-        self.RSE = rse
-        self.Prefix = prefix
-        self.SSLConfig = ssl_config
-        self.FilesPerProject = {}        # {project_id -> {did: path, ...}}
-        self.PinRequest = None
-        self.DB = db
-        self.Poller = poller
-        self.Stop = False
-        self.StagedReplicas = []
+    ArchiveInfoBatch = 1000
 
-    @synchronized
-    def pin_project(self, project_id, replicas):
-        # replicas: {did: path}
-        self.log(f"pin_project({project_id}):", len(replicas), "replicas")
-        self.FilesPerProject[project_id] = replicas.copy()
+    def __init__(self, rse, db, endpoint_url, max_burst, ssl_config, workers=10):
+        DCachePoller.__init__(self, rse, db, endpoint_url, max_burst, ssl_config, workers=workers)
+        Logged.__init__(self, f"WLCGPoller({rse})")
+        self.ArchiveInfoURL = endpoint_url + ("/" if not endpoint_url.endswith("/") else "") + "archiveinfo"
 
-    @synchronized
-    def unpin_project(self, project_id):
-        self.log(f"unpin_project({project_id})")
-        self.FilesPerProject.pop(project_id, None)
+    @staticmethod
+    def locality_status(item):
+        # converts one archiveinfo response item into "available"|"unavailable"|"not found"|None
+        error = item.get("error")
+        if error:
+            error = error.lower()
+            return "not found" if ("not exist" in error or "not found" in error) else None
+        locality = item.get("locality", "").upper()
+        if not locality:
+            return None
+        return "available" if "DISK" in locality else "unavailable"
 
-    def run(self):
-        time.sleep(self.InitialSleepInterval)          # initial sleep so pprojects have a chance to send their pin requests
-        self.debug("run...")
-        while not self.Stop:
-            next_run = self.UpdateInterval
-            try:
-                with self:
-                    all_files = {}              # {did -> path} for all projects, combined
-                    for project_files in self.FilesPerProject.values():
-                        all_files.update(project_files)
-                    all_paths = set(all_files.values())
-                    
-                    self.debug("existing pin request:", None if self.PinRequest is None else self.PinRequest.URL)
-                    
-                    if self.PinRequest is not None:
-                        if not self.PinRequest.same_files(all_paths):
-                            self.log("file set changed -- deleting pin request")
-                            self.debug("file set changed -- deleting pin request")
-                            # debug
-                            for path in sorted(all_paths - self.PinRequest.Paths):
-                                self.debug(" +", path)
-                            for path in sorted(self.PinRequest.Paths - all_paths):
-                                self.debug(" -", path)
-                            self.PinRequest.delete()
-                            self.PinRequest = None
-                        elif self.PinRequest.will_expire(self.UpdateInterval*3):
-                            self.debug("pin request is about to expire -- deleting pin request")
-                            self.log("pin request is about to expire -- deleting pin request")
-                            try:    self.PinRequest.delete()
-                            except Exception as e:
-                                self.error("Exception deleting pin request:", e, "   -- ignoring, the pin request will expire")
-                                self.debug("Exception deleting pin request:", e, "   -- ignoring, the pin request will expire")
-                            self.PinRequest = None
-                    if all_files:       # anything to pin ??
-                        if self.PinRequest is None:
-                            self.debug("sending pin request for", len(all_paths), "replicas...")
-                            pin_request = WLCGPinRequest(self.RSE, self.URL, self.Prefix, self.SSLConfig, all_paths)
-                            try:
-                                created = pin_request.send()
-                            except Exception as e:
-                                self.error("exception sending pin request: " + traceback.format_exc())
-                                self.log("Failed to create pin request because of exception:", e)
-                            else:
-                                if created:
-                                    self.PinRequest = pin_request
-                                    self.debug("pin request created for %d files. URL:%s" % (len(all_paths), self.PinRequest.URL))
-                                    self.log("pin request created for %d files. URL:%s" % (len(all_paths), self.PinRequest.URL))
-                                    next_run = 5            # check request status kinda soon
-                                else:
-                                    self.log("error sending pin request:", pin_request.Error)
-                                    self.error("error sending pin request:", pin_request.Error)
-                        else:
-                            staged_paths = self.PinRequest.update_staged_set()
-                            staged_dids = [did for did, path in all_files.items() if path in staged_paths]
-                            pending_dids_paths = [(did, path) for did, path in all_files.items() if path not in staged_paths]
-                            self.log("files staged:", len(staged_dids), "    still pending:", len(pending_dids_paths))
-                            if staged_dids:
-                                DBReplica.update_availability_bulk(self.DB, True, self.RSE, staged_dids)
-                            if pending_dids_paths:
-                                self.debug("sending", len(pending_dids_paths), "dids/paths to poller")
-                                self.Poller.submit(pending_dids_paths)
-                    else:
-                        #self.debug("no files to pin")
-                        pass
-            except Exception as e:
-                self.error("exception in run:\n", traceback.format_exc())
-            time.sleep(next_run)       
+    def archiveinfo(self, chunk):
+        # chunk: list of (did, path)
+        # returns list of (did, status)
+        self.RateLimiter.wait()
+        t0 = time.time()
+        by_path = {}            # {path -> [did, ...]}
+        for did, path in chunk:
+            by_path.setdefault(path, []).append(did)
+        statuses = {}           # {path -> status}
+        error = False
+        try:
+            response = self.session().post(self.ArchiveInfoURL, data=json.dumps({"paths": list(by_path.keys())}))
+            if response.status_code // 100 == 2:
+                for item in response.json():
+                    path = item.get("path")
+                    if path in by_path:
+                        statuses[path] = self.locality_status(item)
+            else:
+                self.debug("archiveinfo: HTTP status:", response.status_code, response.text)
+                error = True
+        except Exception as e:
+            self.debug("error in archiveinfo request:", e)
+            error = True
+        self.Stats.record(time.time() - t0, error=error, files=len(chunk))
+        return [(did, statuses.get(path)) for did, path in chunk]
+
+    def poll_batch(self, batch):
+        chunks = [batch[i:i+self.ArchiveInfoBatch] for i in range(0, len(batch), self.ArchiveInfoBatch)]
+        for results in self.Executor.map(self.archiveinfo, chunks):
+            yield from results
+
+class WLCGPinner(DCachePinner):
+
+    PinRequestClass = WLCGPinRequest
 
 class DCacheInterface(Primitive, Logged):
     
@@ -237,14 +223,14 @@ class DCacheInterface(Primitive, Logged):
         Primitive.__init__(self, name=f"DCacheInterface({rse})")
         Logged.__init__(self, name=f"DCacheInterface({rse})")
         pin_url = rse_config.pin_url(rse)
-        pin_url = "https://fndca1.fnal.gov:3880/.well-known/wlcg-tape-rest-api"
         if "/.well-known/" in pin_url:
-            pin_url = poll_url = self.discover(pin_url)
+            pin_url = self.discover(pin_url)
             self.debug(f"WLCG interface discovered at:", pin_url)
-        else:
-            poll_url = pin_urlrse_config.poll_url(rse)
-        self.Poller = DCachePoller(rse, db, poll_url, rse_config.max_burst(rse), rse_config.ssl_config(rse))
-        self.Pinner = WLCGPinner(rse, db, pin_url, rse_config.pin_prefix(rse), rse_config.ssl_config(rse), self.Poller)
+        poll_url = rse_config.poll_url(rse, pin_url)        # the tape REST endpoint with the archiveinfo call
+        self.Poller = WLCGPoller(rse, db, poll_url, rse_config.max_burst(rse), rse_config.ssl_config(rse),
+                        workers=rse_config.poll_workers(rse))
+        self.Pinner = WLCGPinner(rse, db, pin_url, rse_config.pin_prefix(rse), rse_config.ssl_config(rse), self.Poller,
+                        max_request_size=rse_config.max_pin_request(rse))
         self.Poller.start()
         self.Pinner.start()
         self.log("WLCG DCacheInterface created at:\n    pin URL:", pin_url, "\n    poll URL:", poll_url)
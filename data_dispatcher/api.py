@@ -85,6 +85,35 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
 
         HTTPClient.__init__(self, server_url, token=self.token(), timeout=timeout)
         
+    def get_stream(self, uri_suffix, none_if_not_found=False):
+        # sends GET request asking for a JSON text sequence (application/json-seq) response and
+        # returns an iterator, which parses the items one by one as they are received
+        if not uri_suffix.startswith("/"):  uri_suffix = "/"+uri_suffix
+        url = "%s%s" % (self.ServerURL, uri_suffix)
+        try:
+            headers = self.auth_headers()
+        except AttributeError:
+            headers = {}
+        headers["Accept"] = "application/json-seq"
+        self.LastURL = url
+        response = self.retry_request("get", url, headers=headers, stream=True)
+        if response.status_code != 200:
+            return self.interpret_response(response, none_if_not_found)
+        return self.checked_json_seq(url, self.interpret_json_stream(response))
+
+    @staticmethod
+    def checked_json_seq(url, items):
+        # the server ends the JSON text sequence with {"$end": true}, or with {"$error": "..."} if it failed
+        # after the response status was sent
+        for item in items:
+            if isinstance(item, dict):
+                if item.get("$end") is True:
+                    return
+                if "$error" in item:
+                    raise ServerError(url, 200, "Error in the response stream", item["$error"])
+            yield item
+        raise ServerError(url, 200, "Response stream truncated")
+
     @staticmethod
     def random_worker_id(prefix=""):
         """
@@ -257,7 +286,7 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
         """
         return self.get(f"activate_project?project_id={project_id}")
 
-    def get_project(self, project_id, with_files=True, with_replicas=False):
+    def get_project(self, project_id, with_files=True, with_replicas=False, stream=False):
         """Gets information about the project
         
         Args:
@@ -266,6 +295,8 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
         Keyword Arguments:
             with_files (boolean) : whether to include iformation about project files. Default: True
             with_replicas (boolean) : whether to include iformation about project file replicas. Default: False
+            stream (boolean) : if True, the "file_handles" value will be an iterator, which receives and parses
+                the file handles one by one instead of a list. Use it for large projects. Default: False
     
         Returns:
             (dict) project information or None if project not found.
@@ -283,10 +314,19 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
                 * worker_timeout: numeric or None, worker idle timeout, in seconds
                 * idle_timeout: numeric or None, project inactivity timeout in seconds
         """
+        with_handles = with_files or with_replicas
         with_files = "yes" if with_files else "no"
         with_replicas = "yes" if with_replicas else "no"
         uri = f"project?project_id={project_id}&with_files={with_files}&with_replicas={with_replicas}"
-        return self.get(uri, none_if_not_found=True)
+        if not stream:
+            return self.get(uri, none_if_not_found=True)
+        items = self.get_stream(uri + "&format=json-seq", none_if_not_found=True)
+        if items is None:
+            return None
+        project_info = next(items)
+        if with_handles:
+            project_info["file_handles"] = items
+        return project_info
 
     def get_handle(self, project_id, namespace, name):
         """Gets information about a file handle
@@ -358,15 +398,21 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
         if owner:   info["owner"] = owner
         return self.post("search_projects", json.dumps(info))
 
-    def __next_file(self, project_id, cpu_site, worker_id):
+    LongPollWait = 30           # seconds for the server to hold next_file request waiting for a file to become available
+
+    def __next_file(self, project_id, cpu_site, worker_id, count=None, wait=None):
         if worker_id is None:
             raise ValueError("DataDispatcherClient must be initialized with Worker ID")
         url_tail = f"next_file?project_id={project_id}&worker_id={worker_id}"
         if cpu_site:
             url_tail += f"&cpu_site={cpu_site}"
+        if count is not None:
+            url_tail += f"&count={count}"
+        if wait is not None:
+            url_tail += f"&wait={wait:.1f}"
         return self.get(url_tail)
 
-    def next_file(self, project_id, cpu_site=None, worker_id=None, timeout=None, stagger=10):
+    def next_file(self, project_id, cpu_site=None, worker_id=None, timeout=None, stagger=10, count=None):
         """Reserves next available file from the project
 
         Args:
@@ -374,10 +420,15 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
             cpu_site (str): optional, if specified, the file will be reserved according to the CPU/RSE proximity map
             timeout (int or float): optional, if specified, time to wait for a file to become available. Otherwise, will wait indefinitely
             stagger (int or float): optional, introduce a random delay between 0 and <stagger> seconds before sending first request. This will help mitigate the effect of synchronous stard of multiple workers. Default: 10
+            count (int): optional, if specified, reserve up to <count> files in one request. The server may limit the number of files reserved at once.
+
+        If the server supports it, the request is held on the server until a file becomes available (long poll),
+        otherwise the client retries the request after a random delay of up to 60 seconds.
 
         Returns:
-            Dictionary or boolean.
+            Dictionary, list or boolean.
             If dictionary, the dictionary contains the reserved file information. "replicas" field will be a dictionary will contain a subdictionary with replicas information indexed by RSE name.
+            If list (``count`` is specified), the list contains one or more dictionaries with reserved files information.
             If ``True``: the request timed out, but can be retried.
             If ``False``: the project has ended.
         """
@@ -388,14 +439,24 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
             time.sleep(stagger * random.random())
         retry = True
         while retry:
-            reply = self.__next_file(project_id, cpu_site, worker_id)
-            info = reply.get("handle")
-            if info:
-                return info         # allocated
+            wait = min(self.LongPollWait, self.Timeout/2)
+            if t1 is not None:
+                wait = max(0.0, min(wait, t1 - time.time()))
+            reply = self.__next_file(project_id, cpu_site, worker_id, count, wait=wait)
+            if count is not None:
+                infos = reply.get("handles")
+                if infos:
+                    return infos    # allocated
+            else:
+                info = reply.get("handle")
+                if info:
+                    return info         # allocated
             reason = reply.get("reason")
             retry = reply["retry"]
             if retry:
                 if t1 is None or time.time() < t1:
+                    if reply.get("long_poll"):
+                        continue        # the server has already waited
                     dt = 60
                     if t1 is not None:
                         dt = min(dt, t1-time.time())
@@ -406,6 +467,32 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
                     break
         return retry            # True=try again later, False=project ended
 
+    def renew_leases(self, project_id, dids=None, worker_id=None):
+        """Extends reservation of the files reserved by the worker, so that they are not released after the project worker timeout.
+        The worker is expected to call this method periodically while processing the files, more frequently than the worker timeout.
+
+        Args:
+            project_id (int): Project id
+            dids (list): optional, list of DIDs (namespace:name) to renew. Default: all files reserved by the worker
+            worker_id (str or None): Worker id. If None, client's worker id will be used
+
+        Returns:
+            dictionary:
+
+            .. code-block:: python
+
+                {
+                    "renewed": [ "namespace:name", ... ],         # DIDs of the files with renewed reservation
+                    "not_renewed": [ "namespace:name", ... ],     # if dids were specified, DIDs not reserved by the worker
+                    "worker_timeout": 3600.0                        # project worker timeout in seconds or None
+                }
+        """
+        worker_id = worker_id or self.WorkerID
+        request = {"project_id": project_id, "worker_id": worker_id}
+        if dids is not None:
+            request["handles"] = list(dids)
+        return self.post("renew_leases", json.dumps(request))
+
     def reserved_handles(self, project_id, worker_id=None):
         """Returns list of file handles reserved in the project by given worker
         
@@ -417,10 +504,11 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
             list of dictionaries with the file handle information
         """
         worker_id = worker_id or self.WorkerID
-        project = self.get_project(project_id)
-        return [h for h in project["file_handles"]
-            if h["state"] == "reserved" and h["worker_id"] == worker_id
-        ]
+        uri = f"reserved_handles?project_id={project_id}&worker_id={urllib.parse.quote(worker_id)}"
+        handles = self.get(uri, none_if_not_found=True)
+        if handles is None:
+            raise NotFoundError(uri, "Project not found")
+        return handles
 
     def list_rses(self):
         """Return information about all RSEs
@@ -480,6 +568,41 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
         retry = "yes" if retry else "no"
         return self.get(f"release?handle_id={handle_id}&failed=yes&retry={retry}")
 
+    def release_files(self, project_id, dids, failed=False, retry=True):
+        """Releases multiple reserved files in one request.
+
+        Args:
+            project_id (int): project id
+            dids (list): list of file DIDs ("<namespace>:<name>") or dictionaries with keys "did", and optional "failed" and "retry",
+                to override the ``failed`` and ``retry`` values for individual files
+
+        Keyword Arguments:
+            failed (boolean): default=False, mark the files as failed. Otherwise, mark them as done
+            retry (boolean): default=True, for failed files, whether the files should be retried
+
+        Returns:
+            (dict) with two items:
+                * released: list of dictionaries with information about released file handles
+                * not_released: list of DIDs of files which were not found or were not reserved
+        """
+        handles = []
+        for item in dids:
+            if isinstance(item, dict):
+                handles.append({
+                    "did":      item["did"],
+                    "failed":   item.get("failed", failed),
+                    "retry":    item.get("retry", retry)
+                })
+            else:
+                handles.append({"did": item, "failed": failed, "retry": retry})
+        return self.post("release_handles", json.dumps(
+                {
+                    "project_id":   project_id,
+                    "handles":      handles
+                }
+            )
+        )
+
     #
     # Deprecated, undocumented, unsupported
     #
@@ -489,16 +612,54 @@ class DataDispatcherClient(HTTPClient, TokenAuthClientMixin):
         """
         return self.get(f"file?namespace={namespace}&name={name}", none_if_not_found=True)
 
-    def list_handles(self, project_id, state=None, not_state=None, with_replicas=False):
+    def list_handles(self, project_id, state=None, not_state=None, with_replicas=False, stream=False):
         """Deprecated
+
+        Keyword Arguments:
+            stream (boolean) : if True, returns an iterator, which receives and parses the file handles one by one
         """
         args = []
         if project_id: args.append(f"project_id={project_id}")
         if state: args.append(f"state={state}")
         if not_state: args.append(f"not_state={not_state}")
+        if stream:
+            args.append("format=json-seq")
+            return self.get_stream("handles?" + "&".join(args))
         args = "?" + "&".join(args) if args else ""
         return self.get(f"handles{args}")
         
+    def iterate_handles(self, project_id, state=None, not_state=None, with_replicas=False, page_size=1000):
+        """Iterates over project file handles, requesting them from the server page by page
+        
+        Args:
+            project_id (int): project id
+
+        Keyword Arguments:
+            state (str): include only handles in this state. Default: all states
+            not_state (str): exclude handles in this state. Default: do not exclude
+            with_replicas (boolean): include information about replicas. Default: False
+            page_size (int): number of handles to request at once. Default: 1000
+    
+        Returns:
+            iterator of dictionaries with file handle information, ordered by namespace and name
+        """
+        args = [f"project_id={project_id}", f"limit={page_size}"]
+        if state: args.append(f"state={state}")
+        if not_state: args.append(f"not_state={not_state}")
+        if with_replicas: args.append("with_replicas=yes")
+        args = "&".join(args)
+        after = None
+        while True:
+            uri = f"handles?{args}"
+            if after is not None:
+                uri += "&after=" + urllib.parse.quote(after)
+            page = self.get(uri)
+            yield from page
+            if len(page) < page_size:
+                break
+            last = page[-1]
+            after = last["namespace"] + ":" + last["name"]
+
     def replica_available(self, namespace, name, rse, path=None, preference=0, url=None):
         data = {
             "path": path,
@@ -1,4 +1,4 @@
-import json, time, io, traceback, urllib.parse
+import json, time, io, traceback, urllib.parse, uuid
 from datetime import datetime, timedelta, timezone
 from metacat.auth import BaseDBUser as DBUser, BaseDBRole as DBRole
 
@@ -8,6 +8,55 @@ def cursor_iterator(c):
         yield t
         t = c.fetchone()
 
+ServerCursorItersize = 1000         # default number of rows fetched from a server side cursor at once
+
+class ServerCursor(object):
+    # Named (server side) cursor, which fetches the results in batches of itersize rows instead of buffering the whole
+    # result in the client memory. The cursor lives in a read transaction, which is ended when the cursor is closed.
+    # If db is a connection pool, the cursor gets a dedicated connection from the pool and returns it when closed, so
+    # that no other code can commit or roll back on it while the results are consumed. If db is a connection,
+    # it must not be in a transaction and must not be used by anything else until the cursor is closed.
+    # The generators using the cursor close it in a "finally" clause, so an abandoned generator releases it too.
+
+    def __init__(self, db, itersize=None):
+        import psycopg2.extensions
+        if hasattr(db, "connect"):
+            self.Connection = db.connect()
+            self.Dedicated = True
+        else:
+            if db.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                raise RuntimeError("Server side cursor can not be used in a connection with an open transaction")
+            self.Connection = db
+            self.Dedicated = False
+        self.Autocommit = self.Connection.autocommit
+        if self.Autocommit:
+            self.Connection.set_session(autocommit=False)        # named cursors require a transaction
+        self.Cursor = self.Connection.cursor(name="data_dispatcher_" + uuid.uuid4().hex)
+        self.Cursor.itersize = itersize or ServerCursorItersize
+
+    def execute(self, sql, params=None):
+        self.Cursor.execute(sql, params)
+
+    def __iter__(self):
+        return iter(self.Cursor)
+
+    def close(self):
+        if self.Cursor is None:
+            return
+        try:
+            self.Cursor.close()
+            self.Connection.rollback()              # read only transaction
+            if self.Autocommit:
+                self.Connection.set_session(autocommit=True)
+        finally:
+            self.Cursor = None
+            if self.Dedicated:
+                self.Connection.close()
+            self.Connection = None
+
+def server_cursor(db, itersize=None):
+    return ServerCursor(db, itersize)
+
 def json_literal(v):
     if isinstance(v, str):       v = '"%s"' % (v.replace("'", "''"),)
     elif isinstance(v, bool):    v = "true" if v else "false"
@@ -19,6 +68,18 @@ def to_timedelta(t):
     if isinstance(t, (int, float)):
         t = timedelta(seconds=t)
     return t
+
+def split_dids(dids):
+    # dids: list of "namespace:name" or (namespace, name)
+    # returns 2 parallel lists: namespaces, names, to be joined with unnest(%s::text[], %s::text[])
+    namespaces, names = [], []
+    for did in dids:
+        if isinstance(did, str):
+            did = did.split(":", 1)
+        namespace, name = did
+        namespaces.append(namespace)
+        names.append(name)
+    return namespaces, names
     
 class HasDB(object):
     
@@ -242,42 +303,67 @@ class HasLogRecord(object):
     #
     #   LogTable        - name of the table to store the log
     #   LogIDColumns    - list of columns in the log table identifying the parent
+    #   LogByFileID     - if True, LogIDColumns include "namespace" and "name" and the log table is keyed by
+    #                     the file_id column instead. The namespace and the name are stored for information
     #
 
     LogIDColumns = None
     LogTable = None
+    LogByFileID = False
+
+    @classmethod
+    def log_conditions(cls, selection):
+        # selection: {column -> value}
+        # returns list of SQL conditions and list of their parameters. For the logs keyed by the file_id,
+        # (namespace, name) is translated to the file_id
+        selection = selection.copy()
+        wheres, params = [], []
+        if cls.LogByFileID and "namespace" in selection and "name" in selection:
+            wheres.append(f"file_id = (select id from {DBFile.Table} where namespace = %s and name = %s)")
+            params += [selection.pop("namespace"), selection.pop("name")]
+        for name, value in selection.items():
+            wheres.append(f"{name} = %s")
+            params.append(value)
+        return wheres, params
 
     @transactioned
     def add_log(self, type, data=None, transaction=None, **kwargs):
+        # plain insert, so that it is committed or rolled back together with the caller's transaction
         #print("add_log:", type, data, kwargs)
         data = (data or {}).copy()
         data.update(kwargs)
         parent_pk_columns = ",".join(self.LogIDColumns)
-        parent_pk_values = ",".join([f"'{v}'" for v in self.pk()])
+        parent_pk_values = ",".join(["%s"] * len(self.LogIDColumns))
+        params = tuple(self.pk())
+        if self.LogByFileID:
+            parent_pk_columns += ",file_id"
+            parent_pk_values += f",(select id from {DBFile.Table} where namespace = %s and name = %s)"
+            params += (self.Namespace, self.Name)
         transaction.execute(f"""
-            begin;
             insert into {self.LogTable}({parent_pk_columns}, type, data)
-                values({parent_pk_values}, %s, %s);
-            commit
-        """, (type, json.dumps(data)))
+                values({parent_pk_values}, %s, %s)
+        """, params + (type, json.dumps(data)))
         
     @classmethod
-    def log_records(cls, db, **selection):
-        c = db.cursor()
+    def log_records(cls, db, itersize=None, **selection):
+        c = server_cursor(db, itersize)
         columns = ",".join(["type", "t", "data"] + cls.LogIDColumns)
         sort_columns = ",".join(cls.LogIDColumns + ["t"])
-        wheres = ["true"] + [f"{name}='{value}'" for name, value in selection.items()]
-        wheres = " and ".join(wheres)
+        wheres, params = cls.log_conditions(selection)
+        wheres = " and ".join(["true"] + wheres)
         c.execute(f"""
             select {columns}
                 from {cls.LogTable}
                 where {wheres}
                 order by {sort_columns}
-        """)
-        for tup in cursor_iterator(c):
-            type, t, data = tup[:3]
-            id_columns = { name:value for name, value in zip(cls.LogIDColumns, tup[3:]) }
-            yield DBLogRecord(type, t, data, id_columns)
+        """, params)
+        try:
+            for tup in c:
+                type, t, data = tup[:3]
+                id_columns = { name:value for name, value in zip(cls.LogIDColumns, tup[3:]) }
+                yield DBLogRecord(type, t, data, id_columns)
+        finally:
+            c.close()
 
     @classmethod
     @transactioned
@@ -293,6 +379,16 @@ class HasLogRecord(object):
                     { data }
                 )
         """
+        columns = cls.LogIDColumns + ["type", "data"]
+        if cls.LogByFileID:
+            i_namespace, i_name = cls.LogIDColumns.index("namespace"), cls.LogIDColumns.index("name")
+            file_ids = DBFile.ids(db, [(id_values[i_namespace], id_values[i_name]) for id_values, _, _ in records], 
+                        transaction=transaction)
+            records = [
+                (tuple(id_values) + (file_ids[(id_values[i_namespace], id_values[i_name])],), type, data)
+                for id_values, type, data in records
+            ]
+            columns = cls.LogIDColumns + ["file_id", "type", "data"]
         csv = []
         for id_values, type, data in records:
             row = '\t'.join([str(v) for v in id_values] + [type, json.dumps(data)])
@@ -301,13 +397,10 @@ class HasLogRecord(object):
             csv = io.StringIO("\n".join(csv))
 
             table = cls.LogTable
-            columns = cls.LogIDColumns + ["type", "data"]
             transaction.copy_from(csv, table, columns=columns)
 
     def get_log(self, type=None, since=None, reversed=False):
-        parent_pk_columns = self.LogIDColumns
-        parent_pk_values = self.pk()
-        wheres = [f"{c} = '{v}'" for c, v in zip(parent_pk_columns, parent_pk_values)]
+        wheres, params = self.log_conditions(dict(zip(self.LogIDColumns, self.pk())))
         if isinstance(since, (float, int)):
             since = datetime.utcfromtimestamp(since).replace(tzinfo=timezone.utc)
             wheres.append(f"t >= {since}")
@@ -321,20 +414,20 @@ class HasLogRecord(object):
                 order by t {desc}
         """
         c = self.DB.cursor()
-        c.execute(sql)
+        c.execute(sql, params)
         return (DBLogRecord(type, t, message) for type, t, message in cursor_iterator(c))
         
     def last_log_record(self, type=None):
-        parent_pk_columns = self.LogIDColumns
         c = self.DB.cursor()
-        pk_wheres = " and ".join([f"({c} = %s)" for c in parent_pk_columns])
+        wheres, params = self.log_conditions(dict(zip(self.LogIDColumns, self.pk())))
+        pk_wheres = " and ".join(wheres)
         c.execute(f"""
             select type, t, data from {self.LogTable}
                 where {pk_wheres}
                     and (%s is null or type = %s)
                 order by t desc
                 limit 1
-        """, tuple(self.pk()) + (type, type)
+        """, tuple(params) + (type, type)
         )
         tup = c.fetchone()
         if tup:
@@ -355,6 +448,13 @@ class DBProject(DBObject, HasLogRecord):
     LogIDColumns = ["project_id"]
     LogTable = "project_log"
     
+    CountsTable = "project_handle_counts"
+    
+    DispatchChannel = "data_dispatcher_dispatch"     # notified with the project id when the project may have
+                                                     # new handles to dispatch or has ended
+    StateChannel = "data_dispatcher_project_state"   # notified with "<project id>:<state>" when a project is created,
+                                                     # its state changes or new files are added
+    
     def __init__(self, db, id, owner=None, created_timestamp=None, end_timestamp=None, state=None, 
                 retry_count=None, attributes={}, query=None, worker_timeout=None, idle_timeout=None):
         self.DB = db
@@ -375,6 +475,11 @@ class DBProject(DBObject, HasLogRecord):
 
     def pk(self):
         return (self.ID,)
+
+    def as_tuple(self):
+        # inverse of from_tuple(), in the Columns order
+        return (self.ID, self.Owner, self.CreatedTimestamp, self.EndTimestamp, self.State, self.RetryCount,
+                self.Attributes, self.Query, self.WorkerTimeout, self.IdleTimeout)
         
     def quoted_query(self):
         query = self.Query
@@ -431,6 +536,7 @@ class DBProject(DBObject, HasLogRecord):
                         to_timedelta(worker_timeout), to_timedelta(idle_timeout))
             )
             id = c.fetchone()[0]
+            c.execute("select pg_notify(%s, %s)", (DBProject.StateChannel, f"{id}:{DBProject.InitialState}"))
             db.commit()
         except:
             db.rollback()
@@ -458,6 +564,7 @@ class DBProject(DBObject, HasLogRecord):
                     to_timedelta(worker_timeout), to_timedelta(idle_timeout))
         )
         id = transaction.fetchone()[0]
+        DBProject.notify_state(db, [(id, DBProject.InitialState)], transaction=transaction)
 
         project = DBProject.get(db, id)
         
@@ -513,53 +620,16 @@ class DBProject(DBObject, HasLogRecord):
         table = DBProject.Table
         columns = DBProject.columns("p", as_text=True)
         if with_handle_counts:
-            h_table = DBFileHandle.Table
-            rse_table = DBRSE.Table
-            rep_table = DBReplica.Table
-
             #
-            # Get active replicas counts per project
+            # HandleCounts are the raw handle states counts: "initial", "reserved", "done", "failed"
             #
-            
-            available_by_project = {}
+            counts_table = DBProject.CountsTable
             c.execute(f"""
-                with 
-                    found_files as  
-                    (
-                        select distinct r.namespace, r.name, true as found
-                            from {rep_table} r
-                    ),
-                    available_files as 
-                    (
-                        select distinct r.namespace, r.name, true as available
-                            from {rep_table} r, {rse_table} s
-                            where r.available and r.rse = s.name and s.is_available
-                    ),
-                    handle_states as
-                    (
-                        select h.project_id, h.namespace, h.name, 
-                                case
-                                    when h.state = 'initial' then (
-                                        case
-                                            when af.available = true then 'available'
-                                            when ff.found = true then 'found'
-                                            else 'not found'
-                                        end
-                                    )
-                                    else h.state
-                                end as state
-                            from {table} p, {h_table} h
-                                left outer join found_files ff on ff.namespace = h.namespace and ff.name = h.name
-                                left outer join available_files af on af.namespace = h.namespace and af.name = h.name
-                            where p.id = h.project_id
-                    )
-                    
-                select {columns}, hs.state, count(*)
-                    from handle_states hs, projects p
-                        where p.id = hs.project_id
-                        and {p_wheres}
-                    group by p.id, hs.state
-                    order by p.id, hs.state
+                select {columns}, hc.state, hc.count
+                    from {table} p
+                        left outer join {counts_table} hc on (hc.project_id = p.id and hc.count > 0)
+                    where {p_wheres}
+                    order by p.id, hc.state
             """, {"state":state, "not_state":not_state, "owner":owner})
 
             p = None
@@ -573,7 +643,8 @@ class DBProject(DBObject, HasLogRecord):
                     p = p1
                     p.HandleCounts = {}
                 #print(p.ID, h_state, count)
-                p.HandleCounts[h_state] = count
+                if h_state is not None:
+                    p.HandleCounts[h_state] = count
             if p is not None:
                 yield p
         else:
@@ -604,6 +675,7 @@ class DBProject(DBObject, HasLogRecord):
             update projects set state=%s, end_timestamp=%s
                 where id=%s
         """, (self.State, self.EndTimestamp, self.ID))
+        DBProject.notify_state(self.DB, [(self.ID, self.State)], transaction=transaction)
 
     @transactioned
     def cancel(self, transaction=None):
@@ -612,6 +684,7 @@ class DBProject(DBObject, HasLogRecord):
             self.EndTimestamp = datetime.now(timezone.utc)
             self.save(transaction=transaction)
             self.add_log("state", event="cancel", state="cancelled", transaction=transaction)
+            DBProject.notify_dispatch(self.DB, [self.ID], transaction=transaction)
 
     @transactioned
     def activate(self, transaction=None):
@@ -619,22 +692,54 @@ class DBProject(DBObject, HasLogRecord):
             self.State = "active"
             self.save(transaction=transaction)
             self.add_log("state", event="activate", state="active", transaction=transaction)
+            # replicas of inactive projects' files are not maintained
+            DBFileHandle.refresh_dispatchable(self.DB, project_id=self.ID, transaction=transaction)
+            DBProject.notify_dispatch(self.DB, [self.ID], transaction=transaction)
 
     @transactioned
     def restart_handles(self, states=None, dids=None, transaction=None):
-        if states:
-            states = set(states)
-        if dids:
-            dids = set(dids)
-        handles_reset = []
-        for h in self.handles(reload=True):
-            if dids and h.did() in dids or \
-                    states and h.State in states:
-                h.reset()
-                handles_reset.append(dict(did=h.did()))
+        # resets the handles in one of the states or with one of the DIDs to the initial state
+        # dids: list of "namespace:name"
+        h_table = DBFileHandle.Table
+        namespaces, names = split_dids(dids or [])
+        transaction.execute(f"""
+            update {h_table} h_new
+                set state = %(initial)s, worker_id = null
+                from {h_table} h_old                    -- to get the state and the worker_id before the update
+                where h_new.project_id = %(project_id)s
+                    and h_new.state != %(initial)s
+                    and (
+                        h_new.state = any(%(states)s::text[])
+                        or h_new.file_id in (
+                            select f.id from {DBFile.Table} f
+                                inner join unnest(%(namespaces)s::text[], %(names)s::text[]) as d(namespace, name)
+                                    using (namespace, name)
+                        )
+                    )
+                    and h_old.project_id = h_new.project_id and h_old.file_id = h_new.file_id
+                returning h_new.namespace, h_new.name, h_old.state, h_old.worker_id
+        """, dict(project_id=self.ID, initial=DBFileHandle.ReadyState, states=list(states or []),
+                namespaces=namespaces, names=names))
+        reset = transaction.fetchall()
+
+        deltas = {}
+        for namespace, name, old_state, worker_id in reset:
+            deltas[(self.ID, old_state)] = deltas.get((self.ID, old_state), 0) - 1
+        if reset:
+            deltas[(self.ID, DBFileHandle.ReadyState)] = len(reset)
+            DBProject.update_handle_counts(self.DB, deltas, transaction=transaction)
+        DBFileHandle.add_log_bulk(self.DB, 
+            [
+                (
+                    (self.ID, namespace, name),
+                    "state",
+                    dict(event="reset", worker=worker_id, state=DBFileHandle.ReadyState, old_state=old_state)
+                )
+                for namespace, name, old_state, worker_id in reset
+            ], transaction=transaction)
 
         log_data = dict(event="restart",
-            handles_reset=handles_reset
+            handles_reset=[dict(did=f"{namespace}:{name}") for namespace, name, _, _ in reset]
         )
         
         if states is not None:
@@ -642,9 +747,14 @@ class DBProject(DBObject, HasLogRecord):
         if dids is not None:
             log_data["dids"] = list(dids)
         
+        counts = self.file_state_counts(transaction=transaction)
+        if self.State != "active":
+            # replicas of inactive projects' files are not maintained
+            DBFileHandle.refresh_dispatchable(self.DB, project_id=self.ID, transaction=transaction)
+        if reset:
+            DBProject.notify_dispatch(self.DB, [self.ID], transaction=transaction)
         if self.State != "active" \
-                and not all(h.State in ("done", "failed") for h in self.handles()):
-            self.State = "active"
+                and counts.get(DBFileHandle.ReadyState, 0) + counts.get(DBFileHandle.ReservedState, 0) > 0:
             log_data["state"] = self.State = "active"
             self.EndTimestamp = None
             self.save(transaction=transaction)
@@ -671,58 +781,145 @@ class DBProject(DBObject, HasLogRecord):
         # files_descs is list of disctionaries: [{"namespace":..., "name":...}, ...]
         files_descs = list(files_descs)     # make sure it's not a generator
         DBFileHandle.create_many(self.DB, self.ID, files_descs)
+        DBProject.notify_state(self.DB, [(self.ID, self.State)])
         
     @transactioned
-    def reserve_handle(self, worker_id, transaction=None):
-        handle = DBFileHandle.reserve_for_worker(self.DB, self.ID, worker_id, transaction=transaction)
-        if handle is not None:
-            return handle, "ok", False
-            
+    def reserve_handles(self, worker_id, count=1, proximities=None, default_proximity=None, transaction=None):
+        # proximities: optional {rse -> proximity} to reserve handles with closer replicas first
+        # returns (list of handles, reason, retry)
+        handles = DBFileHandle.reserve_for_worker(self.DB, self.ID, worker_id, count=count, 
+                        proximities=proximities, default_proximity=default_proximity,
+                        transaction=transaction)
+        if handles:
+            return handles, "ok", False
+
         if not self.is_active(reload=True):
-            return None, "project inactive", False
+            return [], "project inactive", False
         else:
-            return None, "retry", True
+            return [], "retry", True
 
     @transactioned
-    def release_handle(self, namespace, name, failed, retry, transaction=None):
-        handle = self.handle(namespace, name)
-        if handle is None or handle.State != "reserved":
-            return None
+    def reserve_handle(self, worker_id, proximities=None, default_proximity=None, transaction=None):
+        handles, reason, retry = self.reserve_handles(worker_id, 1, 
+                        proximities=proximities, default_proximity=default_proximity, transaction=transaction)
+        return (handles[0] if handles else None), reason, retry
 
-        if failed:
-            handle.failed(retry, transaction=transaction)
-        else:
-            handle.done(transaction=transaction)
-
-        if self.State == "active" and not self.is_active(reload=True):
-            failed_handles = [h.did() for h in self.handles() if h.State == "failed"]
+    @transactioned
+    def release_handle(self, namespace, name, failed, retry, transaction=None):
+        released = self.release_handles([(namespace, name, failed, retry)], transaction=transaction)
+        return released[0] if released else None
 
-            if failed_handles:
-                state = "failed"
-                data = {"failed_handles": failed_handles}
-            else:
-                state = "done"
-                data = {}
+    @transactioned
+    def release_handles(self, releases, transaction=None):
+        # releases: list of tuples (namespace, name, failed, retry)
+        # returns list of released handles. Handles not found or not reserved are ignored
+        released = DBFileHandle.release_bulk(self.DB, self.ID, releases, transaction=transaction)
+        if released:
+            self.check_completion(transaction=transaction)
+        return released
 
+    @transactioned
+    def check_completion(self, transaction=None):
+        # moves the project to "done" or "failed" state if it has no active handles left
+        transaction.execute(f"select state from {self.Table} where id = %s", (self.ID,))
+        tup = transaction.fetchone()
+        if tup is None:
+            return None
+        self.State = tup[0]
+        if self.State != "active":
+            return self.State
+        counts = self.file_state_counts(transaction=transaction)
+        if not counts.get(DBFileHandle.ReadyState) and not counts.get(DBFileHandle.ReservedState):
+            state = "failed" if counts.get("failed") else "done"
             self.add_log("state", event="release", state=state, transaction=transaction)
 
             self.State = state
             self.EndTimestamp = datetime.now(timezone.utc)
             self.save(transaction=transaction)
-        return handle
+            DBProject.notify_dispatch(self.DB, [self.ID], transaction=transaction)
+        return self.State
         
     def is_active(self, reload=False):
-        #print("projet", self.ID, "  handle states:", [h.State for h in self.handles(reload=reload)])
         p = self if not reload else DBProject.get(self.DB, self.ID)
         if p is None:   return False
-        return p.State == "active" and not all(h.State in ("done", "failed") for h in p.handles())
+        if p.State != "active":
+            return False
+        counts = p.HandleCounts if not reload and p.HandleCounts is not None else p.file_state_counts()
+        return counts.get(DBFileHandle.ReadyState, 0) + counts.get(DBFileHandle.ReservedState, 0) > 0
+
+    @transactioned
+    def file_state_counts(self, transaction=None):
+        # returns {state -> count} for raw handle states, read from the counters table
+        transaction.execute(f"""
+            select state, count from {self.CountsTable}
+                where project_id = %s and count > 0
+        """, (self.ID,))
+        return dict(transaction.fetchall())
 
-    def file_state_counts(self):
-        counts = {}
-        for h in DBFileHandle.list(self.DB, project_id=self.ID):
-            s = h.State
-            counts[s] = counts.get(s, 0) + 1
+    @transactioned
+    def handle_state_counts(self, transaction=None):
+        # returns {state -> count} for all DBFileHandle.DerivedStates
+        counts = {state:0 for state in DBFileHandle.DerivedStates}
+        raw_counts = self.file_state_counts(transaction=transaction)
+        for state, count in raw_counts.items():
+            if state != DBFileHandle.ReadyState:
+                counts[state] = count
+        if raw_counts.get(DBFileHandle.ReadyState):
+            counts.update(DBFileHandle.availability_counts(self.DB, self.ID, transaction=transaction))
         return counts
+
+    @staticmethod
+    @transactioned
+    def notify_dispatch(db, project_ids, transaction=None):
+        # the notifications are delivered to the listeners when the transaction commits
+        project_ids = sorted(set(project_ids))
+        if project_ids:
+            transaction.execute("select pg_notify(%s, x::text) from unnest(%s::bigint[]) as x", 
+                (DBProject.DispatchChannel, project_ids))
+
+    @staticmethod
+    @transactioned
+    def notify_state(db, states, transaction=None):
+        # states: [(project_id, state), ...]
+        payloads = [f"{project_id}:{state}" for project_id, state in states]
+        if payloads:
+            transaction.execute("select pg_notify(%s, x) from unnest(%s::text[]) as x", 
+                (DBProject.StateChannel, payloads))
+
+    @staticmethod
+    def active_ids(db):
+        # returns set of ids of active projects with handles to process, reads the project and the counters tables only
+        c = db.cursor()
+        c.execute(f"""
+            select p.id from {DBProject.Table} p
+                where p.state = 'active'
+                    and exists (
+                        select * from {DBProject.CountsTable} hc
+                            where hc.project_id = p.id and hc.state in (%s, %s) and hc.count > 0
+                    )
+        """, (DBFileHandle.ReadyState, DBFileHandle.ReservedState))
+        return set(project_id for (project_id,) in cursor_iterator(c))
+
+    @staticmethod
+    @transactioned
+    def update_handle_counts(db, deltas, transaction=None):
+        # deltas: {(project_id, state) -> increment}
+        # counter rows are updated in sorted order so that concurrent transactions lock them in the same order
+        deltas = sorted((key, n) for key, n in deltas.items() if n)
+        if not deltas:
+            return
+        project_ids = [project_id for (project_id, _), _ in deltas]
+        states = [state for (_, state), _ in deltas]
+        increments = [n for _, n in deltas]
+        table = DBProject.CountsTable
+        transaction.execute(f"""
+            insert into {table}(project_id, state, count)
+                select d.project_id, d.state, d.increment
+                    from unnest(%s::bigint[], %s::text[], %s::bigint[]) with ordinality as d(project_id, state, increment, i)
+                    order by d.i
+                on conflict (project_id, state)
+                    do update set count = {table}.count + excluded.count
+        """, (project_ids, states, increments))
         
     def project_log(self):
         return self.get_log()
@@ -767,8 +964,11 @@ class DBProject(DBObject, HasLogRecord):
                 update {p_table} p 
                     set state='abandoned'
                     where p.id = any(%s)
+                    returning p.id
                 """, (project_ids,))
-            n = transaction.rowcount
+            abandoned = [project_id for (project_id,) in transaction.fetchall()]
+            DBProject.notify_state(db, [(project_id, "abandoned") for project_id in abandoned], transaction=transaction)
+            n = len(abandoned)
         return n
         
     @staticmethod
@@ -812,15 +1012,56 @@ class DBProject(DBObject, HasLogRecord):
         t = datetime.now() - to_timedelta(self.WorkerTimeout)
         return DBFileHandle.release_reserved_before(self.DB, self.ID, t)
 
+class DBFile(object):
+    # maps DIDs to integer ids, which file handles and replicas use to join each other
+    Table = "files"
+
+    @staticmethod
+    @transactioned
+    def ids(db, dids, transaction=None):
+        # dids: list of "namespace:name" or (namespace, name)
+        # creates the missing files
+        # returns {(namespace, name) -> id}
+        namespaces, names = split_dids(dids)
+        if not namespaces:
+            return {}
+        table = DBFile.Table
+        transaction.execute(f"""
+            insert into {table}(namespace, name)
+                select distinct namespace, name from unnest(%s::text[], %s::text[]) as d(namespace, name)
+                on conflict (namespace, name) do nothing
+        """, (namespaces, names))
+        transaction.execute(f"""
+            select f.namespace, f.name, f.id
+                from {table} f
+                    inner join unnest(%s::text[], %s::text[]) as d(namespace, name)
+                        using (namespace, name)
+        """, (namespaces, names))
+        return {(namespace, name): id for namespace, name, id in transaction.fetchall()}
+
+    @staticmethod
+    @transactioned
+    def purge(db, transaction=None):
+        # removes the files not referenced by any file handle or replica
+        table = DBFile.Table
+        transaction.execute(f"""
+            delete from {table} f
+                where not exists (select * from {DBFileHandle.Table} h where h.file_id = f.id)
+                    and not exists (select * from {DBReplica.Table} r where r.file_id = f.id)
+        """)
+        return transaction.rowcount
+
 class DBReplica(DBObject, HasLogRecord):
     Table = "replicas"
     ViewWithRSEStatus = "replicas_with_rse_availability"
+    StagingTable = "replicas_sync_staging"          # per-session temporary table, see sync_replicas()
     
     Columns = ["namespace", "name", "rse", "path", "url", "urls", "preference", "available"]
     PK = ["namespace", "name", "rse"]
     
     LogIDColumns = ["namespace", "name", "rse"]
     LogTable = "replica_log"
+    LogByFileID = True
     
     def __init__(self, db, namespace, name, rse, path, url, 
                 urls=[], preference=0, available=None, rse_available=None):
@@ -835,6 +1076,21 @@ class DBReplica(DBObject, HasLogRecord):
         self.Available = available
         self.RSEAvailable = rse_available           # optional, set by joining the rses table
 
+    def pk(self):
+        return (self.Namespace, self.Name, self.RSE)
+
+    @classmethod
+    def get(cls, db, namespace, name, rse):
+        # replicas are keyed by (file_id, rse)
+        c = db.cursor()
+        c.execute(f"""
+            select {cls.columns(as_text=True)} from {cls.Table}
+                where file_id = (select id from {DBFile.Table} where namespace = %s and name = %s) and rse = %s
+        """, (namespace, name, rse))
+        tup = c.fetchone()
+        if tup is None: return None
+        else:   return cls.from_tuple(db, tup)
+
     def did(self):
         return f"{self.Namespace}:{self.Name}"
         
@@ -848,8 +1104,11 @@ class DBReplica(DBObject, HasLogRecord):
     def list(db, namespace=None, name=None, rse=None):
         c = db.cursor()
         wheres = " true "
-        if namespace:   wheres += f" and namespace='{namespace}'"
-        if name:        wheres += f" and name='{name}'"
+        if namespace and name:
+            wheres += f" and file_id = (select id from {DBFile.Table} where namespace='{namespace}' and name='{name}')"
+        else:
+            if namespace:   wheres += f" and namespace='{namespace}'"
+            if name:        wheres += f" and name='{name}'"
         if rse:         wheres += f" and rse='{rse}'"
         columns = DBReplica.columns(as_text=True)
         table = DBReplica.Table
@@ -873,10 +1132,13 @@ class DBReplica(DBObject, HasLogRecord):
             table = DBReplica.Table
 
             c.execute(f"""
-                select {columns}, rse_available from {DBReplica.ViewWithRSEStatus}
-                where namespace || ':' || name = any(%s)
-                        {wheres}
-            """, (list(dids),))
+                select {columns}, rse_available from {DBReplica.ViewWithRSEStatus} r
+                    where r.file_id in (
+                        select f.id from {DBFile.Table} f
+                            inner join unnest(%s::text[], %s::text[]) as d(namespace, name)
+                                using (namespace, name)
+                    ) {wheres}
+            """, split_dids(dids))
             for tup in cursor_iterator(c):
                 r = DBReplica.from_tuple(db, tup[:-1])
                 r.RSEAvailable = tup[-1]
@@ -894,24 +1156,25 @@ class DBReplica(DBObject, HasLogRecord):
     @transactioned
     def create(db, namespace, name, rse, path, url, urls, preference=0, available=False, error_if_exists=False, transaction=None):
         table = DBReplica.Table
+        file_id = DBFile.ids(db, [(namespace, name)], transaction=transaction)[(namespace, name)]
         transaction.execute(f"""
-            insert into {table}(namespace, name, rse, path, url, urls, preference, available)
-                values(%s, %s, %s, %s, %s, %s, %s, %s)
-                on conflict(namespace, name, rse)
-                    do update set path=%s, url=%s, urls=%s, preference=%s, available=%s;
-            commit
-        """, (namespace, name, rse, path, url, json.dumps(urls), preference, available,
-                path, url, urls, preference, available)
+            insert into {table}(file_id, namespace, name, rse, path, url, urls, preference, available)
+                values(%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                on conflict(file_id, rse)
+                    do update set path=%s, url=%s, urls=%s, preference=%s, available=%s
+        """, (file_id, namespace, name, rse, path, url, json.dumps(urls), preference, available,
+                path, url, json.dumps(urls), preference, available)
         )
+        DBFileHandle.refresh_dispatchable(db, dids=[(namespace, name)], transaction=transaction)
         
-        replica = DBReplica.get(db, namespace, name, rse)
+        replica = DBReplica(db, namespace, name, rse, path, url, urls=urls, preference=preference, available=available)
         replica.add_log("state", {
             "event":        "create",
             "url":          url,
             "path":         path,
             "available":    available,
             "state":        "available" if available else "unavailable"
-        })
+        }, transaction=transaction)
         return replica
 
     def save(self):
@@ -922,13 +1185,14 @@ class DBReplica(DBObject, HasLogRecord):
                 begin;
                 update {table}
                      set path=%s, url=%s, urls=%s, preference=%s, available=%s
-                     where namespace=%s and name=%s and rse=%s;
+                     where file_id = (select id from files where namespace=%s and name=%s) and rse=%s;
                 commit
             """, (self.Path, self.URL, json.dumps(self.URLs), self.Preference, self.Available, 
                     self.Namespace, self.Name, self.RSE))
         except:
             c.execute("rollback")
             raise
+        DBFileHandle.refresh_dispatchable(self.DB, dids=[(self.Namespace, self.Name)])
         return self
 
     #
@@ -941,83 +1205,118 @@ class DBReplica(DBObject, HasLogRecord):
         # by_namespace_name: {(namespace, name) -> {rse: dict(urls=urls, available=available}}
         # The input dictionary is presumed to have all the replicas found for (namespace, name). I.e. if the replica is not found
         # in the input dictionary, it should be deleted
+        # Only the rows which actually change are written. Existing replicas are updated only if the urls changed or
+        # the replica became available.
+        # returns {"inserted": n, "updated": n, "deleted": n}
 
-        t = int(time.time()*1000)
-        temp_table = f"replicas_temp_{t}"
+        if not by_namespace_name:
+            return dict(inserted=0, updated=0, deleted=0)
 
-        records = []
-        for (namespace, name), by_rse in by_namespace_name.items():
-            for rse, info in by_rse.items():
-                records.append((namespace, name, rse, info))
+        table = DBReplica.Table
+        staging = DBReplica.StagingTable
 
-        csv = ['%s\t%s\t%s\t%s\t%s' % (namespace, name, rse, 
+        file_ids = DBFile.ids(db, by_namespace_name.keys(), transaction=transaction)
+        csv = ['%s\t%s\t%s\t%s\t%s\t%s' % (file_ids[(namespace, name)], namespace, name, rse, 
                 json.dumps(info.get("urls", [])),
                 'true' if info["available"] else 'false') 
-            for namespace, name, rse, info in records
+            for (namespace, name), by_rse in by_namespace_name.items()
+            for rse, info in by_rse.items()
         ]
         csv = io.StringIO("\n".join(csv))
-        
+
+        # the staging table is private to the session and is dropped at commit
+        transaction.execute(f"drop table if exists pg_temp.{staging}")
         transaction.execute(f"""
-            create temp table {temp_table}
+            create temp table {staging}
             (
+                file_id     bigint,
                 namespace   text,
                 name        text,
                 rse         text,
                 urls        jsonb,
                 available   boolean
-        )
+            ) on commit drop
         """)
-        transaction.copy_from(csv, temp_table)
-        
+        transaction.copy_from(csv, staging, columns=["file_id", "namespace", "name", "rse", "urls", "available"])
+        transaction.execute(f"analyze {staging}")
+
+        #
+        # delete replicas if (file_id, rse) not present in the list for the file
+        #
+        transaction.execute(f"""
+            delete from {table} r
+                where r.file_id = any(%(file_ids)s::bigint[])
+                    and not exists (
+                        select * from {staging} s
+                            where s.file_id = r.file_id and s.rse = r.rse
+                    )
+                returning r.file_id
+        """, dict(file_ids=list(file_ids.values())))
+        deleted = transaction.fetchall()
+
         #
-        # delete replicas if (namespace, name, rse) not present in the list for (namespace, name)
+        # update existing replicas, which changed
         #
         transaction.execute(f"""
-            delete from replicas r 
-                where row(r.namespace, r.name) in (select namespace, name from {temp_table})
-                    and not row(r.namespace, r.name, r.rse) in (select namespace, name, rse from {temp_table});
+            update {table} r
+                set urls = s.urls,
+                    available = r.available or s.available
+                from {staging} s
+                where r.file_id = s.file_id and r.rse = s.rse
+                    and (r.urls is distinct from s.urls or s.available and not r.available)
+                returning r.file_id
         """)
-        
+        updated = transaction.fetchall()
+
         #
-        # insert new replicas and update existing ones
+        # insert new replicas
         #
         transaction.execute(f"""
-            insert into replicas(namespace, name, rse, urls, available)
+            insert into {table}(file_id, namespace, name, rse, urls, available)
                 (
-                    select namespace, name, rse, urls, available
-                        from {temp_table}
+                    select s.file_id, s.namespace, s.name, s.rse, s.urls, s.available
+                        from {staging} s
+                        where not exists (
+                                select * from {table} r
+                                    where r.file_id = s.file_id and r.rse = s.rse
+                            )
                 )
-                on conflict(namespace, name, rse)
-                do update set 
-                    urls=excluded.urls,
-                    available=replicas.available or excluded.available
+                on conflict(file_id, rse)
+                    do nothing
+                returning file_id
         """)
-        transaction.execute(f"drop table {temp_table}")
+        inserted = transaction.fetchall()
+
+        changed = set(deleted) | set(updated) | set(inserted)
+        if changed:
+            DBFileHandle.refresh_dispatchable(db, file_ids=[file_id for (file_id,) in changed], transaction=transaction)
+        return dict(inserted=len(inserted), updated=len(updated), deleted=len(deleted))
     
     @staticmethod
-    def remove_bulk(db, rse=None, dids=None):
-        c = db.cursor()
+    @transactioned
+    def remove_bulk(db, rse=None, dids=None, transaction=None):
+        # the handles are refreshed in the same transaction, so that the dispatchable flags can not be left stale
         table = DBReplica.Table
         wheres = "true"
         if rse is not None: wheres += f" and rse='{rse}'"
-        try:
+        if dids is not None:
+            transaction.execute(f"""
+                delete from {table} r
+                    using {DBFile.Table} f, unnest(%s::text[], %s::text[]) as d(namespace, name)
+                    where {wheres} and f.namespace = d.namespace and f.name = d.name and r.file_id = f.id
+            """, split_dids(dids))
+        else:
+            transaction.execute(f"""
+                delete from {table}
+                    where {wheres}
+            """)
+        nremoved = transaction.rowcount
+        if nremoved:
             if dids is not None:
-                c.execute(f"""
-                    begin;
-                    delete from {table}
-                        where {wheres} and namespace || ':' || name = any(%s);
-                """, (dids,))
+                DBFileHandle.refresh_dispatchable(db, dids=dids, transaction=transaction)
             else:
-                c.execute(f"""
-                    begin;
-                    delete from {table}
-                        where {wheres};
-                """)
-            nremoved = c.rowcount
-            c.execute("commit")
-        except:
-            c.execute("rollback")
-            raise
+                # the replicas are gone, so the handles to refresh are the dispatchable ones
+                DBFileHandle.refresh_dispatchable(db, dispatchable_only=True, transaction=transaction)
         return nremoved
 
     @staticmethod
@@ -1049,7 +1348,7 @@ class DBReplica(DBObject, HasLogRecord):
             c.execute(f"""
                 insert into {table}({columns}) 
                     select t.ns, t.n, t.r, t.p, t.u, t.pr, %s from {temp_table} t
-                    on conflict (namespace, name, rse)
+                    on conflict
                         do nothing
                     returning {table}.namespace, {table}.name
                 """, (available,))
@@ -1085,8 +1384,12 @@ class DBReplica(DBObject, HasLogRecord):
         return len(new_replicas)
 
     @staticmethod
-    def update_availability_bulk(db, available, rse, dids):
+    @transactioned
+    def update_availability_bulk(db, available, rse, dids, transaction=None):
         # dids is list of dids: ["namespace:name", ...]
+        # the replicas, their log and the handles dispatchable flags are updated in one transaction. Otherwise, if the
+        # process failed after the replicas were updated, the next update would find no changes and the handles
+        # would never be refreshed
 
         r = DBRSE.get(db, rse)
         if r is None or not r.Enabled:
@@ -1095,24 +1398,17 @@ class DBReplica(DBObject, HasLogRecord):
         if not dids:    return
         table = DBReplica.Table
         val = "true" if available else "false"
-        updated = []
-        c = db.cursor()
-        c.execute("begin")
-        try:
-            sql = f"""
-                update {table}
-                    set available = %s
-                    where namespace || ':' || name = any(%s)
-                        and rse = %s
-                        and available != %s
-                    returning namespace, name
-            """
-            c.execute(sql, (val, dids, rse, val))
-            updated = c.fetchall()
-            c.execute("commit")
-        except:
-            c.execute("rollback")
-            raise
+        namespaces, names = split_dids(dids)
+        transaction.execute(f"""
+            update {table} r
+                set available = %s
+                from {DBFile.Table} f, unnest(%s::text[], %s::text[]) as d(namespace, name)
+                where f.namespace = d.namespace and f.name = d.name and r.file_id = f.id
+                    and r.rse = %s
+                    and r.available != %s
+                returning r.namespace, r.name
+        """, (val, namespaces, names, rse, val))
+        updated = transaction.fetchall()
 
         available_text = "available" if available else "unavailable"
         log_records = [
@@ -1124,7 +1420,8 @@ class DBReplica(DBObject, HasLogRecord):
             for (namespace, name) in updated
         ]
         if log_records:
-            DBReplica.add_log_bulk(db, log_records)
+            DBReplica.add_log_bulk(db, log_records, transaction=transaction)
+            DBFileHandle.refresh_dispatchable(db, dids=updated, transaction=transaction)
             
     @staticmethod
     @transactioned
@@ -1136,7 +1433,7 @@ class DBReplica(DBObject, HasLogRecord):
             delete from {table} r
                 where not exists (
                     select * from {h_table} h
-                        where r.namespace = h.namespace and r.name = h.name
+                        where h.file_id = r.file_id
                 )
         """)
         norphans = transaction.rowcount
@@ -1148,10 +1445,11 @@ class DBReplica(DBObject, HasLogRecord):
                         from {p_table} pp, {h_table} hh
                         where pp.state = 'active'
                             and pp.id = hh.project_id
-                            and hh.namespace = r.namespace and hh.name = r.name
+                            and hh.file_id = r.file_id
                 )
         """)
         nabandoned = transaction.rowcount
+        DBFile.purge(db, transaction=transaction)
         return nabandoned + norphans
 
 class DBFileHandle(DBObject, HasLogRecord):
@@ -1171,9 +1469,12 @@ class DBFileHandle(DBObject, HasLogRecord):
             "done",
             "failed"
         ]
+        
+    ProximityWindow = 1000          # number of least attempted handles ranked by proximity on reservation
 
     LogIDColumns = ["project_id", "namespace", "name"]
     LogTable = "file_handle_log"
+    LogByFileID = True
 
     def __init__(self, db, project_id, namespace, name, state=None, worker_id=None, attempts=0, attributes={}, reserved_since=None):
         self.DB = db
@@ -1192,6 +1493,18 @@ class DBFileHandle(DBObject, HasLogRecord):
     def pk(self):
         return (self.ProjectID, self.Namespace, self.Name)
 
+    @classmethod
+    def get(cls, db, project_id, namespace, name):
+        # handles are keyed by (project_id, file_id)
+        c = db.cursor()
+        c.execute(f"""
+            select {cls.columns(as_text=True)} from {cls.Table}
+                where project_id = %s and file_id = (select id from {DBFile.Table} where namespace = %s and name = %s)
+        """, (project_id, namespace, name))
+        tup = c.fetchone()
+        if tup is None: return None
+        else:   return cls.from_tuple(db, tup)
+
     def id(self):
         return f"{self.ProjectID}:{self.Namespace}:{self.Name}"
         
@@ -1256,28 +1569,24 @@ class DBFileHandle(DBObject, HasLogRecord):
         )
         if with_replicas:
             out["replicas"] = {rse: r.as_jsonable() for rse, r in self.replicas().items()}
-        print("DBHandle.as_jsonable: out:", out)
         return out
         
     def attributes_as_json(self):
         return json.dumps(self.Attributes, indent=4)
         
     @staticmethod
-    def create(db, project_id, namespace, name, attributes={}):
-        c = db.cursor()
-        try:
-            c.execute("begin")
-            c.execute("""
-                insert into file_handles(project_id, namespace, name, state, attempts, attributes)
-                    values(%s, %s, %s, %s, 0, %s)
-            """, (project_id, namespace, name, DBFileHandle.InitialState, json.dumps(attributes or {})))
-            id = c.fetchone()[0]
-            db.commit()
-        except:
-            c.execute("rollback")
-            raise
-        handle = DBFileHandle.get(db, project_id, namespace, name)
-        handle.add_log("state", event="create", state="initial")
+    @transactioned
+    def create(db, project_id, namespace, name, attributes={}, transaction=None):
+        file_id = DBFile.ids(db, [(namespace, name)], transaction=transaction)[(namespace, name)]
+        transaction.execute("""
+            insert into file_handles(project_id, file_id, namespace, name, state, attempts, attributes)
+                values(%s, %s, %s, %s, %s, 0, %s)
+        """, (project_id, file_id, namespace, name, DBFileHandle.InitialState, json.dumps(attributes or {})))
+        handle = DBFileHandle(db, project_id, namespace, name, state=DBFileHandle.InitialState, attributes=attributes)
+        handle.add_log("state", event="create", state="initial", transaction=transaction)
+        DBProject.update_handle_counts(db, {(project_id, DBFileHandle.InitialState): 1}, transaction=transaction)
+        DBFileHandle.refresh_dispatchable(db, dids=[(namespace, name)], project_id=project_id,         # replicas may be known already
+                    transaction=transaction)
         return handle
 
     @staticmethod
@@ -1289,14 +1598,16 @@ class DBFileHandle(DBObject, HasLogRecord):
         files_csv = []
         parents_csv = []
         null = r"\N"
+        file_ids = DBFile.ids(db, [(info["namespace"], info["name"]) for info in files], transaction=transaction)
         for info in files:
             namespace = info["namespace"]
             name = info["name"]
             attributes = info.get("attributes") or {}
-            files_csv.append("%s\t%s\t%s\t%s\t%s" % (project_id, namespace, name, DBFileHandle.InitialState, json.dumps(attributes)))
+            files_csv.append("%s\t%s\t%s\t%s\t%s\t%s" % (project_id, file_ids[(namespace, name)], namespace, name, 
+                        DBFileHandle.InitialState, json.dumps(attributes)))
         
         transaction.copy_from(io.StringIO("\n".join(files_csv)), "file_handles", 
-                    columns = ["project_id", "namespace", "name", "state", "attributes"])
+                    columns = ["project_id", "file_id", "namespace", "name", "state", "attributes"])
             
         log_records = [
             (
@@ -1310,63 +1621,73 @@ class DBFileHandle(DBObject, HasLogRecord):
             for f in files 
         ]            
         DBFileHandle.add_log_bulk(db, log_records, transaction=transaction)
+        DBProject.update_handle_counts(db, {(project_id, DBFileHandle.InitialState): len(files_csv)}, transaction=transaction)
+        DBFileHandle.refresh_dispatchable(db, project_id=project_id, transaction=transaction)       # replicas may be known already
 
     @staticmethod
-    def get_bulk(db, project_id, dids, with_replicas=False):
+    def get_bulk(db, project_id, dids, with_replicas=False, itersize=None):
         #print("namespace_names:", type(namespace_names), namespace_names[:3])
-        dids = list(dids)
+        namespaces, names = split_dids(dids)
         h_columns = DBFileHandle.columns("h", as_text=True)
         h_n_columns = len(DBFileHandle.Columns)
         r_columns = DBReplica.columns("r", as_text=True)
         r_n_columns = len(DBReplica.Columns)
         available_replicas_view = DBReplica.ViewWithRSEStatus
-        c = db.cursor()
-        if with_replicas:
-            sql = f"""\
-                select {h_columns}, {r_columns}, rse_available
-                    from file_handles h
-                        inner join {available_replicas_view} r on (
-                            (r.namespace || ':' || r.name) = (h.namespace || ':' || h.name)
-                        )
-                        where h.project_id = %s
-                            and (h.namespace || ':' || h.name) = any(%s)
-                        order by h.namespace, h.name
-            """
-            #print("DBFileHandle.list: sql:", sql)
-            c.execute(sql, (project_id, dids))
-            h = None
-            for tup in cursor_iterator(c):
-                #print("DBFileHandle.get_bulk:", tup)
-                h_tuple, r_tuple, rse_available = tup[:h_n_columns], tup[h_n_columns:h_n_columns+r_n_columns], tup[-1]
-                if h is None:
-                    h = DBFileHandle.from_tuple(db, h_tuple)
-                #print("DBFileHandle.get_bulk: h:", h)
-                h1 = DBFileHandle.from_tuple(db, h_tuple)
-                if h1.Namespace != h.Namespace or h1.Name != h.Name:
-                    if h:   
-                        #print("    yield:", h)
-                        yield h
-                    h = h1
-                if r_tuple[0] is not None:
-                    r = DBReplica.from_tuple(db, r_tuple)
-                    r.RSEAvailable = rse_available
-                    h.Replicas = h.Replicas or {}
-                    h.Replicas[r.RSE] = r
-            if h is not None:
-                #print("    yield:", h)
-                yield h
-        else:
-            sql = f"""
-                select {h_columns}
-                    from file_handles h
-                        where project_id = %s and (namespace || ':' || name) = any(%s)
-                        order by h.namespace, h.name
-            """
-            c.execute(sql, (project_id, dids))
-            yield from (DBFileHandle.from_tuple(db, tup) for tup in cursor_iterator(c))
+        c = server_cursor(db, itersize)
+        try:
+            if with_replicas:
+                sql = f"""\
+                    select {h_columns}, {r_columns}, rse_available
+                        from unnest(%s::text[], %s::text[]) as d(namespace, name)
+                            inner join {DBFile.Table} f using (namespace, name)
+                            inner join file_handles h on (h.project_id = %s and h.file_id = f.id)
+                            inner join {available_replicas_view} r on (r.file_id = h.file_id)
+                            order by h.namespace, h.name
+                """
+                #print("DBFileHandle.list: sql:", sql)
+                c.execute(sql, (namespaces, names, project_id))
+                h = None
+                for tup in c:
+                    #print("DBFileHandle.get_bulk:", tup)
+                    h_tuple, r_tuple, rse_available = tup[:h_n_columns], tup[h_n_columns:h_n_columns+r_n_columns], tup[-1]
+                    if h is None:
+                        h = DBFileHandle.from_tuple(db, h_tuple)
+                    #print("DBFileHandle.get_bulk: h:", h)
+                    h1 = DBFileHandle.from_tuple(db, h_tuple)
+                    if h1.Namespace != h.Namespace or h1.Name != h.Name:
+                        if h:   
+                            #print("    yield:", h)
+                            yield h
+                        h = h1
+                    if r_tuple[0] is not None:
+                        r = DBReplica.from_tuple(db, r_tuple)
+                        r.RSEAvailable = rse_available
+                        h.Replicas = h.Replicas or {}
+                        h.Replicas[r.RSE] = r
+                if h is not None:
+                    #print("    yield:", h)
+                    yield h
+            else:
+                sql = f"""
+                    select {h_columns}
+                        from unnest(%s::text[], %s::text[]) as d(namespace, name)
+                            inner join {DBFile.Table} f using (namespace, name)
+                            inner join file_handles h on (h.project_id = %s and h.file_id = f.id)
+                            order by h.namespace, h.name
+                """
+                c.execute(sql, (namespaces, names, project_id))
+                yield from (DBFileHandle.from_tuple(db, tup) for tup in c)
+        finally:
+            c.close()
 
     @staticmethod
-    def list(db, project_id=None, state=None, namespace=None, not_state=None, with_replicas=False, with_availability=False):
+    def list(db, project_id=None, state=None, namespace=None, not_state=None, with_replicas=False, with_availability=False,
+                itersize=None, after=None, limit=None, worker_id=None, available_only=False):
+        # after, limit: keyset pagination. Handles are ordered by (project_id, namespace, name). If after is specified as
+        #   "namespace:name" or (namespace, name), only handles following it are returned. Use it together with project_id.
+        # limit: maximum number of handles to return
+        # available_only: only the handles with an available replica in an available RSE
+        params = {}
         wheres = []
         if project_id: wheres.append(f"h.project_id={project_id}")
         if state:
@@ -1376,74 +1697,94 @@ class DBFileHandle(DBObject, HasLogRecord):
                 wheres.append(f"h.state='{state}'")
         if not_state:       wheres.append(f"h.state!='{not_state}'")
         if namespace:       wheres.append(f"h.namespace='{namespace}'")
-        wheres = " and ".join(wheres)
-        c = db.cursor()
+        if worker_id:
+            wheres.append("h.worker_id = %(worker_id)s")
+            params["worker_id"] = worker_id
+        if available_only:
+            wheres.append(f"""exists (
+                    select * from {DBReplica.Table} rr, {DBRSE.Table} rs
+                        where rr.file_id = h.file_id and rr.available
+                            and rs.name = rr.rse and rs.is_available
+                )""")
+        if after:
+            if isinstance(after, str):
+                after = after.split(":", 1)
+            wheres.append("(h.namespace, h.name) > (%(after_namespace)s, %(after_name)s)")
+            params["after_namespace"], params["after_name"] = after
+        wheres = " and ".join(wheres) or "true"
+        order = "order by h.project_id, h.namespace, h.name"
+        if limit is not None:
+            order += " limit %(limit)s"
+            params["limit"] = limit
         h_columns = DBFileHandle.columns("h", as_text=True)
         r_columns = DBReplica.columns("r", as_text=True)
         h_n_columns = len(DBFileHandle.Columns)
         r_n_columns = len(DBReplica.Columns)
         available_replicas_view = DBReplica.ViewWithRSEStatus
-        if with_replicas:
-            if with_availability:
-                sql  = f"""\
-                    select {h_columns}, {r_columns}, r.rse_available
-                        from file_handles h
-                            left outer join 
-                            (   select rr.*, rs.is_available as rse_available
-                                    from replicas rr, rses rs
-                                        where rr.rse = rs.name
-                            ) r on (r.name = h.name and r.namespace = h.namespace)
-                        where (%(project_id)s is null or h.project_id = %(project_id)s)
-                        order by h.project_id, h.namespace, h.name
-                    """
+        c = server_cursor(db, itersize)
+        try:
+            if with_replicas:
+                if with_availability:
+                    sql  = f"""\
+                        select {h_columns}, {r_columns}, r.rse_available
+                            from (select * from file_handles h where {wheres} {order}) h
+                                left outer join 
+                                (   select rr.*, rs.is_available as rse_available
+                                        from replicas rr, rses rs
+                                            where rr.rse = rs.name
+                                ) r on (r.file_id = h.file_id)
+                            order by h.project_id, h.namespace, h.name
+                        """
+                else:
+                    sql  = f"""\
+                        select {h_columns}, {r_columns}, null
+                            from (select * from file_handles h where {wheres} {order}) h
+                                left outer join replicas r on (r.file_id = h.file_id)
+                            order by h.project_id, h.namespace, h.name
+                        """
+                c.execute(sql, params)
+                #print("DBFileHandle.list: sql:", sql)
+                h = None
+                for tup in c:
+                    #print("DBFileHandle.list:", tup)
+                    h_tuple, r_tuple, rse_available = tup[:h_n_columns], tup[h_n_columns:h_n_columns+r_n_columns], tup[-1]
+                    #print("Handle.list: tuples:", h_tuple, r_tuple, rse_available)
+                    h1 = DBFileHandle.from_tuple(db, h_tuple)
+                    if h is None or h1.Namespace != h.Namespace or h1.Name != h.Name:
+                        if h is not None:
+                            yield h
+                        h = h1
+                        h.Replicas = {}
+                        h.Availability = "not found" if with_availability else None
+                    if r_tuple[0] is not None:
+                        if h.Availability != "available":
+                            h.Availability = "found"
+                        r = DBReplica.from_tuple(db, r_tuple)
+                        r.RSEAvailable = bool(rse_available)
+                        h.Replicas[r.RSE] = r
+                        if with_availability and rse_available and r.Available:
+                            h.Availability = "available"
+                if h is not None:
+                    #print("    yield:", h, len(h.Replicas))
+                    yield h
             else:
-                sql  = f"""\
-                    select {h_columns}, {r_columns}, null
+                sql = f"""
+                    select {h_columns}
                         from file_handles h
-                            left outer join replicas r on (r.name = h.name and r.namespace = h.namespace)
-                        where (%(project_id)s is null or h.project_id = %(project_id)s)
-                        order by h.project_id, h.namespace, h.name
-                    """
-            c.execute(sql, {"project_id":project_id})
-            #print("DBFileHandle.list: sql:", sql)
-            h = None
-            for tup in cursor_iterator(c):
-                #print("DBFileHandle.list:", tup)
-                h_tuple, r_tuple, rse_available = tup[:h_n_columns], tup[h_n_columns:h_n_columns+r_n_columns], tup[-1]
-                #print("Handle.list: tuples:", h_tuple, r_tuple, rse_available)
-                h1 = DBFileHandle.from_tuple(db, h_tuple)
-                if h is None or h1.Namespace != h.Namespace or h1.Name != h.Name:
-                    if h is not None:
-                        yield h
-                    h = h1
-                    h.Replicas = {}
-                    h.Availability = "not found" if with_availability else None
-                if r_tuple[0] is not None:
-                    if h.Availability != "available":
-                        h.Availability = "found"
-                    r = DBReplica.from_tuple(db, r_tuple)
-                    r.RSEAvailable = bool(rse_available)
-                    h.Replicas[r.RSE] = r
-                    if with_availability and rse_available and r.Available:
-                        h.Availability = "available"
-            if h is not None:
-                #print("    yield:", h, len(h.Replicas))
-                yield h
-        else:
-            sql = f"""
-                select {h_columns}
-                    from file_handles h
-                        where {wheres}
-            """
-            c.execute(sql)
-            yield from (DBFileHandle.from_tuple(db, tup) for tup in cursor_iterator(c))
+                            where {wheres}
+                            {order}
+                """
+                c.execute(sql, params)
+                yield from (DBFileHandle.from_tuple(db, tup) for tup in c)
+        finally:
+            c.close()
     
     
     @transactioned
     def save(self, transaction=None):
         transaction.execute("""
                 update file_handles set state=%s, worker_id=%s, attempts=%s, attributes=%s
-                    where project_id=%s and namespace=%s and name=%s
+                    where project_id=%s and file_id = (select id from files where namespace=%s and name=%s)
             """, (self.State, self.WorkerID, self.Attempts, json.dumps(self.Attributes), 
                     self.ProjectID, self.Namespace, self.Name
                 )            
@@ -1455,51 +1796,171 @@ class DBFileHandle(DBObject, HasLogRecord):
 
     @staticmethod
     @transactioned
-    def reserve_for_worker(db, project_id, worker_id, transaction=None):
+    def reserve_for_worker(db, project_id, worker_id, count=1, proximities=None, default_proximity=None, transaction=None):
+        # reserves up to <count> available handles of an active project in one statement
+        # proximities: optional {rse -> proximity}, lower is closer. If specified, handles with closer replicas
+        #   are reserved first among the ProximityWindow least attempted dispatchable handles. The window is joined
+        #   with the replicas and the proximities once and ranked with min() ... group by, see tools/bench_reserve.py
+        # default_proximity: proximity of the RSEs not in proximities
+        # returns list of reserved handles with their replicas loaded
+        # uses the file_handles_dispatchable partial index, see refresh_dispatchable()
         h_table = DBFileHandle.Table
-        rep_table = DBReplica.Table
-        rse_table = DBRSE.Table
-        reserved = None
+        p_table = DBProject.Table
+        h_columns = DBFileHandle.columns("h", as_text=True)
+        params = dict(project_id=project_id, worker_id=worker_id, count=count,
+                    ready=DBFileHandle.ReadyState, reserved=DBFileHandle.ReservedState)
+        # the project state is checked here because the caller may have used a cached project
+        active_project = f"exists (select * from {p_table} p where p.id = %(project_id)s and p.state = 'active')"
+        if proximities:
+            rep_table = DBReplica.Table
+            rse_table = DBRSE.Table
+            rses, values = zip(*proximities.items())
+            params.update(rses=list(rses), proximities=list(values), default_proximity=default_proximity,
+                window=max(count, DBFileHandle.ProximityWindow))
+            selected = f"""
+                    select hh.file_id
+                        from {h_table} hh,
+                            (
+                                select c.file_id, c.attempts,
+                                        min(coalesce(px.proximity, %(default_proximity)s::int)) filter (where r.file_id is not null) as proximity
+                                    from (
+                                        select file_id, attempts
+                                            from {h_table}
+                                            where project_id = %(project_id)s and state = %(ready)s and dispatchable
+                                            order by attempts
+                                            limit %(window)s
+                                    ) c
+                                    left outer join (
+                                        {rep_table} r
+                                            inner join {rse_table} s on (r.rse = s.name and s.is_enabled and s.is_available)
+                                    ) on (r.file_id = c.file_id and r.available)
+                                    left outer join unnest(%(rses)s::text[], %(proximities)s::int[]) as px(rse, proximity)
+                                        on (px.rse = r.rse)
+                                    group by c.file_id, c.attempts
+                            ) ranked
+                        where hh.project_id = %(project_id)s and hh.file_id = ranked.file_id
+                            and hh.state = %(ready)s
+                            and {active_project}
+                        order by ranked.proximity nulls last, ranked.attempts
+                        limit %(count)s
+                        for update of hh skip locked
+            """
+        else:
+            selected = f"""
+                    select hh.file_id
+                        from {h_table} hh
+                        where
+                            hh.project_id = %(project_id)s and hh.state = %(ready)s and hh.dispatchable
+                            and {active_project}
+                        order by hh.attempts
+                        limit %(count)s
+                        for update skip locked
+            """
         sql = f"""
-                select h.namespace, h.name
-                    from {h_table} h
-                    where 
-                        h.project_id = %s and h.state = %s
-                        and exists (
-                            select * from {rep_table} r, {rse_table} s
-                                where h.namespace = r.namespace and h.name = r.name 
-                                    and r.rse = s.name
-                                    and s.is_enabled and s.is_available
-                        )
-                    order by attempts
-                    limit 1
-                    for update skip locked
+                with selected as ({selected})
+                update {h_table} h
+                    set state = %(reserved)s, worker_id = %(worker_id)s, attempts = h.attempts + 1, reserved_since = now()
+                    from selected
+                    where h.project_id = %(project_id)s and h.file_id = selected.file_id
+                    returning {h_columns}, h.file_id
         """
         #print("sql:\n", sql)
-        transaction.execute(sql, (project_id, DBFileHandle.ReadyState))
-        tup = transaction.fetchone()
-        if tup:
-            namespace, name = tup
-            transaction.execute(f"""
-                update {h_table}
-                    set state = %s, worker_id = %s, attempts = attempts + 1, reserved_since = now()
-                    where project_id = %s and namespace = %s and name = %s
-            """, (DBFileHandle.ReservedState, worker_id, project_id, namespace, name))
-            reserved = (namespace, name)
-
-        if reserved:
-            namespace, name = reserved
-            reserved = DBFileHandle.get(db, project_id, namespace, name)
-            reserved.record_state_change(DBFileHandle.ReservedState, 
-                event = "reserve",
-                old_state = DBFileHandle.ReadyState, worker=worker_id,
-                transaction=transaction)
+        transaction.execute(sql, params)
+        tuples = transaction.fetchall()
+        reserved = [DBFileHandle.from_tuple(db, tup[:-1]) for tup in tuples]
+        if not reserved:
+            return reserved
+
+        by_did = {}
+        for h in reserved:
+            h.Replicas = {}
+            by_did[(h.Namespace, h.Name)] = h
+        r_columns = DBReplica.columns(as_text=True)
+        transaction.execute(f"""
+            select {r_columns}, rse_available from {DBReplica.ViewWithRSEStatus}
+                where file_id = any(%s)
+        """, ([tup[-1] for tup in tuples],))
+        for tup in transaction.fetchall():
+            r = DBReplica.from_tuple(db, tup[:-1])
+            r.RSEAvailable = tup[-1]
+            by_did[(r.Namespace, r.Name)].Replicas[r.RSE] = r
+
+        DBFileHandle.add_log_bulk(db,
+            [
+                (
+                    h.pk(),
+                    "state",
+                    dict(event="reserve", worker=worker_id,
+                        state=DBFileHandle.ReservedState, old_state=DBFileHandle.ReadyState)
+                )
+                for h in reserved
+            ], transaction=transaction)
+        # update the counters last to keep the counter rows locked for as short as possible
+        DBProject.update_handle_counts(db, 
+            {
+                (project_id, DBFileHandle.ReadyState): -len(reserved),
+                (project_id, DBFileHandle.ReservedState): len(reserved)
+            }, transaction=transaction)
         return reserved
         
     #
     # workflow
     #
 
+    @staticmethod
+    @transactioned
+    def release_bulk(db, project_id, releases, transaction=None):
+        # releases: list of tuples (namespace, name, failed, retry)
+        # only reserved handles are released
+        # returns list of released handles
+        new_states = {}                 # {(namespace, name) -> (state, event)}
+        for namespace, name, failed, retry in releases:
+            if failed:
+                new_states[(namespace, name)] = (DBFileHandle.ReadyState if retry else "failed", "failed")
+            else:
+                new_states[(namespace, name)] = ("done", "done")
+        if not new_states:
+            return []
+        namespaces, names = zip(*new_states.keys())
+        states, events = zip(*new_states.values())
+        h_table = DBFileHandle.Table
+        h_columns = DBFileHandle.columns("h_new", as_text=True)
+        transaction.execute(f"""
+            update {h_table} h_new
+                set state = r.state, worker_id = null
+                from unnest(%s::text[], %s::text[], %s::text[], %s::text[]) as r(namespace, name, state, event),
+                    {DBFile.Table} f,
+                    {h_table} h_old                 -- to get the worker_id before it is updated to null
+                where f.namespace = r.namespace and f.name = r.name
+                    and h_new.project_id = %s and h_new.file_id = f.id
+                    and h_new.state = %s
+                    and h_old.project_id = h_new.project_id and h_old.file_id = h_new.file_id
+                returning {h_columns}, h_old.worker_id, r.event
+        """, (list(namespaces), list(names), list(states), list(events), project_id, DBFileHandle.ReservedState))
+        released = []
+        log_records = []
+        deltas = {}
+        n_columns = len(DBFileHandle.Columns)
+        for tup in transaction.fetchall():
+            h = DBFileHandle.from_tuple(db, tup[:n_columns])
+            worker_id, event = tup[n_columns:]
+            released.append(h)
+            deltas[(project_id, h.State)] = deltas.get((project_id, h.State), 0) + 1
+            log_records.append(
+                (
+                    h.pk(),
+                    "state",
+                    dict(event=event, worker=worker_id, state=h.State, old_state=DBFileHandle.ReservedState)
+                )
+            )
+        DBFileHandle.add_log_bulk(db, log_records, transaction=transaction)
+        if released:
+            deltas[(project_id, DBFileHandle.ReservedState)] = -len(released)
+            DBProject.update_handle_counts(db, deltas, transaction=transaction)
+            if any(h.State == DBFileHandle.ReadyState for h in released):
+                DBProject.notify_dispatch(db, [project_id], transaction=transaction)
+        return released
+
     @staticmethod
     @transactioned
     def release_reserved_before(db, project_id, reserved_before, transaction=None):
@@ -1510,7 +1971,7 @@ class DBFileHandle(DBObject, HasLogRecord):
                 set state = %s, worker_id = null
                 from file_handles h_old                     -- this is the trick to get the worker_id before it is updated to null
                 where h_new.project_id = %s and h_new.state = %s and h_new.reserved_since < %s
-                    and h_new.project_id = h_old.project_id and h_new.namespace = h_old.namespace and h_new.name = h_old.name
+                    and h_new.project_id = h_old.project_id and h_new.file_id = h_old.file_id
                 returning h_new.namespace, h_new.name, h_old.worker_id
         """, (DBFileHandle.ReadyState, project_id, DBFileHandle.ReservedState, reserved_before))
         log_records = [
@@ -1521,8 +1982,167 @@ class DBFileHandle(DBObject, HasLogRecord):
             ) for namespace, name, worker_id in transaction.fetchall()
         ]
         DBFileHandle.add_log_bulk(db, log_records, transaction=transaction)
+        DBProject.update_handle_counts(db, 
+            {
+                (project_id, DBFileHandle.ReservedState): -len(log_records),
+                (project_id, DBFileHandle.ReadyState): len(log_records)
+            }, transaction=transaction)
+        if log_records:
+            DBProject.notify_dispatch(db, [project_id], transaction=transaction)
         return len(log_records)
 
+    @staticmethod
+    @transactioned
+    def renew_leases(db, project_id, worker_id, dids=None, transaction=None):
+        # extends the reservation of the handles reserved by the worker, all of them or only those in dids
+        # dids: list of "namespace:name"
+        # returns list of DIDs of the renewed handles
+        h_table = DBFileHandle.Table
+        params = dict(project_id=project_id, worker_id=worker_id, reserved=DBFileHandle.ReservedState)
+        did_filter = ""
+        if dids is not None:
+            dids = [did.split(":", 1) for did in dids]
+            if not dids:
+                return []
+            namespaces, names = zip(*dids)
+            did_filter = f"""and h.file_id in (
+                    select f.id from {DBFile.Table} f
+                        inner join unnest(%(namespaces)s::text[], %(names)s::text[]) as d(namespace, name)
+                            using (namespace, name)
+                )"""
+            params.update(namespaces=list(namespaces), names=list(names))
+        transaction.execute(f"""
+            update {h_table} h
+                set reserved_since = now()
+                where h.project_id = %(project_id)s and h.worker_id = %(worker_id)s and h.state = %(reserved)s
+                    {did_filter}
+                returning h.namespace, h.name
+        """, params)
+        return [f"{namespace}:{name}" for namespace, name in transaction.fetchall()]
+
+    @staticmethod
+    @transactioned
+    def release_expired(db, transaction=None):
+        # releases handles reserved longer than their project worker timeout, in all active projects
+        # returns {project_id -> number of handles released}
+        h_table = DBFileHandle.Table
+        p_table = DBProject.Table
+        transaction.execute(f"""
+            update {h_table} h_new
+                set state = %(ready)s, worker_id = null
+                from {p_table} p, {h_table} h_old           -- to get the worker_id before it is updated to null
+                where p.state = 'active' and p.worker_timeout is not null
+                    and h_new.project_id = p.id and h_new.state = %(reserved)s
+                    and h_new.reserved_since < now() - p.worker_timeout
+                    and h_old.project_id = h_new.project_id and h_old.file_id = h_new.file_id
+                returning h_new.project_id, h_new.namespace, h_new.name, h_old.worker_id
+        """, dict(ready=DBFileHandle.ReadyState, reserved=DBFileHandle.ReservedState))
+        released = {}
+        log_records = []
+        for project_id, namespace, name, worker_id in transaction.fetchall():
+            released[project_id] = released.get(project_id, 0) + 1
+            log_records.append(
+                (
+                    (project_id, namespace, name),
+                    "state",
+                    dict(event="worker_timeout", state=DBFileHandle.ReadyState, old_state=DBFileHandle.ReservedState, 
+                        worker=worker_id)
+                )
+            )
+        if released:
+            DBFileHandle.add_log_bulk(db, log_records, transaction=transaction)
+            deltas = {}
+            for project_id, n in released.items():
+                deltas[(project_id, DBFileHandle.ReservedState)] = -n
+                deltas[(project_id, DBFileHandle.ReadyState)] = n
+            DBProject.update_handle_counts(db, deltas, transaction=transaction)
+            DBProject.notify_dispatch(db, list(released.keys()), transaction=transaction)
+        return released
+
+    @staticmethod
+    @transactioned
+    def refresh_dispatchable(db, dids=None, rse=None, project_id=None, dispatchable_only=False, file_ids=None, transaction=None):
+        # Recalculates the "dispatchable" flag for the handles of the given files, of the files with replicas
+        # in the RSE or in the project. A handle is dispatchable if the file has an available replica
+        # in an enabled and available RSE.
+        # dids: list of "namespace:name" or (namespace, name)
+        # file_ids: list of file ids, alternative to dids
+        # dispatchable_only: check only the handles currently marked as dispatchable, e.g. after replicas were removed
+        # returns number of handles updated
+        h_table = DBFileHandle.Table
+        rep_table = DBReplica.Table
+        rse_table = DBRSE.Table
+        wheres = []
+        params = {}
+        if dids is not None:
+            namespaces, names = split_dids(dids)
+            if not namespaces:
+                return 0
+            wheres.append(f"""h.file_id in (
+                    select f.id from {DBFile.Table} f
+                        inner join unnest(%(namespaces)s::text[], %(names)s::text[]) as d(namespace, name)
+                            using (namespace, name)
+                )""")
+            params["namespaces"] = namespaces
+            params["names"] = names
+        if file_ids is not None:
+            if not file_ids:
+                return 0
+            wheres.append("h.file_id = any(%(file_ids)s::bigint[])")
+            params["file_ids"] = list(file_ids)
+        if rse is not None:
+            wheres.append(f"""exists (
+                    select * from {rep_table} rr
+                        where rr.rse = %(rse)s and rr.file_id = h.file_id
+                )""")
+            params["rse"] = rse
+        if project_id is not None:
+            wheres.append("h.project_id = %(project_id)s")
+            params["project_id"] = project_id
+        if dispatchable_only:
+            wheres.append("h.dispatchable")
+        wheres = " and ".join(wheres) or "true"
+        transaction.execute(f"""
+            update {h_table} h
+                set dispatchable = not h.dispatchable
+                where {wheres}
+                    and h.dispatchable != exists (
+                        select * from {rep_table} r, {rse_table} s
+                            where r.file_id = h.file_id
+                                and r.available
+                                and r.rse = s.name and s.is_enabled and s.is_available
+                    )
+                returning h.project_id, h.state, h.dispatchable
+        """, params)
+        updated = transaction.fetchall()
+        DBProject.notify_dispatch(db, 
+            [project_id for project_id, state, dispatchable in updated if dispatchable and state == DBFileHandle.ReadyState],
+            transaction=transaction)
+        return len(updated)
+
+    @staticmethod
+    @transactioned
+    def availability_counts(db, project_id, transaction=None):
+        # returns {"available"|"found"|"not found" -> count} for the project handles in the initial state
+        h_table = DBFileHandle.Table
+        rep_table = DBReplica.Table
+        transaction.execute(f"""
+            select
+                    case
+                        when h.dispatchable then 'available'
+                        when exists (
+                            select * from {rep_table} r
+                                where r.file_id = h.file_id
+                        ) then 'found'
+                        else 'not found'
+                    end as availability,
+                    count(*)
+                from {h_table} h
+                where h.project_id = %s and h.state = %s
+                group by availability
+        """, (project_id, DBFileHandle.ReadyState))
+        return dict(transaction.fetchall())
+
     def is_available(self):
         return any(r.Available and r.RSEAvailable for r in self.replicas().values())
 
@@ -1541,6 +2161,12 @@ class DBFileHandle(DBObject, HasLogRecord):
         data["state"] = new_state
         data["old_state"] = old_state
         self.add_log("state", data, transaction=transaction)
+        if new_state != old_state:
+            DBProject.update_handle_counts(self.DB, 
+                {
+                    (self.ProjectID, old_state): -1,
+                    (self.ProjectID, new_state): 1
+                }, transaction=transaction)
 
     @transactioned
     def set_state(self, state, transaction=None, **log_data):
@@ -1553,7 +2179,7 @@ class DBFileHandle(DBObject, HasLogRecord):
     def done(self, transaction=None):
         self.set_state("done", event="done", worker=self.WorkerID, transaction=transaction)
         self.WorkerID = None
-        self.save()
+        self.save(transaction=transaction)
 
     @transactioned
     def failed(self, retry=True, transaction=None):
@@ -1670,6 +2296,7 @@ class DBRSE(DBObject):
                 self.AddPrefix, self.PinPrefix, self.Preference, self.Type,
                 self.Name)
         )
+        DBFileHandle.refresh_dispatchable(self.DB, rse=self.Name, transaction=transaction)
 
 
     @staticmethod
@@ -1678,11 +2305,88 @@ class DBRSE(DBObject):
         for name in names:
             DBRSE.create(db, name, transaction=transaction)
 
+class DBPinRequest(DBObject):
+    # tape pin requests sent by the daemon, so they can be adopted after a restart
+
+    Columns = ["id", "rse", "url", "created", "expiration", "paths", "staged"]
+    PK = ["id"]
+    Table = "pin_requests"
+
+    def __init__(self, db, id, rse, url, created=None, expiration=None, paths=[], staged=[]):
+        self.DB = db
+        self.ID = id
+        self.RSE = rse
+        self.URL = url
+        self.Created = created
+        self.Expiration = expiration            # datetime
+        self.Paths = set(paths or [])
+        self.Staged = set(staged or [])
+
+    def pk(self):
+        return (self.ID,)
+
+    def as_jsonable(self):
+        return dict(
+            id          = self.ID,
+            rse         = self.RSE,
+            url         = self.URL,
+            created     = self.Created.timestamp() if self.Created is not None else None,
+            expiration  = self.Expiration.timestamp() if self.Expiration is not None else None,
+            paths       = sorted(self.Paths),
+            staged      = sorted(self.Staged)
+        )
+
+    @staticmethod
+    def to_datetime(t):
+        # epoch timestamp or datetime or None
+        if t is None or isinstance(t, datetime):
+            return t
+        return datetime.fromtimestamp(t, timezone.utc)
+
+    @classmethod
+    @transactioned
+    def create(cls, db, rse, url, paths, expiration=None, staged=[], transaction=None):
+        table = cls.Table
+        transaction.execute(f"""
+            insert into {table}(rse, url, expiration, paths, staged)
+                values(%s, %s, %s, %s, %s)
+                on conflict (rse, url)
+                    do update set expiration = excluded.expiration, paths = excluded.paths, staged = excluded.staged
+                returning id, created
+        """, (rse, url, cls.to_datetime(expiration), list(paths), list(staged)))
+        id, created = transaction.fetchone()
+        return cls(db, id, rse, url, created, cls.to_datetime(expiration), paths, staged)
+
+    @classmethod
+    def list(cls, db, rse=None):
+        c = db.cursor()
+        columns = cls.columns(as_text=True)
+        table = cls.Table
+        wheres = "where rse = %s" if rse is not None else ""
+        c.execute(f"""
+            select {columns} from {table} {wheres}
+                order by id
+        """, (rse,) if rse is not None else ())
+        return (cls.from_tuple(db, tup) for tup in cursor_iterator(c))
+
+    @transactioned
+    def save(self, transaction=None):
+        transaction.execute(f"""
+            update {self.Table}
+                set expiration=%s, paths=%s, staged=%s
+                where id=%s
+        """, (self.to_datetime(self.Expiration), list(self.Paths), list(self.Staged), self.ID))
+
+    @transactioned
+    def delete(self, transaction=None):
+        transaction.execute(f"delete from {self.Table} where id=%s", (self.ID,))
+
 class DBProximityMap(DBObject):
 
     Columns = ["cpu", "rse", "proximity"]
     PK = ["cpu", "rse"]
     Table = "proximity_map"
+    VersionTable = "proximity_map_version"
     
     def __init__(self, db, tuples=None, defaults = {}, overrides={}, default=None, rses=None):
         self.DB = db
@@ -1708,13 +2412,25 @@ class DBProximityMap(DBObject):
     
     def load(self):
         self.Map = {}
-        c = self.DB.cursor()
+        self._load(DBProximityMap.read_tuples(self.DB))
+        return self
+
+    @staticmethod
+    def read_tuples(db):
+        c = db.cursor()
         c.execute(f"""
             select cpu, rse, proximity
-                from {self.Table}
+                from {DBProximityMap.Table}
         """)
-        self._load(cursor_iterator(c))
-        return self
+        return list(cursor_iterator(c))
+
+    @staticmethod
+    def version(db):
+        # the version is incremented every time the map is saved
+        c = db.cursor()
+        c.execute(f"select version from {DBProximityMap.VersionTable}")
+        tup = c.fetchone()
+        return tup[0] if tup else None
     
     def save(self):
         c = self.DB.cursor()
@@ -1731,6 +2447,7 @@ class DBProximityMap(DBObject):
                         on conflict(cpu, rse)
                             do update set proximity=%s
                     """, (cpu, rse, proximity, proximity))
+            c.execute(f"update {self.VersionTable} set version = version + 1")
             c.execute("commit")
         except:
             c.execute("rollback")
@@ -1744,6 +2461,14 @@ class DBProximityMap(DBObject):
         overrides = self.Overrides.get(cpu, {})
         return overrides.get(rse, cpu_map.get(rse, cpu_map.get("DEFAULT", default)))
         
+    def cpu_proximities(self, cpu):
+        # returns ({rse -> proximity}, default proximity) for the CPU site, consistent with proximity()
+        if cpu is None: cpu = "DEFAULT"
+        cpu_map = self.Map.get(cpu,  self.Map.get("DEFAULT", self.Defaults.get(cpu, {})))
+        proximities = {rse: proximity for rse, proximity in cpu_map.items() if rse.upper() != "DEFAULT"}
+        proximities.update(self.Overrides.get(cpu, {}))
+        return proximities, cpu_map.get("DEFAULT", self.Default)
+
     def raw(self, cpu, rse, default=None):
         return self.Map.get(cpu, {}).get(rse, default)
 
@@ -1755,3 +2480,53 @@ class DBProximityMap(DBObject):
         for cpu, cpu_map in self.Map.items():
             rses |= set(rse for rse in cpu_map.keys())
         return sorted(list(rses), key=lambda x: "-" if x.upper() == "DEFAULT" else x)
+
+class DBListener(object):
+    # Receives Postgres notifications on a dedicated autocommit connection.
+    # dbconfig is the "database" section of the configuration or a connection string
+
+    def __init__(self, dbconfig, channels):
+        self.Config = dbconfig
+        self.Channels = list(channels)
+        self.Connection = None
+
+    def connstr(self):
+        cfg = self.Config
+        if isinstance(cfg, str):
+            return cfg
+        cs = "host=%(host)s port=%(port)s dbname=%(dbname)s user=%(user)s" % cfg
+        if cfg.get("password"):
+            cs += " password=%(password)s" % cfg
+        return cs
+
+    def connect(self):
+        import psycopg2
+        self.close()
+        connection = psycopg2.connect(self.connstr())
+        connection.autocommit = True
+        c = connection.cursor()
+        for channel in self.Channels:
+            c.execute(f"listen {channel}")
+        self.Connection = connection
+
+    def close(self):
+        if self.Connection is not None:
+            try:    self.Connection.close()
+            except: pass
+            self.Connection = None
+
+    def wait(self, timeout):
+        # returns list of (channel, payload) tuples, empty on timeout
+        # raises an exception if the connection is broken. The next call will reconnect
+        import select
+        if self.Connection is None:
+            self.connect()
+        try:
+            if self.Connection.notifies or select.select([self.Connection], [], [], timeout)[0]:
+                self.Connection.poll()
+            notifies = self.Connection.notifies[:]
+            del self.Connection.notifies[:]
+        except:
+            self.close()
+            raise
+        return [(n.channel, n.payload) for n in notifies]
@@ -1,4 +1,4 @@
-import getopt, json, time, pprint, textwrap, sys
+import getopt, json, time, pprint, textwrap, sys, itertools
 from datetime import datetime
 from metacat.webapi import MetaCatClient
 from .ui_lib import pretty_json, parse_attrs, print_handles
@@ -249,7 +249,7 @@ class ActivateCommand(CLICommand):
             
 class ShowCommand(CLICommand):
     
-    Opts = "arjf:"
+    Opts = "arjf:n:"
     Usage = """[options] <project_id>               -- show project info (-j show as JSON)
         -a                                              - show project attributes only
         -r                                              - show replicas information
@@ -262,12 +262,17 @@ class ShowCommand(CLICommand):
                reserved  - reserved files only
                failed    - failed files only
                done      - done files only
+        -n <number>                                     - show at most <number> files
     """
     MinArgs = 1
     
     def __call__(self, command, client, opts, args):
         project_id = args[0]
-        info = client.get_project(project_id, with_files=True, with_replicas=True)
+        limit = int(opts["-n"]) if "-n" in opts else None
+        page_size = 1000 if limit is None else max(1, min(limit, 1000))        # do not request more handles than needed
+        # with -j and no limit, get the project with all its handles in one request, otherwise the handles are read page by page
+        with_files = "-j" in opts and "-a" not in opts and limit is None
+        info = client.get_project(project_id, with_files=with_files, with_replicas=with_files)
         if info is None:
             print("Project", project_id, "not found")
             sys.exit(1)
@@ -280,19 +285,29 @@ class ShowCommand(CLICommand):
                     print(f"{name} {value}")
         else:
             if "-j" in opts:
+                if not with_files:
+                    info["file_handles"] = list(itertools.islice(client.iterate_handles(project_id, with_replicas=True, page_size=page_size), limit))
                 print(pretty_json(info))
             elif "-f" in opts:
                 filter_state = opts["-f"]
-                for h in info["file_handles"]:
+                if filter_state == "ready":
+                    filter_state = "initial"
+                server_state = filter_state if filter_state in ("done", "initial", "failed", "reserved") else None
+                handles = client.iterate_handles(project_id, state=server_state, with_replicas=filter_state == "available")
+                nprinted = 0
+                for h in handles:
+                    if limit is not None and nprinted >= limit:
+                        break
                     did = h["namespace"] + ":" + h["name"]
                     state = h["state"]
-                    rlist = h["replicas"].values()
-                    available = state == "ready" and len([r for r in rlist if r["available"] and r["rse_available"]]) > 0
+                    available = state == "initial" and \
+                        any(r["available"] and r["rse_available"] for r in h.get("replicas", {}).values())
                     if filter_state == "all" or \
-                                filter_state in ("done", "ready", "failed", "reserved") and state == filter_state or \
+                                filter_state in ("done", "initial", "failed", "reserved") and state == filter_state or \
                                 filter_state == "available" and available or \
                                 filter_state == "active" and not state in ("done", "failed"):
                         print(did)
+                        nprinted += 1
             else:
                 created_timestamp = datetime.utcfromtimestamp(info["created_timestamp"]).strftime("%Y/%m/%d %H:%M:%S UTC")
                 ended_timestamp = info.get("ended_timestamp") or ""
@@ -315,8 +330,8 @@ class ShowCommand(CLICommand):
                     print("  %-15s = %s" % (k, v))
                 print("Handles:")
                 print_replicas = "-r" in opts
-                if "file_handles" in info:
-                    print_handles(info["file_handles"], print_replicas)
+                handles = itertools.islice(client.iterate_handles(project_id, with_replicas=True, page_size=page_size), limit)
+                print_handles(handles, print_replicas)
 
 class ListCommand(CLICommand):
     Opts = "ju:s:a:"
@@ -5,7 +5,7 @@ from data_dispatcher.api import NotFoundError
 
 class NextFileCommand(CLICommand):
     
-    Opts = "j:t:c:w:"
+    Opts = "j:t:c:w:n:"
     MinArgs = 1
     Usage = """[options] <project_id> -- get next available file
              -w <worker id>     -- specify worker id
@@ -13,6 +13,8 @@ class NextFileCommand(CLICommand):
              -j <json file>     -- write reserved file information into a JSON file
              -t <timeout>       -- wait for next file until "timeout" seconds, 
                                    otherwise, wait until the project finishes
+             -n <count>         -- reserve up to <count> files at once, print one DID per line
+                                   and write a JSON list of reserved files with -j
     """
 
     def __call__(self, command, client, opts, args):
@@ -22,17 +24,21 @@ class NextFileCommand(CLICommand):
         timeout = opts.get("-t")
         if timeout is not None: timeout = int(timeout)
         cpu_site = opts.get("-c")
+        count = opts.get("-n")
+        if count is not None: count = int(count)
 
         try:
-            reply = client.next_file(project_id, cpu_site=cpu_site, worker_id=worker_id, timeout=timeout)
+            reply = client.next_file(project_id, cpu_site=cpu_site, worker_id=worker_id, timeout=timeout, count=count)
         except NotFoundError:
             print("project not found")
             sys.exit(1)
 
-        if isinstance(reply, dict):
-            print("%s:%s" % (reply["namespace"], reply["name"]))
+        if isinstance(reply, (dict, list)):
+            infos = reply if isinstance(reply, list) else [reply]
+            for info in infos:
+                print("%s:%s" % (info["namespace"], info["name"]))
+                info["replicas"] = sorted(info["replicas"].values(), key=lambda r: 1000000 if r.get("preference") is None else r["preference"])
             if json_out:
-                reply["replicas"] = sorted(reply["replicas"].values(), key=lambda r: 1000000 if r.get("preference") is None else r["preference"])
                 with open(json_out, "w") as jo:
                     json.dump(reply, jo, indent=4, sort_keys=True)
         else:
@@ -43,36 +49,60 @@ class NextFileCommand(CLICommand):
 class DoneCommand(CLICommand):
     
     MinArgs = 2
-    Usage = """<project id> (<DID>|all)                          -- mark a file as done
+    Usage = """<project id> (<DID> [<DID> ...]|all)              -- mark files as done
         "all" means mark all files reserved by the worker as done
     """
 
     def __call__(self, command, client, opts, args):
-        project_id, did = args
-        if did == "all":
-            dids = [to_did(h["namespace"], h["name"]) for h in client.reserved_files(project_id)]
-        else:
-            dids = [did]
-        for did in dids:
-            client.file_done(int(project_id), did)
+        project_id, dids = int(args[0]), args[1:]
+        if dids == ["all"]:
+            dids = [to_did(h["namespace"], h["name"]) for h in client.reserved_handles(project_id)]
+        if len(dids) == 1:
+            client.file_done(project_id, dids[0])
+        elif dids:
+            client.release_files(project_id, dids)
     
 class FailedCommand(CLICommand):
     
     Opts = "f"
     MinArgs = 2
-    Usage = """[-f] <project id> (<DID>|all)                      -- mark a file as failed
-        -f            -- final, do not retry the file
+    Usage = """[-f] <project id> (<DID> [<DID> ...]|all)          -- mark files as failed
+        -f            -- final, do not retry the files
         "all" means mark all files reserved by the worker as failed
     """
     
     def __call__(self, command, client, opts, args):
-        project_id, did = args
-        if did == "all":
-            dids = [to_did(h["namespace"], h["name"]) for h in client.reserved_files(project_id)]
-        else:
-            dids = [did]
-        for did in dids:
-            client.file_failed(int(project_id), did, retry = not "-f" in opts)
+        project_id, dids = int(args[0]), args[1:]
+        retry = not "-f" in opts
+        if dids == ["all"]:
+            dids = [to_did(h["namespace"], h["name"]) for h in client.reserved_handles(project_id)]
+        if len(dids) == 1:
+            client.file_failed(project_id, dids[0], retry = retry)
+        elif dids:
+            client.release_files(project_id, dids, failed=True, retry=retry)
+
+class RenewCommand(CLICommand):
+    
+    Opts = "w:"
+    MinArgs = 1
+    Usage = """[-w <worker id>] <project id> [<DID> ...]      -- extend reservation of files reserved by the worker
+        -w <worker id>          -- specify worker id. Otherwise, use my worker id
+        if no DIDs are specified, renew all files reserved by the worker
+    """
+
+    def __call__(self, command, client, opts, args):
+        project_id, dids = int(args[0]), args[1:] or None
+        worker_id = opts.get("-w")
+        try:    reply = client.renew_leases(project_id, dids, worker_id=worker_id)
+        except NotFoundError:
+            print("project not found", file=sys.stderr)
+            sys.exit(1)
+        for did in reply.get("renewed", []):
+            print(did)
+        if reply.get("not_renewed"):
+            for did in reply["not_renewed"]:
+                print("not reserved:", did, file=sys.stderr)
+            sys.exit(1)
 
 class IDCommand(CLICommand):
     
@@ -99,7 +129,7 @@ class IDCommand(CLICommand):
 class ListReservedCommand(CLICommand):
     
     MinArgs = 1
-    Opts = "j"
+    Opts = "jw:"
     Usage = """[-j] [-w <worker id>] <project id>              -- list files allocated to the worker
         -j                      -- as JSON
         -w <worker id>          -- specify worker id. Otherwise, use my worker id    
@@ -110,7 +140,7 @@ class ListReservedCommand(CLICommand):
         worker_id = opts.get("-w", client.WorkerID)
         as_json = "-j" in opts
         
-        try:    handles = client.reserved_files(project_id, worker_id)
+        try:    handles = client.reserved_handles(project_id, worker_id)
         except NotFoundError:
             print("project not found", file=sys.stderr)
             sys.exit(1)
@@ -127,5 +157,6 @@ WorkerCLI = CLI(
     "list",     ListReservedCommand(),
     "next",     NextFileCommand(),
     "done",     DoneCommand(),
-    "failed",   FailedCommand()
+    "failed",   FailedCommand(),
+    "renew",    RenewCommand()
 )
@@ -1,13 +1,18 @@
 drop table if exists project_log;
 drop table if exists file_handle_log;
 drop table if exists replicas cascade;
+drop table if exists replicas_staging;
+drop table if exists project_handle_counts;
 drop table if exists file_handles;
 drop table if exists project_users;
 drop table if exists project_roles;
 drop table if exists projects;
 drop table if exists proximity_map;
+drop table if exists proximity_map_version;
 drop table if exists replica_log;
+drop table if exists pin_requests;
 drop table if exists rses;
+drop table if exists files;
 
 create table projects
 (
@@ -53,8 +58,17 @@ create table rses
     type            text
 );
 
+create table files
+(
+    id          bigserial   primary key,
+    namespace   text,
+    name        text,
+    unique (namespace, name)
+);
+
 create table replicas
 (
+    file_id     bigint      not null references files(id),
     namespace   text,
     name        text,
     rse         text        references rses(name) on delete cascade,
@@ -63,11 +77,10 @@ create table replicas
     urls        jsonb       default '[]'::jsonb,
     available   boolean     default false,
     preference  int         default 0,
-    primary key (namespace, name, rse),
+    primary key (file_id, rse),
     foreign key (rse) references rses (name) on delete cascade
 );
 
-create index replicas_dids on replicas ((namespace || ':' || name));
 create index replicas_rse on replicas(rse);
 
 create view replicas_with_rse_availability as
@@ -79,6 +92,7 @@ create view replicas_with_rse_availability as
 create table file_handles
 (
     project_id  bigint references projects(id) on delete cascade,
+    file_id     bigint not null references files(id),
     namespace   text,
     name        text,
     state       text,
@@ -86,12 +100,22 @@ create table file_handles
     reserved_since  timestamp with time zone,
     attempts    int default 0,
     attributes  jsonb  default '{}'::jsonb,
-    primary key (project_id, namespace, name)
+    dispatchable    boolean default false,      -- has an available replica in an enabled and available RSE
+    primary key (project_id, file_id)
 );
 
-create unique index file_handles_project_id_filespec on file_handles(project_id, namespace, name);
-create index file_handles_project_id on file_handles(project_id);
-create index file_handles_filespec on file_handles(namespace, name);
+create index file_handles_file_id on file_handles(file_id);
+create index file_handles_dispatchable on file_handles(project_id, attempts) where state = 'initial' and dispatchable;
+create index file_handles_reserved_since on file_handles(reserved_since) where state = 'reserved';
+create index file_handles_worker on file_handles(project_id, worker_id) where state = 'reserved';
+
+create table project_handle_counts
+(
+    project_id  bigint  references projects(id) on delete cascade,
+    state       text,
+    count       bigint  default 0,
+    primary key (project_id, state)
+);
 
 create table project_log
 (
@@ -105,28 +129,42 @@ create table project_log
 create table file_handle_log
 (
     project_id  bigint,
+    file_id     bigint,
     namespace   text,
     name        text,
     t           timestamp with time zone     default now(),
     type        text,
     data        jsonb,
-    primary key (project_id, namespace, name, t, type),
-    foreign key (project_id, namespace, name) references file_handles on delete cascade
+    primary key (project_id, file_id, t, type),
+    foreign key (project_id, file_id) references file_handles on delete cascade
 );
 
 create table replica_log
 (
+    file_id     bigint,
     namespace   text,
     name        text,
     rse         text,
     t           timestamp with time zone     default now(),
     type        text,
     data        jsonb,
-    primary key (namespace, name, rse, t, type),
-    foreign key (namespace, name, rse) references replicas(namespace, name, rse) on delete cascade,
+    primary key (file_id, rse, t, type),
+    foreign key (file_id, rse) references replicas on delete cascade,
     foreign key (rse) references rses(name) on delete cascade
 );
 
+create table pin_requests
+(
+    id          bigserial   primary key,
+    rse         text        references rses(name) on delete cascade,
+    url         text        not null,
+    created     timestamp with time zone     default now(),
+    expiration  timestamp with time zone,
+    paths       text[],
+    staged      text[],
+    unique (rse, url)
+);
+
 create table proximity_map
 (
     cpu             text,
@@ -137,4 +175,11 @@ create table proximity_map
 
 insert into proximity_map(cpu, rse, proximity) values('DEFAULT', 'DEFAULT', 100);
 
+create table proximity_map_version
+(
+    version     bigint
+);
+
+insert into proximity_map_version(version) values(0);
+
     
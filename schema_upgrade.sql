@@ -0,0 +1,186 @@
+--
+-- Upgrades an existing database to the current schema.sql. Each section can be re-run safely.
+--
+
+--
+-- per-project handle state counters
+--
+
+create table if not exists project_handle_counts
+(
+    project_id  bigint  references projects(id) on delete cascade,
+    state       text,
+    count       bigint  default 0,
+    primary key (project_id, state)
+);
+
+insert into project_handle_counts(project_id, state, count)
+    select project_id, state, count(*)
+        from file_handles
+        group by project_id, state
+    on conflict (project_id, state)
+        do update set count = excluded.count;
+
+--
+-- dispatchable file handles
+--
+
+alter table file_handles add column if not exists dispatchable boolean default false;
+
+update file_handles h
+    set dispatchable = true
+    where not h.dispatchable
+        and exists (
+            select * from replicas r, rses s
+                where r.namespace = h.namespace and r.name = h.name
+                    and r.available
+                    and r.rse = s.name and s.is_enabled and s.is_available
+        );
+
+create index if not exists file_handles_dispatchable on file_handles(project_id, attempts) where state = 'initial' and dispatchable;
+
+--
+-- proximity map version
+--
+
+create table if not exists proximity_map_version
+(
+    version     bigint
+);
+
+insert into proximity_map_version(version)
+    select 0
+        where not exists (select * from proximity_map_version);
+
+--
+-- worker lease expiration
+--
+
+create index if not exists file_handles_reserved_since on file_handles(reserved_since) where state = 'reserved';
+
+--
+-- replica sync stages the replicas in a per-session temporary table, the shared staging table is not used any more
+--
+
+drop table if exists replicas_staging;
+
+--
+-- replicas are matched by (namespace, name), the expression index is not used any more
+--
+
+drop index if exists replicas_dids;
+
+--
+-- integer file ids
+--
+
+create table if not exists files
+(
+    id          bigserial   primary key,
+    namespace   text,
+    name        text,
+    unique (namespace, name)
+);
+
+insert into files(namespace, name)
+    select namespace, name from file_handles
+    union
+    select namespace, name from replicas
+    on conflict (namespace, name) do nothing;
+
+alter table file_handles add column if not exists file_id bigint references files(id);
+alter table replicas add column if not exists file_id bigint references files(id);
+
+update file_handles h
+    set file_id = f.id
+    from files f
+    where h.file_id is null and f.namespace = h.namespace and f.name = h.name;
+
+update replicas r
+    set file_id = f.id
+    from files f
+    where r.file_id is null and f.namespace = r.namespace and f.name = r.name;
+
+alter table file_handles alter column file_id set not null;
+alter table replicas alter column file_id set not null;
+
+create unique index if not exists file_handles_project_file_id on file_handles(project_id, file_id);
+create index if not exists file_handles_file_id on file_handles(file_id);
+create index if not exists replicas_file_id on replicas(file_id);
+
+-- replicas.* now includes file_id
+drop view if exists replicas_with_rse_availability;
+create view replicas_with_rse_availability as
+    select replicas.*, rses.is_available as rse_available
+        from replicas, rses
+        where rses.name = replicas.rse and rses.is_enabled
+;
+
+--
+-- handles reserved by a worker
+--
+
+create index if not exists file_handles_worker on file_handles(project_id, worker_id) where state = 'reserved';
+
+--
+-- pin requests
+--
+
+create table if not exists pin_requests
+(
+    id          bigserial   primary key,
+    rse         text        references rses(name) on delete cascade,
+    url         text        not null,
+    created     timestamp with time zone     default now(),
+    expiration  timestamp with time zone,
+    paths       text[],
+    staged      text[],
+    unique (rse, url)
+);
+
+--
+-- file handles, replicas and their logs keyed by file id
+--
+
+alter table file_handle_log add column if not exists file_id bigint;
+alter table replica_log add column if not exists file_id bigint;
+
+update file_handle_log l
+    set file_id = f.id
+    from files f
+    where l.file_id is null and f.namespace = l.namespace and f.name = l.name;
+
+update replica_log l
+    set file_id = f.id
+    from files f
+    where l.file_id is null and f.namespace = l.namespace and f.name = l.name;
+
+delete from file_handle_log where file_id is null;
+delete from replica_log where file_id is null;
+
+alter table file_handle_log drop constraint if exists file_handle_log_project_id_namespace_name_fkey;
+alter table file_handle_log drop constraint if exists file_handle_log_project_id_file_id_fkey;
+alter table replica_log drop constraint if exists replica_log_namespace_name_rse_fkey;
+alter table replica_log drop constraint if exists replica_log_file_id_rse_fkey;
+
+alter table file_handles drop constraint if exists file_handles_pkey;
+alter table file_handles add primary key (project_id, file_id);
+alter table replicas drop constraint if exists replicas_pkey;
+alter table replicas add primary key (file_id, rse);
+
+alter table file_handle_log drop constraint if exists file_handle_log_pkey;
+alter table file_handle_log add primary key (project_id, file_id, t, type);
+alter table replica_log drop constraint if exists replica_log_pkey;
+alter table replica_log add primary key (file_id, rse, t, type);
+
+alter table file_handle_log add constraint file_handle_log_project_id_file_id_fkey
+    foreign key (project_id, file_id) references file_handles on delete cascade;
+alter table replica_log add constraint replica_log_file_id_rse_fkey
+    foreign key (file_id, rse) references replicas on delete cascade;
+
+drop index if exists file_handles_project_id;
+drop index if exists file_handles_filespec;
+drop index if exists file_handles_project_file_id;
+drop index if exists file_handles_project_id_filespec;
+drop index if exists replicas_file_id;
+drop index if exists replicas_filespec_rse;
@@ -0,0 +1,87 @@
+#
+# Compares matching replicas by "namespace:name" strings against joining with parallel namespace and name arrays
+#
+# Usage: python bench_did_join.py -c <config.yaml> [-s <sizes>] [-n <repeat>]
+#       -s <sizes>              comma-separated numbers of DIDs, default 10000,100000
+#       -n <repeat>             number of times to run each query, default 5
+#
+# The script creates temporary replicas, an RSE and the (namespace || ':' || name) expression index, which the string
+# matching needs, in the database configured in the "database" section of the config file and deletes them when done.
+#
+
+import sys, time, getopt, os, yaml
+from wsdbtools import ConnectionPool
+from data_dispatcher.db import DBReplica, DBRSE, split_dids
+
+Usage = """
+Usage: python bench_did_join.py -c <config.yaml> [-s <sizes>] [-n <repeat>]
+"""
+
+RSE = "BENCHMARK_RSE"
+Namespace = "bench_did_join"
+StringIndex = "bench_replicas_dids"
+
+StringQuery = """
+    select count(*) from replicas
+        where namespace || ':' || name = any(%s)
+"""
+
+JoinQuery = """
+    select count(*) from replicas r
+        inner join unnest(%s::text[], %s::text[]) as d(namespace, name)
+            using (namespace, name)
+"""
+
+def execute(db, *params):
+    c = db.cursor()
+    c.execute("begin")
+    c.execute(*params)
+    c.execute("commit")
+
+def timed(db, sql, params, n):
+    times = []
+    for _ in range(n):
+        c = db.cursor()
+        t0 = time.time()
+        c.execute(sql, params)
+        count = c.fetchone()[0]
+        times.append(time.time() - t0)
+    times.sort()
+    return count, times[len(times)//2]
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "c:s:n:")
+    opts = dict(opts)
+    config = opts.get("-c") or os.environ.get("DATA_DISPATCHER_CFG")
+    if not config:
+        print(Usage)
+        sys.exit(2)
+    config = yaml.load(open(config, "r"), Loader=yaml.SafeLoader)
+    sizes = [int(x) for x in opts.get("-s", "10000,100000").split(",")]
+    n = int(opts.get("-n", 5))
+
+    dbconfig = config["database"]
+    connection_pool = ConnectionPool(postgres=dbconfig, max_connections=dbconfig.get("max_connections"))
+    db = connection_pool.connect()
+
+    DBRSE.create(db, RSE, description="DID join benchmark", is_enabled=True, is_available=True)
+    execute(db, f"create index if not exists {StringIndex} on replicas ((namespace || ':' || name))")
+
+    print("%10s %8s %14s %14s" % ("dids", "found", "string, ms", "unnest, ms"))
+    try:
+        for size in sizes:
+            dids = [(Namespace, f"{size}_{i:08d}") for i in range(size)]
+            DBReplica.sync_replicas(db, {did: {RSE: {"urls":[], "available":True}} for did in dids})
+            execute(db, "analyze replicas")
+            try:
+                found, t_string = timed(db, StringQuery, (["%s:%s" % did for did in dids],), n)
+                _, t_join = timed(db, JoinQuery, split_dids(dids), n)
+            finally:
+                execute(db, "delete from replicas where namespace = %s", (Namespace,))
+            print("%10d %8d %14.3f %14.3f" % (size, found, t_string*1000, t_join*1000))
+    finally:
+        execute(db, f"drop index if exists {StringIndex}")
+        execute(db, "delete from rses where name = %s", (RSE,))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#
+# Compares polling file locality one file per request (dCache namespace API) against bulk WLCG Tape REST API
+# archiveinfo requests
+#
+# Usage: python bench_locality.py [-u <url>] [-n <files>] [-w <workers>] [-r <rate>] [-b <batch>]
+#       -u <url>                tape REST server URL, default http://localhost:8080
+#       -n <files>              number of files to poll, default 10000
+#       -w <workers>            number of concurrent requests, default 10
+#       -r <rate>               max requests per second, default 1000
+#       -b <batch>              archiveinfo batch size, default 1000
+#
+# Run it against tools/tape_rest_server.py or a real tape endpoint. The script uses the daemon poller classes
+# and does not access the database.
+#
+
+import sys, time, getopt, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "daemon"))
+
+from dcache import DCachePoller
+from wlcg import WLCGPoller
+
+Usage = """
+Usage: python bench_locality.py [-u <url>] [-n <files>] [-w <workers>] [-r <rate>] [-b <batch>]
+"""
+
+def bench(poller, files):
+    t0 = time.time()
+    counts = {}
+    for did, status in poller.poll_batch(files):
+        counts[status] = counts.get(status, 0) + 1
+    dt = time.time() - t0
+    stats = poller.Stats.reset()
+    poller.Executor.shutdown()
+    return dt, counts, stats
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "u:n:w:r:b:h")
+    opts = dict(opts)
+    if "-h" in opts:
+        print(Usage)
+        sys.exit(2)
+    url = opts.get("-u", "http://localhost:8080").rstrip("/")
+    n = int(opts.get("-n", 10000))
+    workers = int(opts.get("-w", 10))
+    rate = float(opts.get("-r", 1000))
+    WLCGPoller.ArchiveInfoBatch = int(opts.get("-b", 1000))
+
+    files = [(f"bench_locality:file_{i:08d}", f"/bench_locality/file_{i:08d}") for i in range(n)]
+
+    print("%-12s %8s %10s %10s %12s %12s  %s" % ("poller", "files", "requests", "time, s", "files/s", "latency, ms", "statuses"))
+    for name, poller in [
+                ("dcache", DCachePoller("BENCHMARK_RSE", None, url + "/api/v1/namespace", rate, {}, workers=workers)),
+                ("archiveinfo", WLCGPoller("BENCHMARK_RSE", None, url + "/api/v1", rate, {}, workers=workers))
+            ]:
+        dt, counts, stats = bench(poller, files)
+        print("%-12s %8d %10d %10.3f %12.1f %12.3f  %s" % (name, n, stats["polls"], dt, n/dt if dt > 0 else 0.0,
+            stats["average_latency"]*1000, " ".join("%s:%d" % (status, c) for status, c in sorted(counts.items(), key=str))))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#
+# Measures file handle reservation latency against the project size and the fraction of available files
+#
+# Usage: python bench_reserve.py -c <config.yaml> [-s <sizes>] [-f <fractions>] [-n <reservations>] [-p]
+#       -s <sizes>              comma-separated project sizes, default 1000,10000,100000
+#       -f <fractions>          comma-separated fractions of available files, default 0.01,0.1,1.0
+#       -n <reservations>       number of reservations to time per project, default 100
+#       -p                      also time reservations ranked by RSE proximity
+#
+# The script creates temporary projects, replicas and an RSE in the database configured in the "database"
+# section of the config file and deletes them when done.
+#
+# With -p, the "proximity" rows rank the DBFileHandle.ProximityWindow least attempted handles by the proximity
+# of their replicas. The latency of these rows is expected to stay flat as the project size grows past the window
+# size, because the window is joined with the replicas once regardless of the number of handles in the project.
+#
+
+import sys, time, getopt, os, random, yaml
+from wsdbtools import ConnectionPool
+from data_dispatcher.db import DBProject, DBReplica, DBRSE, DBFileHandle
+
+Usage = """
+Usage: python bench_reserve.py -c <config.yaml> [-s <sizes>] [-f <fractions>] [-n <reservations>] [-p]
+"""
+
+RSE = "BENCHMARK_RSE"
+Namespace = "bench_reserve"
+
+def create_project(db, size, fraction, tag):
+    project = DBProject.create(db, "bench_reserve", attributes={"benchmark":"reserve"})
+    files = [{"namespace":Namespace, "name":f"{tag}_{i:08d}"} for i in range(size)]
+    project.add_files(files)
+    available = random.sample(files, int(size*fraction + 0.5))
+    DBReplica.sync_replicas(db, {
+        (f["namespace"], f["name"]): {RSE: {"urls":[], "available":True}}
+        for f in available
+    })
+    return project
+
+def delete_project(db, project):
+    c = db.cursor()
+    c.execute("begin")
+    c.execute("delete from replicas where namespace = %s", (Namespace,))
+    c.execute("delete from projects where id = %s", (project.ID,))
+    c.execute("commit")
+
+def bench(db, project, n, proximities=None):
+    times = []
+    for i in range(n):
+        t0 = time.time()
+        handles = DBFileHandle.reserve_for_worker(db, project.ID, "bench_worker",
+            proximities=proximities, default_proximity=100 if proximities else None)
+        times.append(time.time() - t0)
+        if not handles:
+            break
+    times.sort()
+    return len(times), sum(times)/len(times), times[len(times)//2], times[int(len(times)*0.99)]
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "c:s:f:n:p")
+    opts = dict(opts)
+    config = opts.get("-c") or os.environ.get("DATA_DISPATCHER_CFG")
+    if not config:
+        print(Usage)
+        sys.exit(2)
+    config = yaml.load(open(config, "r"), Loader=yaml.SafeLoader)
+    sizes = [int(x) for x in opts.get("-s", "1000,10000,100000").split(",")]
+    fractions = [float(x) for x in opts.get("-f", "0.01,0.1,1.0").split(",")]
+    n = int(opts.get("-n", 100))
+    modes = [("plain", None)]
+    if "-p" in opts:
+        modes.append(("proximity", {RSE: 0}))
+
+    dbconfig = config["database"]
+    connection_pool = ConnectionPool(postgres=dbconfig, max_connections=dbconfig.get("max_connections"))
+    db = connection_pool.connect()
+
+    DBRSE.create(db, RSE, description="reservation benchmark", is_enabled=True, is_available=True)
+
+    print("%-10s %10s %10s %8s %12s %12s %12s" % ("mode", "size", "available", "reserved", "mean, ms", "median, ms", "99%, ms"))
+    try:
+        for mode, proximities in modes:
+            for size in sizes:
+                for fraction in fractions:
+                    project = create_project(db, size, fraction, f"{mode}_{size}_{fraction}")
+                    try:
+                        nreserved, mean, median, p99 = bench(db, project, n, proximities)
+                    finally:
+                        delete_project(db, project)
+                    print("%-10s %10d %10.3f %8d %12.3f %12.3f %12.3f" % (mode, size, fraction, nreserved, mean*1000, median*1000, p99*1000))
+    finally:
+        c = db.cursor()
+        c.execute("begin")
+        c.execute("delete from rses where name = %s", (RSE,))
+        c.execute("commit")
+
+if __name__ == "__main__":
+    main()
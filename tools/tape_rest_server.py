@@ -0,0 +1,258 @@
+#
+# Local stand-in for a tape RSE REST interface, for tests and benchmarks of the daemon tape RSE pollers and pinners
+#
+# Usage: python tape_rest_server.py [-p <port>] [-s <stage time>] [-d <fraction>] [-m <fraction>] [-l <latency>]
+#       -p <port>               port to listen on, default 8080
+#       -s <stage time>         maximum time in seconds to stage a file, default 60
+#       -d <fraction>           fraction of the files which are initially on disk, default 0.1
+#       -m <fraction>           fraction of the files which do not exist, default 0.0
+#       -l <latency>            added latency per request in seconds, default 0
+#
+# Implements the parts of the WLCG Tape REST API used by the daemon:
+#
+#       GET     /.well-known/wlcg-tape-rest-api             endpoint discovery
+#       POST    /api/v1/stage                               create stage request, {"files":[{"path":...}, ...]}
+#       GET     /api/v1/stage/<request id>                  stage request status
+#       DELETE  /api/v1/stage/<request id>                  delete stage request
+#       POST    /api/v1/stage/<request id>/cancel           cancel some files of the request, {"paths":[...]}
+#       POST    /api/v1/archiveinfo                         bulk file locality, {"paths":[...]}
+#
+# and the dCache namespace locality query and bulk requests API:
+#
+#       GET     /api/v1/namespace/<path>?locality=true
+#       POST    /api/v1/bulk-requests                       create pin request, {"target": "[<path>, ...]", "activity": "PIN", ...}
+#       GET     /api/v1/bulk-requests/<request id>          pin request status
+#       PATCH   /api/v1/bulk-requests/<request id>          cancel some files of the request, {"action": "cancel", "paths": [...]}
+#       DELETE  /api/v1/bulk-requests/<request id>          delete pin request
+#
+# Any path is assumed to exist on tape unless it is selected as missing by the -m option. Files are selected
+# as initially on disk or missing deterministically by their path hash. Once a file is requested to be staged, it
+# becomes ONLINE after a random time between 0 and the stage time.
+#
+# Example daemon RSE configuration:
+#
+#       TEST_TAPE:
+#           is_tape:    true
+#           type:       wlcg
+#           pin_url:    http://localhost:8080/.well-known/wlcg-tape-rest-api
+#
+
+import sys, time, getopt, json, random, threading, uuid, zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+Usage = """
+Usage: python tape_rest_server.py [-p <port>] [-s <stage time>] [-d <fraction>] [-m <fraction>] [-l <latency>]
+"""
+
+class TapeSystem(object):
+
+    def __init__(self, stage_time, on_disk_fraction, missing_fraction):
+        self.StageTime = stage_time
+        self.OnDiskFraction = on_disk_fraction
+        self.MissingFraction = missing_fraction
+        self.OnlineAt = {}          # {path -> time when the file is or will be on disk}
+        self.Requests = {}          # {request id -> {"created":..., "paths":[...]}}
+        self.Lock = threading.Lock()
+
+    def fraction(self, path):
+        return (zlib.crc32(path.encode("utf-8")) % 10000)/10000.0
+
+    def exists(self, path):
+        return self.fraction(path) >= self.MissingFraction
+
+    def on_disk(self, path):
+        if not self.exists(path):
+            return False
+        if self.fraction(path) < self.MissingFraction + self.OnDiskFraction:
+            return True
+        with self.Lock:
+            t = self.OnlineAt.get(path)
+        return t is not None and t <= time.time()
+
+    def stage(self, paths):
+        now = time.time()
+        request_id = uuid.uuid4().hex
+        with self.Lock:
+            for path in paths:
+                if path not in self.OnlineAt:
+                    self.OnlineAt[path] = now + random.random()*self.StageTime
+            self.Requests[request_id] = {"created": now, "paths": list(paths)}
+        return request_id
+
+    def request_status(self, request_id):
+        with self.Lock:
+            request = self.Requests.get(request_id)
+        if request is None:
+            return None
+        files = []
+        for path in request["paths"]:
+            if not self.exists(path):
+                files.append({"path": path, "state": "FAILED", "error": "USER_ERROR: file does not exist"})
+            elif self.on_disk(path):
+                files.append({"path": path, "state": "COMPLETED", "onDisk": True})
+            else:
+                files.append({"path": path, "state": "STARTED", "onDisk": False})
+        out = {
+            "id": request_id,
+            "createdAt": int(request["created"]),
+            "startedAt": int(request["created"]),
+            "files": files
+        }
+        if all(f["state"] != "STARTED" for f in files):
+            out["completedAt"] = int(time.time())
+        return out
+
+    def bulk_request_status(self, request_id):
+        # dCache bulk request format
+        status = self.request_status(request_id)
+        if status is None:
+            return None
+        states = {"COMPLETED": "COMPLETED", "FAILED": "FAILED", "STARTED": "RUNNING"}
+        return {
+            "status": "COMPLETED" if "completedAt" in status else "STARTED",
+            "targets": [{"target": f["path"], "state": states[f["state"]]} for f in status["files"]]
+        }
+
+    def cancel(self, request_id, paths):
+        paths = set(paths)
+        with self.Lock:
+            request = self.Requests.get(request_id)
+            if request is None:
+                return False
+            request["paths"] = [p for p in request["paths"] if p not in paths]
+        return True
+
+    def delete_request(self, request_id):
+        with self.Lock:
+            return self.Requests.pop(request_id, None) is not None
+
+    def archiveinfo(self, path):
+        if not self.exists(path):
+            return {"path": path, "error": "USER_ERROR: file does not exist"}
+        return {"path": path, "locality": "DISK_AND_TAPE" if self.on_disk(path) else "TAPE"}
+
+    def locality(self, path):
+        return "ONLINE_AND_NEARLINE" if self.on_disk(path) else "NEARLINE"
+
+class Handler(BaseHTTPRequestHandler):
+
+    Tape = None
+    Latency = 0.0
+    Prefix = "/api/v1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers={}):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        n = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(n) or b"{}")
+
+    def route(self):
+        if self.Latency:
+            time.sleep(self.Latency)
+        parts = urlsplit(self.path)
+        return parts.path, parse_qs(parts.query)
+
+    def do_GET(self):
+        path, query = self.route()
+        if path == "/.well-known/wlcg-tape-rest-api":
+            host = self.headers.get("Host", "localhost")
+            self.send_json({
+                "sitename": "test",
+                "endpoints": [{"uri": f"http://{host}{self.Prefix}", "version": "v1"}]
+            })
+        elif path.startswith(self.Prefix + "/stage/"):
+            status = self.Tape.request_status(path.split("/")[-1])
+            if status is None:
+                self.send_json({"title": "request not found"}, 404)
+            else:
+                self.send_json(status)
+        elif path.startswith(self.Prefix + "/bulk-requests/"):
+            status = self.Tape.bulk_request_status(path.split("/")[-1])
+            if status is None:
+                self.send_json({"title": "request not found"}, 404)
+            else:
+                self.send_json(status)
+        elif path.startswith(self.Prefix + "/namespace/"):
+            file_path = path[len(self.Prefix + "/namespace"):]
+            if not self.Tape.exists(file_path):
+                self.send_json({"errors": [{"message": "File not found"}]}, 404)
+            else:
+                self.send_json({"fileType": "REGULAR", "fileLocality": self.Tape.locality(file_path)})
+        else:
+            self.send_json({"title": "not found"}, 404)
+
+    def do_POST(self):
+        path, query = self.route()
+        if path == self.Prefix + "/stage":
+            paths = [f["path"] for f in self.read_json().get("files", [])]
+            request_id = self.Tape.stage(paths)
+            self.send_json({"requestId": request_id}, 201,
+                {"Location": f"http://{self.headers.get('Host', 'localhost')}{self.Prefix}/stage/{request_id}"})
+        elif path == self.Prefix + "/bulk-requests":
+            paths = json.loads(self.read_json().get("target", "[]"))
+            request_id = self.Tape.stage(paths)
+            self.send_json({}, 201,
+                {"request-url": f"http://{self.headers.get('Host', 'localhost')}{self.Prefix}/bulk-requests/{request_id}"})
+        elif path.startswith(self.Prefix + "/stage/") and path.endswith("/cancel"):
+            paths = self.read_json().get("paths", [])
+            if self.Tape.cancel(path.split("/")[-2], paths):
+                self.send_json({})
+            else:
+                self.send_json({"title": "request not found"}, 404)
+        elif path == self.Prefix + "/archiveinfo":
+            paths = self.read_json().get("paths", [])
+            self.send_json([self.Tape.archiveinfo(p) for p in paths])
+        else:
+            self.send_json({"title": "not found"}, 404)
+
+    def do_PATCH(self):
+        path, query = self.route()
+        if path.startswith(self.Prefix + "/bulk-requests/"):
+            data = self.read_json()
+            if data.get("action") != "cancel":
+                self.send_json({"title": "unsupported action"}, 400)
+            elif self.Tape.cancel(path.split("/")[-1], data.get("paths", [])):
+                self.send_json({})
+            else:
+                self.send_json({"title": "request not found"}, 404)
+        else:
+            self.send_json({"title": "not found"}, 404)
+
+    def do_DELETE(self):
+        path, query = self.route()
+        if (path.startswith(self.Prefix + "/stage/") or path.startswith(self.Prefix + "/bulk-requests/")) \
+                    and self.Tape.delete_request(path.split("/")[-1]):
+            self.send_json({})
+        else:
+            self.send_json({"title": "request not found"}, 404)
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "p:s:d:m:l:h")
+    opts = dict(opts)
+    if "-h" in opts:
+        print(Usage)
+        sys.exit(2)
+    port = int(opts.get("-p", 8080))
+    Handler.Tape = TapeSystem(float(opts.get("-s", 60)), float(opts.get("-d", 0.1)), float(opts.get("-m", 0.0)))
+    Handler.Latency = float(opts.get("-l", 0.0))
+    server = ThreadingHTTPServer(("", port), Handler)
+    print("Tape REST server listening on port", port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
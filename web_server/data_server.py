@@ -1,11 +1,12 @@
 from webpie import WPApp, WPHandler
-from data_dispatcher.db import DBProject, DBFileHandle, DBRSE, DBProximityMap
+import data_dispatcher.db
+from data_dispatcher.db import DBProject, DBFileHandle, DBRSE, DBProximityMap, DBListener
 from data_dispatcher.logs import Logged, init_logger
 from data_dispatcher import Version
 from metacat.common import SignedToken, SignedTokenExpiredError, SignedTokenImmatureError, \
     SignedTokenUnacceptedAlgorithmError, SignedTokenSignatureVerificationError
 from metacat.auth.server import BaseHandler, BaseApp, AuthHandler
-import json, urllib.parse, yaml, secrets, hashlib
+import json, urllib.parse, yaml, secrets, hashlib, time, threading, itertools
 import requests
 from datetime import datetime, timedelta
 from data_dispatcher.query import ProjectQuery
@@ -20,7 +21,68 @@ def to_str(x):
     if isinstance(x, bytes):
         x = x.decode("utf-8")
     return x
-    
+
+#
+# Streaming responses. Large listings are sent as they are read from the database instead of being built in memory first.
+# Two formats are supported:
+#   "json"      - regular JSON document, content type text/json
+#   "json-seq"  - RFC 7464 JSON text sequence, content type application/json-seq: each item is sent as
+#                 <RS><JSON text><LF>, so the client can parse the items one by one
+#
+# The response status is sent before the items are read, so an error in the middle of the stream can not change it.
+# A JSON document cut by an error is left unterminated and fails to parse. A JSON text sequence always ends with
+# either the {"$end": true} record or the {"$error": "<message>"} record, so the client can tell a complete sequence
+# from a truncated one.
+#
+
+StreamChunkSize = 64*1024
+
+def buffered(parts, chunk_size=StreamChunkSize):
+    # combines small strings into chunks of about chunk_size characters
+    buf = []
+    size = 0
+    for part in parts:
+        buf.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield "".join(buf)
+
+def json_list_parts(items):
+    yield "["
+    comma = ""
+    for item in items:
+        yield comma + json.dumps(item)
+        comma = ","
+    yield "]"
+
+def json_object_parts(obj, list_key, items):
+    # JSON representation of obj with an additional list_key member, which is the list of the items
+    head = json.dumps(obj)[:-1]             # remove closing "}"
+    if obj:
+        head += ","
+    yield head + json.dumps(list_key) + ":"
+    yield from json_list_parts(items)
+    yield "}"
+
+def json_seq_parts(items):
+    try:
+        for item in items:
+            yield "\x1e" + json.dumps(item) + "\n"
+    except Exception as e:
+        yield "\x1e" + json.dumps({"$error": f"{e.__class__.__name__}: {e}"}) + "\n"
+    else:
+        yield "\x1e" + json.dumps({"$end": True}) + "\n"
+
+def stream_list(items, format="json"):
+    # returns webpie response streaming the items as a JSON list or a JSON text sequence
+    if format == "json-seq":
+        return buffered(json_seq_parts(items)), "application/json-seq"
+    return buffered(json_list_parts(items)), "text/json"
+
 class Handler(BaseHandler):
     
     def __init__(self, request, app):
@@ -100,6 +162,7 @@ class Handler(BaseHandler):
         if user.Username != project.Owner and not user.is_admin():
             return 403, "Forbidden"
         project.delete()
+        self.App.ProjectCache.invalidate(project_id)
         return "null", "text/json"
         
     def activate_project(self, request, relpath, project_id=None, **args):
@@ -117,6 +180,7 @@ class Handler(BaseHandler):
         if user.Username != project.Owner and not user.is_admin():
             return 403, "Forbidden"
         project.activate()
+        self.App.ProjectCache.invalidate(project_id)
         return json.dumps(project.as_jsonable(with_replicas=True)), "text/json"
 
     def restart_project(self, request, relpath, project_id=None, force="no", failed_only="yes", **args):
@@ -136,6 +200,7 @@ class Handler(BaseHandler):
         if user.Username != project.Owner and not user.is_admin():
             return 403, "Forbidden"
         project.restart(force=force, failed_only=failed_only)
+        self.App.ProjectCache.invalidate(project_id)
         return json.dumps(project.as_jsonable(with_replicas=True)), "text/json"
         
     def restart_handles(self, request, relpath, **args):
@@ -162,6 +227,7 @@ class Handler(BaseHandler):
         else:
             states = [s for s in DBFileHandle.States if params.get(s)]
             project.restart_handles(states=states)
+        self.App.ProjectCache.invalidate(project_id)
 
         return json.dumps(project.as_jsonable(with_replicas=True)), "text/json"
         
@@ -213,51 +279,96 @@ class Handler(BaseHandler):
         if user.Username != project.Owner and not user.is_admin():
             return 403, "Forbidden"
         project.cancel()
+        self.App.ProjectCache.invalidate(project_id)
         return json.dumps(project.as_jsonable(with_replicas=True)), "text/json"
         
-    def next_file(self, request, relpath, project_id=None, worker_id=None, cpu_site=None, **args):
+    MaxReserveCount = 100           # max number of handles reserved by single next_file request
+
+    def reserved_handle_info(self, handle, project, pmap, cpu_site):
+        info = handle.as_jsonable(with_replicas=True)
+        info["replicas"] = {
+                rse: r for rse, r in info["replicas"].items()
+                if r["available"] and r["rse_available"]
+        }
+        for rse, r in info["replicas"].items():
+            try:    proximity = pmap.proximity(cpu_site, rse)
+            except KeyError:
+                proximity = None
+            r["preference"] = r["proximity"] = proximity
+        info["project_attributes"] = project.Attributes or {}
+        return info
+
+    def next_file(self, request, relpath, project_id=None, worker_id=None, cpu_site=None, count=None, wait=None, **args):
         #print("next_file...")
         user, error = self.authenticated_user()
         if user is None:
             return 401, error
         if worker_id is None or project_id is None:
             return 400, "Project ID and Worker ID must be specified"
-        db = self.App.db()
+        if count is not None:
+            try:    count = int(count)
+            except ValueError:
+                return 400, "Invalid count value"
+            if count < 1:
+                return 400, "Count must be positive"
+            count = min(count, self.MaxReserveCount)
+        notifier = self.App.DispatchNotifier
+        if wait is not None:
+            try:    wait = float(wait)
+            except ValueError:
+                return 400, "Invalid wait value"
+            if notifier is None:
+                wait = None             # long poll is not available
+            else:
+                wait = min(max(wait, 0.0), self.App.MaxLongPollWait)
         project_id = int(project_id)
-        project = DBProject.get(db, project_id)
-        if not project:
-            return 404, "Project not found"
-        if not (user.is_admin() or project.authorized_user(user.Username)):
-            return 403, "Not authorized"
-        if project.State == "abandoned":
-            project.activate()
-        elif project.State != "active":
-            return 400, f"Inactive project. State={project.State}"
-        handle, reason, retry = project.reserve_handle(worker_id)
-        if handle is None:
-            out = {
-                "handle": None,
-                "reason": reason,
-                "retry": retry
-            }
-        else:
+        project_cache = self.App.ProjectCache
+        t_end = time.time() + (wait or 0)
+        long_poll = wait is not None
+        while True:
+            if notifier is not None:
+                mark = notifier.mark(project_id)        # before the reservation attempt to not miss a notification
+            db = self.App.db()
+            project = project_cache.get(db, project_id)
+            if not project:
+                return 404, "Project not found"
+            if not (user.is_admin() or project_cache.authorized_user(project, user.Username)):
+                return 403, "Not authorized"
+            if project.State == "abandoned":
+                project.activate()
+                project_cache.update(project)
+            elif project.State != "active":
+                return 400, f"Inactive project. State={project.State}"
+            proximities = default_proximity = None
+            if cpu_site:
+                proximities, default_proximity = self.App.ProximityMapCache.cpu_proximities(cpu_site)
+            handles, reason, retry = project.reserve_handles(worker_id, count or 1, 
+                            proximities=proximities, default_proximity=default_proximity)
+            if reason == "project inactive":
+                project_cache.invalidate(project_id)
+            dt = t_end - time.time()
+            if handles or not retry or not wait or dt <= 0:
+                break
+            project = db = None             # return the DB connection to the pool while waiting
+            if notifier.wait(project_id, mark, dt) is None:
+                long_poll = False           # too many requests are held already, the client should sleep before retrying
+                break
+
+        infos = []
+        if handles:
             pmap = self.App.proximity_map()
-            info = handle.as_jsonable(with_replicas=True)
-            info["replicas"] = {
-                    rse: r for rse, r in info["replicas"].items() 
-                    if r["available"] and r["rse_available"]
-            }
-            for rse, r in info["replicas"].items():
-                try:    proximity = pmap.proximity(cpu_site, rse)
-                except KeyError:
-                    proximity = None
-                r["preference"] = r["proximity"] = proximity
-            info["project_attributes"] = project.Attributes or {}
-            out = {
-                "handle": info,
-                "reason": "reserved",
-                "retry": False
-            }
+            infos = [self.reserved_handle_info(h, project, pmap, cpu_site) for h in handles]
+            reason, retry = "reserved", False
+        out = {
+            "reason": reason,
+            "retry": retry
+        }
+        if wait is not None:
+            out["long_poll"] = long_poll    # if true, the request was held on the server and the client does not need to sleep before retrying
+        if count is None:
+            out["handle"] = infos[0] if infos else None
+        else:
+            out["handles"] = infos
         return json.dumps(out), "text/json"
 
     def release(self, request, relpath, handle_id=None, failed="no", retry="yes", **args):
@@ -271,23 +382,116 @@ class Handler(BaseHandler):
 
         project_id, namespace, name = DBFileHandle.unpack_id(handle_id)
 
-        project = DBProject.get(db, project_id)
+        project_cache = self.App.ProjectCache
+        project = project_cache.get(db, project_id)
         if project is None:
             return 404, "Project not found"
 
-        if not user.is_admin() and user.Username != project.Owner:
+        if not (user.is_admin() or project_cache.authorized_user(project, user.Username)):
             return 403, "Not authorized"
-            
+
         failed = failed == "yes"
         retry = retry == "yes"
-        
+
+        old_state = project.State
         handle = project.release_handle(namespace, name, failed, retry)
         if handle is None:
             return 404, "Handle not found or was not reserved"
         if project.State == "abandoned":
             project.activate()
+        if project.State != old_state:
+            project_cache.update(project)
         return json.dumps(handle.as_jsonable()), "text/json"
 
+    def release_handles(self, request, relpath, **args):
+        # request body: {
+        #   "project_id": ...,
+        #   "handles": [ {"did": "namespace:name", "failed": true/false, "retry": true/false}, ... ]
+        # }
+        user, error = self.authenticated_user()
+        if user is None:
+            return 401, error
+
+        params = json.loads(to_str(request.body))
+        project_id = params.get("project_id")
+        if not project_id:
+            return 400, "Project id must be specified"
+        project_id = int(project_id)
+
+        releases = []
+        for item in params.get("handles", []):
+            if isinstance(item, str):
+                item = {"did": item}
+            did = item.get("did") if isinstance(item, dict) else None
+            if not did or ":" not in did:
+                return 400, f"Invalid file handle specification: {item}"
+            namespace, name = did.split(":", 1)
+            releases.append((namespace, name, bool(item.get("failed", False)), bool(item.get("retry", True))))
+
+        db = self.App.db()
+        project_cache = self.App.ProjectCache
+        project = project_cache.get(db, project_id)
+        if project is None:
+            return 404, "Project not found"
+
+        if not (user.is_admin() or project_cache.authorized_user(project, user.Username)):
+            return 403, "Not authorized"
+
+        old_state = project.State
+        released = project.release_handles(releases)
+        if project.State == "abandoned":
+            project.activate()
+        if project.State != old_state:
+            project_cache.update(project)
+        released_dids = set(h.did() for h in released)
+        out = {
+            "released":     [h.as_jsonable() for h in released],
+            "not_released": [f"{namespace}:{name}" for namespace, name, _, _ in releases
+                                if f"{namespace}:{name}" not in released_dids]
+        }
+        return json.dumps(out), "text/json"
+
+    def renew_leases(self, request, relpath, **args):
+        # request body: {
+        #   "project_id": ...,
+        #   "worker_id": ...,
+        #   "handles": ["namespace:name", ...]        # optional, default: all handles reserved by the worker
+        # }
+        user, error = self.authenticated_user()
+        if user is None:
+            return 401, error
+
+        params = json.loads(to_str(request.body))
+        project_id = params.get("project_id")
+        worker_id = params.get("worker_id")
+        if not project_id or not worker_id:
+            return 400, "Project ID and Worker ID must be specified"
+        project_id = int(project_id)
+        dids = params.get("handles")
+        if dids is not None:
+            for did in dids:
+                if not isinstance(did, str) or ":" not in did:
+                    return 400, f"Invalid file handle specification: {did}"
+
+        db = self.App.db()
+        project_cache = self.App.ProjectCache
+        project = project_cache.get(db, project_id)
+        if project is None:
+            return 404, "Project not found"
+
+        if not (user.is_admin() or project_cache.authorized_user(project, user.Username)):
+            return 403, "Not authorized"
+
+        renewed = DBFileHandle.renew_leases(db, project_id, worker_id, dids)
+        out = {
+            "renewed":      renewed,
+            "worker_timeout":   None if project.WorkerTimeout is None else project.WorkerTimeout.total_seconds()
+        }
+        if dids is not None:
+            renewed_set = set(renewed)
+            out["not_renewed"] = [did for did in dids if did not in renewed_set]
+        return json.dumps(out), "text/json"
+
     def ______reset_file(self, request, relpath, handle_id=None, force="no", **args):
         # not fully implemented. need to be careful with the project status update - possible race condition
         if handle_id is None:
@@ -318,7 +522,9 @@ class Handler(BaseHandler):
         handle.reset()
         return json.dumps(handle.as_jsonable()), "text/json"
         
-    def project_files(self, request, relpath, project_id=None, state=None, ready_only="no", **args):
+    def project_files(self, request, relpath, project_id=None, state=None, ready_only="no", format="json", 
+                after=None, limit=None, **args):
+        # after=<namespace:name>, limit=<n> - keyset pagination, handles are sorted by namespace, name
         if project_id is None:
             return 400, "Project ID must be specified"
         ready_only = ready_only == "yes"
@@ -326,10 +532,14 @@ class Handler(BaseHandler):
         project_id = int(project_id)
         project = DBProject.get(db, project_id)
         if not project: return 404, "Project not found"
-        handles = project.files(state=state, ready_only=ready_only)
-        return json.dumps([h.as_jsonable(with_replicas=ready_only) for h in handles]), "text/json"
-
-    def project(self, request, relpath, project_id=None, with_files="yes", with_replicas="yes", **args):
+        handles = DBFileHandle.list(db, project_id=project_id, state=state, available_only=ready_only,
+                        with_replicas=ready_only, with_availability=ready_only,
+                        after=after, limit=None if limit is None else int(limit))
+        return stream_list((h.as_jsonable(with_replicas=ready_only) for h in handles), format)
+
+    def project(self, request, relpath, project_id=None, with_files="yes", with_replicas="yes", format="json", **args):
+        # format: "json" - single JSON object with the list of handles under "file_handles"
+        #         "json-seq" - JSON text sequence: the project information without the handles followed by the handles
         with_files = with_files == "yes"
         with_replicas = with_replicas == "yes"
         db = self.App.db()
@@ -338,8 +548,17 @@ class Handler(BaseHandler):
         if not project:
             return 404, "Project not found"
         #print("project(): with handles/replicas: ", with_files, with_replicas)
-        jsonable = project.as_jsonable(with_handles=with_files, with_replicas=with_replicas)
-        return json.dumps(jsonable), "text/json"
+        jsonable = project.as_jsonable()
+        handles = []
+        if with_files or with_replicas:
+            handles = (h.as_jsonable(with_replicas=with_replicas) 
+                        for h in DBFileHandle.list(db, project_id=project_id, with_replicas=True, with_availability=True))
+        if format == "json-seq":
+            return buffered(json_seq_parts(itertools.chain([jsonable], handles))), "application/json-seq"
+        elif with_files or with_replicas:
+            return buffered(json_object_parts(jsonable, "file_handles", handles)), "text/json"
+        else:
+            return json.dumps(jsonable), "text/json"
 
     def project_handles_log(self, request, relpath, project_id=None):
         project_id = int(project_id)
@@ -396,12 +615,30 @@ class Handler(BaseHandler):
             return "null", "text/json"
         return json.dumps(handle.as_jsonable(with_replicas=True)), "text/json"
     
-    def handles(self, request, relpath, project_id=None, state=None, not_state=None, with_replicas="no"):
+    def handles(self, request, relpath, project_id=None, state=None, not_state=None, with_replicas="no", format="json",
+                after=None, limit=None):
+        # after=<namespace:name>, limit=<n> - keyset pagination, handles are sorted by namespace, name
         db = self.App.db()
         project_id = int(project_id)
-        lst = DBFileHandle.list(db, project_id=project_id, not_state=not_state, state=state, with_replicas=with_replicas=="yes")
-        return json.dumps([h.as_jsonable() for h in lst]), "text/json"
+        with_replicas = with_replicas == "yes"
+        lst = DBFileHandle.list(db, project_id=project_id, not_state=not_state, state=state, 
+                    with_replicas=with_replicas, with_availability=with_replicas,
+                    after=after, limit=None if limit is None else int(limit))
+        return stream_list((h.as_jsonable(with_replicas=with_replicas) for h in lst), format)
         
+    def reserved_handles(self, request, relpath, project_id=None, worker_id=None, with_replicas="no", format="json"):
+        # returns the handles reserved in the project by the worker
+        if not project_id or not worker_id:
+            return 400, "Project ID and Worker ID must be specified"
+        db = self.App.db()
+        project = self.App.ProjectCache.get(db, int(project_id))
+        if project is None:
+            return 404, "Project not found"
+        with_replicas = with_replicas == "yes"
+        handles = DBFileHandle.list(db, project_id=project.ID, state=DBFileHandle.ReservedState, worker_id=worker_id,
+                    with_replicas=with_replicas, with_availability=with_replicas)
+        return stream_list((h.as_jsonable(with_replicas=with_replicas) for h in handles), format)
+
     def rses(self, request, relpath, **args):
         rses = DBRSE.list(self.App.db())
         return json.dumps([r.as_jsonable() for r in rses]), "text/json"
@@ -434,6 +671,163 @@ class Handler(BaseHandler):
         return json.dumps(rse.as_jsonable()), "text/json"
 
 
+class ProximityMapCache(Logged):
+    # Shared proximity map. The map version in the database is checked at most once per TTL seconds
+    # and the map is reloaded only if the version has changed
+
+    def __init__(self, app, defaults={}, overrides={}, ttl=60):
+        Logged.__init__(self, "ProximityMapCache")
+        self.App = app
+        self.Defaults = defaults
+        self.Overrides = overrides
+        self.TTL = ttl
+        self.Map = None
+        self.Version = None
+        self.CheckedAt = 0
+        self.CPUProximities = {}            # {cpu -> ({rse -> proximity}, default)}, for the current map
+        self.Lock = threading.RLock()
+
+    def get(self):
+        with self.Lock:
+            now = time.time()
+            if self.Map is None or now >= self.CheckedAt + self.TTL:
+                db = self.App.db()
+                version = DBProximityMap.version(db)
+                if self.Map is None or version is None or version != self.Version:
+                    # do not keep the DB connection in the cached map
+                    self.Map = DBProximityMap(None, tuples=DBProximityMap.read_tuples(db), 
+                                    defaults=self.Defaults, overrides=self.Overrides)
+                    self.Version = version
+                    self.CPUProximities = {}
+                    self.debug("proximity map reloaded, version:", version)
+                self.CheckedAt = now
+            return self.Map
+
+    def cpu_proximities(self, cpu):
+        with self.Lock:
+            pmap = self.get()
+            proximities = self.CPUProximities.get(cpu)
+            if proximities is None:
+                proximities = self.CPUProximities[cpu] = pmap.cpu_proximities(cpu)
+            return proximities
+
+    def invalidate(self):
+        with self.Lock:
+            self.Map = None
+            self.CPUProximities = {}
+
+class DispatchNotifier(Logged):
+    # Listens to the DBProject.DispatchChannel notifications and wakes up the next_file requests waiting for
+    # the project handles to become available for dispatching.
+    # Each waiting request holds a web server thread, so the number of waiting requests is limited by max_waiters
+
+    def __init__(self, dbconfig, max_waiters=20):
+        Logged.__init__(self, "DispatchNotifier")
+        self.MaxWaiters = max_waiters
+        self.Waiters = 0
+        self.Listener = DBListener(dbconfig, [DBProject.DispatchChannel])
+        self.Versions = {}              # {project_id -> notification counter}
+        self.Generation = 0             # incremented when notifications may have been lost
+        self.Condition = threading.Condition()
+        self.Thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.Thread.start()
+
+    def run(self):
+        while True:
+            try:
+                notifications = self.Listener.wait(10)
+            except Exception as e:
+                self.error("listener error:", e)
+                with self.Condition:
+                    # wake up all waiting requests to retry because notifications may have been missed
+                    self.Generation += 1
+                    self.Condition.notify_all()
+                time.sleep(5)
+                continue
+            if notifications:
+                with self.Condition:
+                    for channel, payload in notifications:
+                        try:    project_id = int(payload)
+                        except ValueError:
+                            continue
+                        self.Versions[project_id] = self.Versions.get(project_id, 0) + 1
+                    self.Condition.notify_all()
+
+    def mark(self, project_id):
+        with self.Condition:
+            return (self.Generation, self.Versions.get(project_id, 0))
+
+    def wait(self, project_id, mark, timeout):
+        # waits until a notification for the project arrives after mark() was called, or until the timeout
+        # returns True if notified, False on timeout, None without waiting if max_waiters requests are waiting already
+        with self.Condition:
+            if self.Waiters >= self.MaxWaiters:
+                return None
+            self.Waiters += 1
+            try:
+                return self.Condition.wait_for(lambda: self.mark(project_id) != mark, timeout)
+            finally:
+                self.Waiters -= 1
+
+class ProjectCache(Logged):
+    # Per-process cache of project metadata and authorization, keyed by project id.
+    # DBProject objects are not shared between requests because they hold the DB connection. The cache keeps project tuples
+    # and creates a new DBProject for every get()
+
+    def __init__(self, ttl=10):
+        Logged.__init__(self, "ProjectCache")
+        self.TTL = ttl
+        self.Projects = {}              # {project_id -> (project tuple, time cached)}
+        self.Authorized = {}            # {(project_id, username) -> (authorized, time cached)}
+        self.PurgedAt = time.time()
+        self.Lock = threading.RLock()
+
+    def purge(self, now):
+        # remove expired entries, called under the lock
+        if now < self.PurgedAt + self.TTL:
+            return
+        self.Projects = {project_id: entry for project_id, entry in self.Projects.items() if now < entry[1] + self.TTL}
+        self.Authorized = {key: entry for key, entry in self.Authorized.items() if now < entry[1] + self.TTL}
+        self.PurgedAt = now
+
+    def get(self, db, project_id):
+        now = time.time()
+        with self.Lock:
+            tup, t = self.Projects.get(project_id, (None, 0))
+        if tup is not None and now < t + self.TTL:
+            return DBProject.from_tuple(db, tup)
+        project = DBProject.get(db, project_id)
+        if project is not None:
+            with self.Lock:
+                self.purge(now)
+                self.Projects[project_id] = (project.as_tuple(), now)
+        return project
+
+    def authorized_user(self, project, username):
+        now = time.time()
+        key = (project.ID, username)
+        with self.Lock:
+            authorized, t = self.Authorized.get(key, (None, 0))
+        if authorized is None or now >= t + self.TTL:
+            authorized = project.authorized_user(username)
+            with self.Lock:
+                self.purge(now)
+                self.Authorized[key] = (authorized, now)
+        return authorized
+
+    def update(self, project):
+        # call after the project state was changed by this process
+        with self.Lock:
+            self.Projects[project.ID] = (project.as_tuple(), time.time())
+
+    def invalidate(self, project_id):
+        with self.Lock:
+            self.Projects.pop(project_id, None)
+            for key in [key for key in self.Authorized if key[0] == project_id]:
+                del self.Authorized[key]
+
 class App(BaseApp, Logged):
 
     def __init__(self, config, prefix):
@@ -443,13 +837,23 @@ class App(BaseApp, Logged):
         proximity_map_cfg = config.get("proximity_map", {})
         self.ProximityMapDefaults = proximity_map_cfg.get("defaults", {})
         self.ProximityMapOverrides = proximity_map_cfg.get("overrides", {})
+        self.ProximityMapCache = ProximityMapCache(self, 
+                defaults=self.ProximityMapDefaults, overrides=self.ProximityMapOverrides, 
+                ttl=proximity_map_cfg.get("cache_ttl", 60))
+        self.ProjectCache = ProjectCache(ttl=config.get("web_server", {}).get("project_cache_ttl", 10))
+        data_dispatcher.db.ServerCursorItersize = config["database"].get("itersize", data_dispatcher.db.ServerCursorItersize)
+        long_poll_cfg = config.get("web_server", {}).get("long_poll", {})
+        self.MaxLongPollWait = long_poll_cfg.get("max_wait", 20)
+        self.DispatchNotifier = None
+        if long_poll_cfg.get("enabled", True):
+            self.DispatchNotifier = DispatchNotifier(config["database"], max_waiters=long_poll_cfg.get("max_waiters", 20))
+            self.DispatchNotifier.start()
         log_out = config.get("web_server",{}).get("log","-")
         init_logger(log_out, debug_enabled=True)
         self.init_auth_core(config)
     
     def proximity_map(self):
-        db = self.db()
-        return DBProximityMap(db, defaults=self.ProximityMapDefaults, overrides=self.ProximityMapOverrides)
+        return self.ProximityMapCache.get()
 
     def project_created(self, project_id):
         if self.DaemonURL:
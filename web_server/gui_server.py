@@ -165,9 +165,7 @@ class ProjectsHandler(BaseHandler):
         project = DBProject.get(db, project_id)
         if project is None:
             return 404, "Project not found"
-        counts = {state:0 for state in DBFileHandle.DerivedStates}
-        for did, state in project.handle_states().items():
-            counts[state] = counts.get(state, 0) + 1
+        counts = project.handle_state_counts()
         return json.dumps(counts), "text/json"
 
     @sanitize()